@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from pathlib import Path
@@ -6,13 +7,28 @@ import uvicorn
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 
 from config import settings
 from database import cosmos_db
+from db_instrumentation import RequestCostMiddleware
+from metrics import (
+    MetricsMiddleware,
+    export_snapshots,
+    registry,
+    render_all,
+    sample_event_loop_lag,
+    write_snapshot,
+)
+from profiling import PROFILE_ID_HEADER, ProfilingMiddleware
 from routes_auth import router as auth_router
 from routes_media import router as media_router
+from routes_files import router as files_router
+from routes_profiles import router as profiles_router
 from storage import blob_storage
+from tracing import TRACE_ID_HEADER, TracingMiddleware
+from upload_guard import UploadGuardMiddleware
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +38,24 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def warm_up(app: FastAPI):
+    """Warm connection pools in the background, then mark the app ready"""
+    retry_delay = 1
+    while True:
+        try:
+            await asyncio.gather(
+                run_in_threadpool(cosmos_db.warm_up, settings.warmup_connections),
+                run_in_threadpool(blob_storage.warm_up, settings.warmup_connections),
+            )
+            app.state.ready = True
+            logger.info("Azure connections warmed up, ready to serve")
+            return
+        except Exception as e:
+            logger.error(f"Warm-up failed, retrying in {retry_delay}s: {e}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -29,18 +63,32 @@ async def lifespan(app: FastAPI):
     """
     # Startup
     logger.info("Starting up Cloud Media Platform API...")
-    try:
-        cosmos_db.initialize()
-        blob_storage.initialize()
-        logger.info("Azure services initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize Azure services: {e}")
-        raise
+    app.state.ready = False
+    if settings.provision_on_startup:
+        try:
+            await run_in_threadpool(cosmos_db.provision)
+            await run_in_threadpool(blob_storage.provision)
+            logger.info("Azure services provisioned successfully")
+        except Exception as e:
+            logger.error(f"Failed to provision Azure services: {e}")
+            raise
+
+    # Resources are assumed to be provisioned; clients connect lazily
+    warm_up_task = asyncio.create_task(warm_up(app))
+    lag_sampler_task = asyncio.create_task(sample_event_loop_lag())
+    metrics_dir = settings.metrics_multiprocess_dir
+    snapshot_task = asyncio.create_task(export_snapshots(metrics_dir)) if metrics_dir else None
 
     yield
 
     # Shutdown
     logger.info("Shutting down Cloud Media Platform API...")
+    warm_up_task.cancel()
+    lag_sampler_task.cancel()
+    if snapshot_task is not None:
+        snapshot_task.cancel()
+        # Keep this worker's counts in the node's totals after it exits
+        write_snapshot(metrics_dir)
 
 
 # Create FastAPI application
@@ -54,13 +102,34 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
-# Configure CORS
+# Refuse oversized or mistyped uploads before their body is ingested
+app.add_middleware(UploadGuardMiddleware)
+
+# Record request metrics and the database cost of each request
+app.add_middleware(RequestCostMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+# Profile requests that ask for it (X-Profile) or are sampled
+app.add_middleware(ProfilingMiddleware)
+
+# Trace sampled requests; the root span covers everything below CORS
+app.add_middleware(TracingMiddleware)
+
+# Configure CORS, added last so it is outermost: responses sent early by the
+# middlewares above (413/415/429 from the upload guard) get CORS headers too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.allowed_origins_list,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Request-Charge",
+        "Server-Timing",
+        "Retry-After",
+        PROFILE_ID_HEADER,
+        TRACE_ID_HEADER,
+    ],
 )
 
 
@@ -107,9 +176,35 @@ async def health_check():
     }
 
 
+# Readiness endpoint
+@app.get("/api/ready", tags=["Health"])
+async def readiness_check(request: Request):
+    """Readiness endpoint: 503 until connection pools are warmed up"""
+    if not request.app.state.ready:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "warming_up"},
+        )
+    return {"status": "ready"}
+
+
+# Metrics endpoint
+@app.get("/api/metrics", tags=["Health"], response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics for this node's workers, or this process without a metrics directory"""
+    if settings.metrics_multiprocess_dir:
+        text = await run_in_threadpool(render_all, settings.metrics_multiprocess_dir)
+    else:
+        text = registry.render()
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
 # Include routers
 app.include_router(auth_router, prefix="/api")
 app.include_router(media_router, prefix="/api")
+app.include_router(profiles_router, prefix="/api")
+if settings.storage_backend == "local":
+    app.include_router(files_router, prefix="/api")
 
 # Static files configuration
 static_dir = Path(__file__).parent / "static"
@@ -18,6 +18,16 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, Optional[str]]:
+    """
+    Verify a password against its hash
+    Also returns a new hash when the stored one uses outdated parameters
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
 def get_password_hash(password: str) -> str:
     """Hash a password"""
     return pwd_context.hash(password)
@@ -54,6 +64,17 @@ def decode_access_token(token: str) -> dict:
         )
 
 
+def bearer_user_id(authorization: str) -> Optional[str]:
+    """User id of a valid 'Bearer <token>' Authorization header, or None"""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return decode_access_token(token).get("sub")
+    except HTTPException:
+        return None
+
+
 async def get_current_user_id(
     credentials: HTTPAuthorizationCredentials = Depends(security),
 ) -> str:
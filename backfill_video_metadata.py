@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Video metadata backfill
+Fills in duration, display size, codecs and creation time on video documents
+uploaded before these were read at upload time. Each video's container
+headers are read from blob storage with ranged reads (see video_metadata), so
+a video costs a few KB of transfer rather than a download. Database reads run
+at bulk priority.
+
+Every video looked at is marked with videoMetadataChecked, including those
+whose headers cannot be parsed (counted as unreadable), so a later run does
+not read them again. Videos whose blob could not be read are left unmarked
+for the next run.
+
+Usage:
+    python backfill_video_metadata.py [--dry-run] [--user USER_ID ...] [--after USER_ID]
+"""
+import argparse
+import logging
+import sys
+from collections import Counter
+
+from database import cosmos_db
+from storage import blob_storage
+from user_batch import add_user_arguments, run_per_user
+from video_metadata import extract_video_metadata
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def backfill_user(user_id: str, dry_run: bool, counts: Counter):
+    for document in cosmos_db.get_videos_without_metadata(user_id):
+        name = document["fileName"]
+        errors = []
+
+        def read(offset: int, length: int) -> bytes:
+            try:
+                return blob_storage.read_file(name, offset, length)
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        metadata = extract_video_metadata(read, document["fileSize"])
+        if errors:
+            logger.warning(f"Could not read {name}: {errors[0]}")
+            counts["read_failed"] += 1
+            continue
+        counts["updated" if metadata.get("durationSeconds") else "unreadable"] += 1
+        if dry_run:
+            logger.info(f"Would update {document['id']}: {metadata}")
+            continue
+        cosmos_db.update_media(
+            document["id"], user_id, {**metadata, "videoMetadataChecked": True}
+        )
+    counts["users"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read metadata of videos uploaded without it")
+    parser.add_argument("--dry-run", action="store_true", help="only log what would be stored")
+    add_user_arguments(parser, "backfill")
+    args = parser.parse_args()
+
+    counts = Counter()
+    return run_per_user(
+        "Backfill",
+        lambda user_id: backfill_user(user_id, args.dry_run, counts),
+        args.user,
+        args.after,
+        counts,
+        args.dry_run,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
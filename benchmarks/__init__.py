@@ -0,0 +1,20 @@
+"""
+Local benchmark suite
+Runs the API against in-memory stand-ins for Cosmos DB and Blob Storage so
+changes can be measured without Azure accounts.
+
+    python -m benchmarks.load_test --duration 30 --concurrency 16
+    python -m benchmarks.micro
+    python -m benchmarks.compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import os
+
+# Settings requires these; the fakes never use them
+os.environ.setdefault("COSMOS_ENDPOINT", "https://benchmark.documents.azure.com:443/")
+os.environ.setdefault("COSMOS_KEY", "YmVuY2htYXJr")
+os.environ.setdefault(
+    "AZURE_STORAGE_CONNECTION_STRING",
+    "DefaultEndpointsProtocol=https;AccountName=benchmark;"
+    "AccountKey=YmVuY2htYXJr;EndpointSuffix=core.windows.net",
+)
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
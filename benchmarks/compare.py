@@ -0,0 +1,23 @@
+"""
+Compare two benchmark result files
+
+    python -m benchmarks.compare BASELINE.json CURRENT.json [--threshold 0.1]
+"""
+import argparse
+import sys
+
+from benchmarks.results import compare
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare benchmark results")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change counted as a regression")
+    args = parser.parse_args()
+    return 0 if compare(args.baseline, args.current, args.threshold) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
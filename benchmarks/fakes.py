@@ -0,0 +1,513 @@
+"""
+In-memory stand-ins for CosmosDBClient and BlobStorageClient
+Both mirror the public methods of the real clients (install_fakes checks) and
+can inject latency to emulate the network round trip of the real SDK calls
+(which block the calling thread, so the fakes block too). Writes are numbered
+like the SQLite backend's, which gives delta sync watermarks and change feed
+continuations.
+"""
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+import database
+import storage
+from delta_sync import decode_watermark, encode_watermark
+from hedging import hedged
+
+CHANGE_FEED_RANGE = "0"
+
+
+class LatencyModel:
+    """Fixed base latency plus an exponential tail, in milliseconds"""
+
+    def __init__(self, base_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.base_ms = base_ms
+        self.jitter_ms = jitter_ms
+
+    def wait(self):
+        delay = self.base_ms
+        if self.jitter_ms:
+            delay += random.expovariate(1 / self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+
+class InMemoryCosmosDBClient:
+    def __init__(self, latency: Optional[LatencyModel] = None):
+        self.latency = latency or LatencyModel()
+        self._lock = threading.Lock()
+        self.users = {}
+        self.media = {}
+        self.views = {}
+        self.tombstones = {}
+        self.leases = {}
+        # Write sequence numbers of media documents and tombstones, by key
+        self._seq = 0
+        self._media_seq = {}
+        self._tombstone_seq = {}
+        # Versions of views, used as their etags
+        self._view_versions = {}
+
+    def provision(self, migrate_indexing_policy: bool = True):
+        pass
+
+    def warm_up(self, connections: int = 4):
+        pass
+
+    def reset_after_fork(self):
+        pass
+
+    def _next_seq(self) -> int:
+        """Call with the lock held"""
+        self._seq += 1
+        return self._seq
+
+    # User operations
+    def create_user(self, user_data: dict) -> dict:
+        self.latency.wait()
+        with self._lock:
+            if user_data["id"] in self.users:
+                raise ValueError("User already exists")
+            self.users[user_data["id"]] = dict(user_data)
+        return dict(user_data)
+
+    def get_user_by_email(self, email: str) -> Optional[dict]:
+        self.latency.wait()
+        with self._lock:
+            for user in self.users.values():
+                if user["email"] == email:
+                    return dict(user)
+        return None
+
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        def read():
+            self.latency.wait()
+            user = self.users.get(user_id)
+            return dict(user) if user else None
+
+        # Point reads are hedged like CosmosDBClient's
+        return hedged("get_user_by_id", read)
+
+    def iter_users(
+        self,
+        page_size: int = 500,
+        after_id: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Iterator[List[dict]]:
+        with self._lock:
+            users = sorted(
+                (dict(user) for user in self.users.values() if user["id"] > (after_id or "")),
+                key=lambda user: user["id"],
+            )
+        if fields:
+            keep = {"id", *fields}
+            users = [{key: value for key, value in user.items() if key in keep} for user in users]
+        for start in range(0, len(users), page_size):
+            self.latency.wait()
+            yield users[start:start + page_size]
+
+    def patch_user(self, user_id: str, fields: dict) -> dict:
+        self.latency.wait()
+        with self._lock:
+            if user_id not in self.users:
+                raise ValueError("User not found")
+            self.users[user_id].update(fields)
+            return dict(self.users[user_id])
+
+    # Media operations
+    def create_media(self, media_data: dict) -> dict:
+        self.latency.wait()
+        key = (media_data["userId"], media_data["id"])
+        with self._lock:
+            self.media[key] = dict(media_data)
+            self._media_seq[key] = self._next_seq()
+        return dict(media_data)
+
+    def get_media_by_id(self, media_id: str, user_id: str) -> Optional[dict]:
+        def read():
+            self.latency.wait()
+            item = self.media.get((user_id, media_id))
+            return dict(item) if item else None
+
+        return hedged("get_media_by_id", read)
+
+    def get_media_by_ids(self, user_id: str, media_ids: List[str]) -> List[dict]:
+        self.latency.wait()
+        with self._lock:
+            items = [self.media.get((user_id, media_id)) for media_id in media_ids]
+        return [dict(item) for item in items if item]
+
+    def _user_items(self, user_id: str) -> List[dict]:
+        with self._lock:
+            items = [item for (owner, _), item in self.media.items() if owner == user_id]
+        return sorted(items, key=lambda item: item["uploadedAt"], reverse=True)
+
+    @staticmethod
+    def _page(items: List[dict], page: int, page_size: int) -> tuple[List[dict], int]:
+        offset = (page - 1) * page_size
+        return [dict(item) for item in items[offset:offset + page_size]], len(items)
+
+    def get_user_media(
+        self,
+        user_id: str,
+        page: int = 1,
+        page_size: int = 20,
+        media_type: Optional[str] = None,
+        orientation: Optional[str] = None,
+        camera_model: Optional[str] = None,
+        min_width: Optional[int] = None,
+        min_height: Optional[int] = None,
+        captured_after: Optional[str] = None,
+        captured_before: Optional[str] = None,
+    ) -> tuple[List[dict], int]:
+        # The real client issues a count query and a page query
+        self.latency.wait()
+        self.latency.wait()
+        checks = [
+            ("mediaType", lambda v: media_type is None or v == media_type),
+            ("orientation", lambda v: orientation is None or v == orientation),
+            ("cameraModel", lambda v: camera_model is None or v == camera_model),
+            ("width", lambda v: min_width is None or (v or 0) >= min_width),
+            ("height", lambda v: min_height is None or (v or 0) >= min_height),
+            ("capturedAt", lambda v: captured_after is None or (v or "") >= captured_after),
+            ("capturedAt", lambda v: captured_before is None or (v or "") <= captured_before),
+        ]
+        items = [
+            item
+            for item in self._user_items(user_id)
+            if all(check(item.get(field)) for field, check in checks)
+        ]
+        return self._page(items, page, page_size)
+
+    def iter_user_media(
+        self,
+        user_id: str,
+        media_type: Optional[str] = None,
+        tag: Optional[str] = None,
+        page_size: int = 100,
+    ) -> Iterator[dict]:
+        items = [
+            item
+            for item in self._user_items(user_id)
+            if (media_type is None or item["mediaType"] == media_type)
+            and (tag is None or tag in (item.get("tags") or []))
+        ]
+        for start in range(0, len(items), page_size):
+            self.latency.wait()
+            for item in items[start:start + page_size]:
+                yield dict(item)
+
+    def update_media(self, media_id: str, user_id: str, updates: dict) -> dict:
+        existing = self.get_media_by_id(media_id, user_id)
+        if not existing:
+            raise ValueError("Media not found")
+        existing.update(updates)
+        self.latency.wait()
+        with self._lock:
+            self.media[(user_id, media_id)] = existing
+            self._media_seq[(user_id, media_id)] = self._next_seq()
+        return dict(existing)
+
+    def delete_media(self, media_id: str, user_id: str) -> bool:
+        self.latency.wait()
+        key = (user_id, media_id)
+        with self._lock:
+            if self.media.pop(key, None) is None:
+                return False
+            del self._media_seq[key]
+            self.tombstones[key] = {
+                "id": media_id,
+                "userId": user_id,
+                "deleted": True,
+                "deletedAt": datetime.utcnow().isoformat(),
+            }
+            self._tombstone_seq[key] = self._next_seq()
+        return True
+
+    def get_media_changes(
+        self, user_id: str, since: Optional[str], limit: int = 500
+    ) -> tuple[List[dict], List[dict], str, bool]:
+        """Watermarks are write sequence numbers; tombstones are never pruned"""
+        after = 0
+        if since is not None:
+            position = decode_watermark(since)
+            if len(position) != 1 or not isinstance(position[0], int):
+                raise ValueError("Invalid watermark")
+            after = position[0]
+        self.latency.wait()
+        with self._lock:
+            changes = sorted(
+                [
+                    (seq, False, dict(self.media[key]))
+                    for key, seq in self._media_seq.items()
+                    if key[0] == user_id and seq > after
+                ]
+                + [
+                    (seq, True, dict(self.tombstones[key]))
+                    for key, seq in self._tombstone_seq.items()
+                    if key[0] == user_id and seq > after
+                ],
+                key=lambda change: change[0],
+            )
+        more = len(changes) > limit
+        changes = changes[:limit]
+        if changes:
+            after = changes[-1][0]
+        return (
+            [document for _, deleted, document in changes if not deleted],
+            [document for _, deleted, document in changes if deleted],
+            encode_watermark([after]),
+            more,
+        )
+
+    def search_media(
+        self, user_id: str, query: str, page: int = 1, page_size: int = 20
+    ) -> tuple[List[dict], int]:
+        self.latency.wait()
+        self.latency.wait()
+        needle = query.lower()
+        items = [
+            item
+            for item in self._user_items(user_id)
+            if needle in item["originalFileName"].lower()
+            or needle in (item.get("description") or "").lower()
+            or any(needle == tag.lower() for tag in item.get("tags") or [])
+        ]
+        return self._page(items, page, page_size)
+
+    def get_tag_counts(self, user_id: str) -> Dict[str, int]:
+        self.latency.wait()
+        counts = Counter()
+        for item in self._user_items(user_id):
+            counts.update(set(item.get("tags") or []))
+        return dict(counts)
+
+    def get_perceptual_hashes(self, user_id: str) -> List[tuple[str, str]]:
+        self.latency.wait()
+        return [
+            (item["id"], item["perceptualHash"])
+            for item in self._user_items(user_id)
+            if isinstance(item.get("perceptualHash"), str)
+        ]
+
+    def get_media_stats(self, user_id: str) -> Dict[str, dict]:
+        self.latency.wait()
+        stats = {}
+        for item in self._user_items(user_id):
+            totals = stats.setdefault(item["mediaType"], {"count": 0, "bytes": 0})
+            totals["count"] += 1
+            totals["bytes"] += item.get("fileSize") or 0
+        return stats
+
+    def find_media_by_blob(self, user_id: str, blob_name: str) -> Optional[dict]:
+        self.latency.wait()
+        for item in self._user_items(user_id):
+            if blob_name in (item.get("fileName"), item.get("thumbnailFileName")):
+                return dict(item)
+        return None
+
+    def iter_blob_references(self, user_id: str, page_size: int = 1000) -> Iterator[str]:
+        self.latency.wait()
+        names = set()
+        for item in self._user_items(user_id):
+            names.update(
+                item[field]
+                for field in database.CosmosDBClient.BLOB_REFERENCE_FIELDS
+                if isinstance(item.get(field), str)
+            )
+        return iter(sorted(names))
+
+    def get_unnamed_thumbnails(self, user_id: str) -> List[dict]:
+        self.latency.wait()
+        return [
+            {"id": item["id"], "userId": user_id, "thumbnailUrl": item["thumbnailUrl"]}
+            for item in self._user_items(user_id)
+            if isinstance(item.get("thumbnailUrl"), str) and "thumbnailFileName" not in item
+        ]
+
+    def get_videos_without_metadata(self, user_id: str) -> List[dict]:
+        self.latency.wait()
+        return [
+            {key: item.get(key) for key in ("id", "userId", "fileName", "fileSize")}
+            for item in self._user_items(user_id)
+            if item["mediaType"] == "video"
+            and "durationSeconds" not in item
+            and "videoMetadataChecked" not in item
+        ]
+
+    # Change feed
+    def change_feed_ranges(self, feed: str = "media") -> List[str]:
+        return [CHANGE_FEED_RANGE]
+
+    def read_changes(
+        self,
+        feed: str,
+        range_id: str,
+        continuation: Optional[str],
+        max_items: int = 100,
+        start_from_beginning: bool = True,
+    ) -> tuple[List[dict], Optional[str]]:
+        if feed not in ("media", "tombstones"):
+            raise ValueError(f"Unknown change feed: '{feed}'")
+        self.latency.wait()
+        with self._lock:
+            if continuation is not None:
+                after = int(continuation)
+            elif start_from_beginning:
+                after = 0
+            else:
+                after = self._seq
+            documents, sequences = (
+                (self.media, self._media_seq)
+                if feed == "media"
+                else (self.tombstones, self._tombstone_seq)
+            )
+            changes = sorted(
+                ({**documents[key], "_lsn": seq} for key, seq in sequences.items() if seq > after),
+                key=lambda change: change["_lsn"],
+            )[:max_items]
+        return changes, str(changes[-1]["_lsn"] if changes else after)
+
+    def read_lease(self, lease_id: str) -> Optional[dict]:
+        self.latency.wait()
+        with self._lock:
+            lease = self.leases.get(lease_id)
+        return dict(lease) if lease else None
+
+    def write_lease(self, lease: dict, etag: Optional[str]) -> Optional[dict]:
+        self.latency.wait()
+        with self._lock:
+            stored = self.leases.get(lease["id"])
+            if (stored["_etag"] if stored else None) != etag:
+                return None
+            version = int(etag or 0) + 1
+            self.leases[lease["id"]] = {**lease, "_etag": str(version)}
+            return dict(self.leases[lease["id"]])
+
+    # Views maintained by change feed projectors
+    def get_view(self, user_id: str, name: str) -> Optional[dict]:
+        self.latency.wait()
+        with self._lock:
+            view = self.views.get((user_id, name))
+            if not view:
+                return None
+            return {**view, "_etag": str(self._view_versions[(user_id, name)])}
+
+    def upsert_view(self, user_id: str, name: str, view: dict) -> dict:
+        self.latency.wait()
+        body = {**view, "id": name, "userId": user_id}
+        with self._lock:
+            self.views[(user_id, name)] = body
+            self._view_versions[(user_id, name)] = self._view_versions.get((user_id, name), 0) + 1
+        return dict(body)
+
+    def write_view(
+        self, user_id: str, name: str, view: dict, etag: Optional[str]
+    ) -> Optional[dict]:
+        self.latency.wait()
+        key = (user_id, name)
+        body = {**view, "id": name, "userId": user_id}
+        with self._lock:
+            version = self._view_versions.get(key)
+            if (str(version) if version else None) != etag:
+                return None
+            self.views[key] = body
+            self._view_versions[key] = (version or 0) + 1
+            return {**body, "_etag": str(self._view_versions[key])}
+
+
+class InMemoryBlobStorageClient(storage.StorageBackend):
+    def __init__(self, latency: Optional[LatencyModel] = None):
+        self.latency = latency or LatencyModel()
+        self.container_name = "benchmark"
+        self._lock = threading.Lock()
+        self.blobs = {}
+
+    def provision(self):
+        pass
+
+    def warm_up(self, connections: int = 4):
+        pass
+
+    def upload_file(
+        self, file: BinaryIO, user_id: str, original_filename: str, content_type: str
+    ) -> tuple[str, str]:
+        blob_name = self.generate_blob_name(user_id, original_filename)
+        data = file.read()
+        self.latency.wait()
+        with self._lock:
+            self.blobs[blob_name] = (data, content_type, datetime.now(timezone.utc))
+        return blob_name, self.get_blob_url(blob_name)
+
+    def delete_file(self, blob_name: str) -> bool:
+        self.latency.wait()
+        with self._lock:
+            return self.blobs.pop(blob_name, None) is not None
+
+    def get_blob_url(self, blob_name: str) -> str:
+        return f"https://benchmark.blob.core.windows.net/{self.container_name}/{blob_name}"
+
+    def read_file(self, blob_name: str, offset: int = 0, length: Optional[int] = None) -> bytes:
+        self.latency.wait()
+        with self._lock:
+            data = self.blobs[blob_name][0]
+        return data[offset:] if length is None else data[offset:offset + length]
+
+    def iter_file(self, blob_name: str) -> Iterator[bytes]:
+        self.latency.wait()
+        with self._lock:
+            data = self.blobs[blob_name][0]
+        for start in range(0, len(data), storage.STREAM_CHUNK_SIZE):
+            yield data[start:start + storage.STREAM_CHUNK_SIZE]
+
+    def list_files(self, user_id: str) -> Iterator[tuple[str, datetime]]:
+        self.latency.wait()
+        with self._lock:
+            files = sorted(
+                (name, modified)
+                for name, (_, _, modified) in self.blobs.items()
+                if name.startswith(f"{user_id}/")
+            )
+        return iter(files)
+
+
+def _check_interface(fake, real_class: type):
+    """Fail early, rather than mid-benchmark, if a fake lacks a method of the real client"""
+    missing = sorted(
+        name
+        for name in dir(real_class)
+        if not name.startswith("_")
+        and callable(getattr(real_class, name))
+        and not callable(getattr(fake, name, None))
+    )
+    if missing:
+        raise TypeError(f"{type(fake).__name__} lacks {', '.join(missing)}")
+
+
+def install_fakes(cosmos_latency: LatencyModel, blob_latency: LatencyModel):
+    """
+    Swap the global cosmos_db/blob_storage instances for in-memory fakes
+    Every loaded module that imported the originals by name is patched.
+
+    Returns:
+        tuple: (fake cosmos client, fake blob client)
+    """
+    import app  # noqa: F401  (load every module that holds a reference)
+
+    cosmos_fake = InMemoryCosmosDBClient(cosmos_latency)
+    _check_interface(cosmos_fake, database.CosmosDBClient)
+    replacements = {
+        id(database.cosmos_db): ("cosmos_db", cosmos_fake),
+        id(storage.blob_storage): ("blob_storage", InMemoryBlobStorageClient(blob_latency)),
+    }
+    for module in list(sys.modules.values()):
+        for original_id, (name, fake) in replacements.items():
+            if id(getattr(module, name, None)) == original_id:
+                setattr(module, name, fake)
+
+    return tuple(fake for _, fake in replacements.values())
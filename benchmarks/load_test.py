@@ -0,0 +1,279 @@
+"""
+In-process load test of the API against in-memory Azure stand-ins
+Requests are driven straight through the ASGI interface, so the numbers
+cover routing, validation, auth, thumbnailing and the data layer without
+any socket or HTTP parser overhead.
+
+    python -m benchmarks.load_test --duration 30 --concurrency 16 \\
+        --cosmos-latency-ms 5 --blob-latency-ms 15
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlencode
+
+import benchmarks  # noqa: F401  (sets default settings)
+from benchmarks.fakes import LatencyModel, install_fakes
+from benchmarks.results import latest_result, print_table, save_results, summarize, compare
+
+# Relative weights of each operation in the request mix
+DEFAULT_MIX = {
+    "list": 40,
+    "get": 15,
+    "search": 15,
+    "upload": 15,
+    "delete": 5,
+    "login": 10,
+}
+
+SEARCH_TERMS = ["holiday", "beach", "IMG", "family", "sunset", "nothing-matches"]
+TAGS = ["holiday", "beach", "family", "sunset", "city", "food"]
+
+
+class ASGIClient:
+    """Minimal in-process HTTP client for an ASGI app"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, headers=None, body: bytes = b"",
+                      query: dict = None) -> tuple[int, bytes]:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": urlencode(query or {}).encode(),
+            "root_path": "",
+            "headers": [(b"host", b"benchmark")]
+            + [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+            + [(b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 50000),
+            "server": ("benchmark", 80),
+        }
+        request_sent = False
+        response = {"status": 0, "body": []}
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return response["status"], b"".join(response["body"])
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    """A noisy JPEG so thumbnailing does realistic work"""
+    from PIL import Image
+
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def multipart_body(file_name: str, content: bytes, fields: dict) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+            f"{value}\r\n".encode()
+        )
+    parts.append(
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+        f"filename=\"{file_name}\"\r\nContent-Type: image/jpeg\r\n\r\n".encode()
+        + content + b"\r\n"
+    )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Workload:
+    def __init__(self, client: ASGIClient, images: list, mix: dict):
+        self.client = client
+        self.images = images
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.users = []  # (email, password, token, [media ids])
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def setup(self, users: int, media_per_user: int):
+        for index in range(users):
+            email = f"bench{index}-{uuid.uuid4().hex[:6]}@example.com"
+            password = "benchmark-password"
+            status, body = await self.client.request(
+                "POST", "/api/auth/register",
+                headers={"content-type": "application/json"},
+                body=json.dumps(
+                    {"username": f"bench{index}", "email": email, "password": password}
+                ).encode(),
+            )
+            if status != 200:
+                raise RuntimeError(f"Registration failed ({status}): {body[:200]!r}")
+            token = json.loads(body)["token"]
+            user = (email, password, token, [])
+            self.users.append(user)
+            for _ in range(media_per_user):
+                await self.upload(user)
+
+    async def upload(self, user):
+        body, content_type = multipart_body(
+            f"IMG_{random.randint(0, 9999):04d}.jpg",
+            random.choice(self.images),
+            {
+                "description": f"{random.choice(TAGS)} photo",
+                "tags": json.dumps(random.sample(TAGS, 2)),
+            },
+        )
+        status, response = await self.client.request(
+            "POST", "/api/media",
+            headers={"authorization": f"Bearer {user[2]}", "content-type": content_type},
+            body=body,
+        )
+        if status == 201:
+            user[3].append(json.loads(response)["id"])
+        return status
+
+    async def run_operation(self, name: str, user) -> int:
+        auth = {"authorization": f"Bearer {user[2]}"}
+        if name == "list":
+            status, _ = await self.client.request(
+                "GET", "/api/media", headers=auth,
+                query={"page": random.randint(1, 3), "pageSize": 20},
+            )
+        elif name == "get":
+            if not user[3]:
+                return await self.upload(user)
+            status, _ = await self.client.request(
+                "GET", f"/api/media/{random.choice(user[3])}", headers=auth
+            )
+        elif name == "search":
+            status, _ = await self.client.request(
+                "GET", "/api/media/search", headers=auth,
+                query={"query": random.choice(SEARCH_TERMS)},
+            )
+        elif name == "upload":
+            status = await self.upload(user)
+        elif name == "delete":
+            if not user[3]:
+                return await self.upload(user)
+            media_id = user[3].pop(random.randrange(len(user[3])))
+            status, _ = await self.client.request(
+                "DELETE", f"/api/media/{media_id}", headers=auth
+            )
+        elif name == "login":
+            status, _ = await self.client.request(
+                "POST", "/api/auth/login",
+                headers={"content-type": "application/json"},
+                body=json.dumps({"email": user[0], "password": user[1]}).encode(),
+            )
+        else:
+            raise ValueError(f"Unknown operation: {name}")
+        return status
+
+    async def worker(self, deadline: float):
+        while time.perf_counter() < deadline:
+            name = random.choices(self.operations, self.weights)[0]
+            user = random.choice(self.users)
+            started = time.perf_counter()
+            status = await self.run_operation(name, user)
+            self.latencies[name].append((time.perf_counter() - started) * 1000)
+            self.statuses[name][status] += 1
+
+    async def run(self, concurrency: int, duration: float) -> float:
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(self.worker(deadline) for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+
+async def main_async(args) -> int:
+    random.seed(args.seed)
+    install_fakes(
+        LatencyModel(args.cosmos_latency_ms, args.cosmos_jitter_ms),
+        LatencyModel(args.blob_latency_ms, args.blob_jitter_ms),
+    )
+    from app import app
+
+    # Per-request INFO logs would dominate the profile
+    logging.getLogger().setLevel(logging.WARNING)
+
+    mix = dict(DEFAULT_MIX)
+    for entry in args.mix or []:
+        name, weight = entry.split("=")
+        mix[name] = int(weight)
+
+    images = [make_jpeg(*map(int, size.split("x"))) for size in args.image_sizes]
+    workload = Workload(ASGIClient(app), images, mix)
+
+    async with app.router.lifespan_context(app):
+        await workload.setup(args.users, args.media_per_user)
+        elapsed = await workload.run(args.concurrency, args.duration)
+
+    all_latencies = [value for values in workload.latencies.values() for value in values]
+    results = {"all": summarize(all_latencies)}
+    results["all"]["throughput_rps"] = round(len(all_latencies) / elapsed, 2)
+    for name, values in sorted(workload.latencies.items()):
+        results[name] = summarize(values)
+        results[name]["throughput_rps"] = round(len(values) / elapsed, 2)
+        results[name]["statuses"] = dict(workload.statuses[name])
+
+    print(f"{len(all_latencies)} requests in {elapsed:.1f}s "
+          f"({results['all']['throughput_rps']:.1f} req/s)")
+    print_table(results)
+
+    config = {key: value for key, value in vars(args).items() if key != "compare"}
+    config["mix"] = mix
+    path = save_results("load", config, results)
+    print(f"Results written to {path}")
+
+    if args.compare:
+        baseline = latest_result("load", exclude=path) if args.compare == "latest" else args.compare
+        if baseline:
+            return 0 if compare(baseline, path) else 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process API load test")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--media-per-user", type=int, default=30)
+    parser.add_argument("--cosmos-latency-ms", type=float, default=5.0)
+    parser.add_argument("--cosmos-jitter-ms", type=float, default=2.0)
+    parser.add_argument("--blob-latency-ms", type=float, default=15.0)
+    parser.add_argument("--blob-jitter-ms", type=float, default=5.0)
+    parser.add_argument("--image-sizes", nargs="+", default=["1280x960", "640x480"],
+                        help="uploaded JPEG sizes, WIDTHxHEIGHT")
+    parser.add_argument("--mix", nargs="*", metavar="OP=WEIGHT",
+                        help=f"override request mix weights {DEFAULT_MIX}")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", metavar="RESULT|latest",
+                        help="compare against a previous result file")
+    return asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
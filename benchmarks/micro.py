@@ -0,0 +1,64 @@
+"""
+Micro-benchmarks for CPU-bound helpers on the request path
+
+    python -m benchmarks.micro [--iterations 50] [--compare latest]
+"""
+import argparse
+import sys
+import time
+from datetime import timedelta
+
+import benchmarks  # noqa: F401  (sets default settings)
+from benchmarks.load_test import make_jpeg
+from benchmarks.results import latest_result, print_table, save_results, summarize, compare
+
+
+def measure(func, iterations: int, warmup: int = 3) -> dict:
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - started) * 1000)
+    stats = summarize(latencies)
+    stats["ops_per_sec"] = round(1000 / stats["mean_ms"], 1) if stats["mean_ms"] else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--image-sizes", nargs="+", default=["1280x960", "4032x3024"])
+    parser.add_argument("--compare", metavar="RESULT|latest")
+    args = parser.parse_args()
+
+    from auth import create_access_token, decode_access_token
+    from utils import extract_image_metadata, generate_thumbnail
+
+    results = {}
+    for size in args.image_sizes:
+        image = make_jpeg(*map(int, size.split("x")))
+        results[f"thumbnail_{size}"] = measure(
+            lambda: generate_thumbnail(image), args.iterations
+        )
+        results[f"metadata_{size}"] = measure(
+            lambda: extract_image_metadata(image), args.iterations * 10
+        )
+
+    token = create_access_token({"sub": "benchmark-user"}, timedelta(hours=1))
+    results["jwt_decode"] = measure(lambda: decode_access_token(token), args.iterations * 100)
+
+    print_table(results)
+    path = save_results("micro", vars(args), results)
+    print(f"Results written to {path}")
+
+    if args.compare:
+        baseline = latest_result("micro", exclude=path) if args.compare == "latest" else args.compare
+        if baseline:
+            return 0 if compare(baseline, path) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Latency statistics and result files shared by the benchmarks
+Results are written to benchmarks/results/<suite>-<timestamp>-<commit>.json
+"""
+import json
+import platform
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies_ms: List[float]) -> dict:
+    """Count, mean and p50/p95/p99 of a list of latencies in milliseconds"""
+    values = sorted(latencies_ms)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "p99_ms": round(percentile(values, 0.99), 3),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(suite: str, config: dict, results: dict) -> Path:
+    """Write a result file tagged with the current commit"""
+    commit = _git_commit()
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"{suite}-{timestamp}-{commit or 'nogit'}.json"
+    document = {
+        "suite": suite,
+        "commit": commit,
+        "timestamp": timestamp,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    path.write_text(json.dumps(document, indent=2))
+    return path
+
+
+def latest_result(suite: str, exclude: Optional[Path] = None) -> Optional[Path]:
+    """Most recent result file for a suite, if any"""
+    candidates = sorted(
+        path for path in RESULTS_DIR.glob(f"{suite}-*.json") if path != exclude
+    )
+    return candidates[-1] if candidates else None
+
+
+def print_table(results: dict):
+    print(f"{'operation':<20}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, stats in results.items():
+        if not isinstance(stats, dict) or "p50_ms" not in stats:
+            continue
+        print(
+            f"{name:<20}{stats['count']:>8}{stats['mean_ms']:>10.2f}"
+            f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+        )
+
+
+def compare(baseline_path: Path, current_path: Path, threshold: float = 0.10) -> bool:
+    """
+    Print per-operation p50/p99 changes between two result files
+
+    Returns:
+        bool: True if no operation regressed by more than the threshold
+    """
+    baseline = json.loads(Path(baseline_path).read_text())
+    current = json.loads(Path(current_path).read_text())
+    print(f"baseline {baseline['commit']} ({baseline['timestamp']}) -> "
+          f"current {current['commit']} ({current['timestamp']})")
+
+    ok = True
+    for name, stats in current["results"].items():
+        old = baseline["results"].get(name)
+        if not isinstance(stats, dict) or not isinstance(old, dict):
+            continue
+        for key in ("p50_ms", "p99_ms", "throughput_rps"):
+            if key not in stats or not old.get(key):
+                continue
+            change = (stats[key] - old[key]) / old[key]
+            # Throughput regresses when it drops, latency when it grows
+            regressed = -change > threshold if key == "throughput_rps" else change > threshold
+            ok = ok and not regressed
+            marker = "  REGRESSION" if regressed else ""
+            print(f"{name:<20}{key:<16}{old[key]:>10.2f} -> {stats[key]:>10.2f} "
+                  f"({change:+.1%}){marker}")
+    return ok
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Change feed processor for the media and tombstones containers
+Derived data is maintained off the write path: each projector (see
+projectors.py) reads media changes from the change feed and updates its
+views. Every projector has its own leases, one per feed and partition key
+range, so it can run in as many processes as its views need and the ranges
+are spread across them. A lease is taken and renewed with compare-and-swap writes and
+holds the range's continuation, which is checkpointed only after the
+projector has handled the batch: delivery is at least once, so projectors
+must be idempotent.
+
+The media feed carries the latest version of each created or updated
+document. Deletes do not appear in it; projectors that need them also read
+the tombstones feed, whose documents have "deleted": true.
+
+Usage:
+    python change_feed.py [projector ...]    # default: all projectors
+"""
+import argparse
+import logging
+import math
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from azure.cosmos import exceptions
+
+from config import settings
+from database import cosmos_db
+
+logger = logging.getLogger(__name__)
+
+
+class Projector:
+    """Maintains a derived view from batches of changed media documents"""
+
+    name = ""
+    feeds = ("media",)
+
+    def project(self, changes: List[dict]):
+        """
+        Apply a batch of changes, in modification order
+        Raising leaves the batch unacknowledged; it is delivered again.
+        """
+        raise NotImplementedError
+
+
+class ChangeFeedProcessor:
+    """Runs one projector over the ranges of one feed this process leases"""
+
+    def __init__(self, projector: Projector, feed: str = "media", owner: Optional[str] = None):
+        self.projector = projector
+        self.feed = feed
+        self.label = projector.name if feed == "media" else f"{projector.name}/{feed}"
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.leases: Dict[str, dict] = {}
+        self._next_balance = 0.0
+
+    def _lease_id(self, range_id: str) -> str:
+        # Media feed leases keep the ids they had before there were other feeds
+        if self.feed == "media":
+            return f"{self.projector.name}.{range_id}"
+        return f"{self.projector.name}.{self.feed}.{range_id}"
+
+    def _write(self, lease: dict, **fields) -> Optional[dict]:
+        return cosmos_db.write_lease({**lease, **fields}, lease.get("_etag"))
+
+    def _expires_at(self) -> float:
+        return time.time() + settings.change_feed_lease_seconds
+
+    def balance(self):
+        """
+        Renew the leases held, then take or give up leases so that each live
+        owner holds an even share of the ranges
+        """
+        now = time.time()
+        ranges = cosmos_db.change_feed_ranges(self.feed)
+        leases = {}
+        for range_id in ranges:
+            lease = cosmos_db.read_lease(self._lease_id(range_id))
+            if lease is None:
+                lease = cosmos_db.write_lease(
+                    {
+                        "id": self._lease_id(range_id),
+                        "processor": self.projector.name,
+                        "feed": self.feed,
+                        "rangeId": range_id,
+                        "owner": None,
+                        "continuation": None,
+                        "expiresAt": 0,
+                    },
+                    None,
+                )
+            if lease is not None:
+                leases[range_id] = lease
+
+        # Leases lost to another owner, or to a partition split, are dropped
+        self.leases = {
+            range_id: leases[range_id]
+            for range_id in self.leases
+            if range_id in leases and leases[range_id]["owner"] == self.owner
+        }
+        for range_id, lease in list(self.leases.items()):
+            renewed = self._write(lease, expiresAt=self._expires_at())
+            if renewed is None:
+                del self.leases[range_id]
+            else:
+                self.leases[range_id] = renewed
+
+        held: Dict[str, List[str]] = {self.owner: []}
+        free = []
+        for range_id, lease in leases.items():
+            if lease["owner"] and lease["expiresAt"] > now:
+                held.setdefault(lease["owner"], []).append(range_id)
+            elif range_id not in self.leases:
+                free.append(range_id)
+        held[self.owner] = list(self.leases)
+        target = math.ceil(len(leases) / len(held))
+
+        if len(self.leases) > target:
+            range_id = next(iter(self.leases))
+            if self._write(self.leases.pop(range_id), owner=None, expiresAt=0):
+                logger.info(f"{self.label}: released range {range_id}")
+            return
+        if not free and len(self.leases) < target:
+            # Take one range from the busiest owner if it is over its share
+            busiest = max(held, key=lambda owner: len(held[owner]))
+            if len(held[busiest]) > target:
+                free = held[busiest][:1]
+        for range_id in free[: target - len(self.leases)]:
+            acquired = self._write(
+                leases[range_id], owner=self.owner, expiresAt=self._expires_at()
+            )
+            if acquired is not None:
+                self.leases[range_id] = acquired
+                logger.info(f"{self.label}: acquired range {range_id}")
+
+    def process(self, range_id: str) -> int:
+        """Project the next batch of one leased range; the number of changes"""
+        lease = self.leases[range_id]
+        try:
+            changes, continuation = cosmos_db.read_changes(
+                self.feed,
+                range_id,
+                lease["continuation"],
+                max_items=settings.change_feed_batch_size,
+                start_from_beginning=settings.change_feed_start_from_beginning,
+            )
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code != 410:
+                raise
+            # The range was split; its children get leases of their own
+            logger.info(f"{self.label}: range {range_id} is gone, rebalancing")
+            del self.leases[range_id]
+            self._next_balance = 0.0
+            return 0
+
+        if changes:
+            self.projector.project(changes)
+        if continuation != lease["continuation"]:
+            checkpointed = self._write(
+                lease, continuation=continuation, expiresAt=self._expires_at()
+            )
+            if checkpointed is None:
+                # Another owner took the range; it resumes from its checkpoint
+                logger.info(f"{self.label}: lost range {range_id}")
+                del self.leases[range_id]
+                return len(changes)
+            self.leases[range_id] = checkpointed
+        return len(changes)
+
+    def run(self, stop: threading.Event):
+        """Poll the leased ranges until stop is set, then release them"""
+        logger.info(f"{self.label}: started as {self.owner}")
+        while not stop.is_set():
+            busy = False
+            try:
+                if time.monotonic() >= self._next_balance:
+                    self.balance()
+                    self._next_balance = (
+                        time.monotonic() + settings.change_feed_lease_seconds / 3
+                    )
+                for range_id in list(self.leases):
+                    if stop.is_set():
+                        break
+                    busy = self.process(range_id) > 0 or busy
+            except Exception as e:
+                logger.error(f"{self.label}: {e}", exc_info=True)
+                busy = False
+            if not busy:
+                stop.wait(settings.change_feed_poll_seconds)
+
+        for range_id, lease in self.leases.items():
+            try:
+                self._write(lease, owner=None, expiresAt=0)
+            except Exception as e:
+                logger.warning(f"{self.label}: failed to release range {range_id}: {e}")
+        self.leases = {}
+        logger.info(f"{self.label}: stopped")
+
+
+def main():
+    from projectors import PROJECTORS
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    parser = argparse.ArgumentParser(description="Maintain views from the media change feed")
+    parser.add_argument(
+        "projectors",
+        nargs="*",
+        help=f"projectors to run (default: all of {', '.join(sorted(PROJECTORS))})",
+    )
+    args = parser.parse_args()
+    unknown = set(args.projectors) - set(PROJECTORS)
+    if unknown:
+        parser.error(f"unknown projectors: {', '.join(sorted(unknown))}")
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    threads = []
+    for name in args.projectors or sorted(PROJECTORS):
+        projector = PROJECTORS[name]()
+        for feed in projector.feeds:
+            processor = ChangeFeedProcessor(projector, feed)
+            threads.append(
+                threading.Thread(target=processor.run, args=(stop,), name=processor.label)
+            )
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=0.5)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,15 +3,80 @@ from typing import List
 
 
 class Settings(BaseSettings):
+    # Metadata backend: "cosmos" or "sqlite"
+    metadata_backend: str = "cosmos"
+
     # Azure Cosmos DB Configuration
-    cosmos_endpoint: str
-    cosmos_key: str
+    cosmos_endpoint: str = ""
+    cosmos_key: str = ""
     cosmos_database_name: str = "CloudMediaDB"
 
+    # Client-side RU budget per container for this node; server.py splits it
+    # evenly between its worker processes, so with several nodes give each
+    # its share of the provisioned throughput.
+    # 0 disables the limiter: 429s are then retried by the SDK, and those it
+    # gives up on are returned to clients as 503s
+    cosmos_ru_per_second: float = 400
+    # Share of the budget that writes and bulk calls (scripts) may not spend
+    cosmos_bulk_reserve: float = 0.2
+    cosmos_throttle_max_retries: int = 5
+    # Calls made for a client request give up waiting for budget after this long
+    cosmos_throttle_max_wait_ms: int = 5000
+
+    # Concurrent identical reads (media lists, searches, single items) share
+    # one Cosmos DB request
+    singleflight_enabled: bool = True
+
+    # Hedged requests: resend a point read or small blob read that has not
+    # answered within this percentile of recent latencies
+    hedging_enabled: bool = False
+    hedging_percentile: float = 95
+    hedging_min_delay_ms: float = 5
+    # Extra requests allowed, as a percentage of hedged calls
+    hedging_budget_percent: float = 5
+    hedging_max_blob_bytes: int = 1024 * 1024
+
+    # Data-layer calls at or above either threshold go to the slow-query log
+    slow_query_ru_threshold: float = 50.0
+    slow_query_ms_threshold: float = 500.0
+
+    # Request tracing (see tracing.py): exporter "console", "file" or
+    # "package.module:Class"
+    tracing_enabled: bool = False
+    tracing_sample_rate: float = 1.0
+    tracing_exporter: str = "console"
+    tracing_file_path: str = "traces.jsonl"
+
+    # On-demand request profiling (see profiling.py): requests with an
+    # X-Profile header from these users (comma separated), who may also read
+    # the profiles, and a random fraction of all requests
+    profiling_enabled: bool = False
+    profiling_user_ids: str = ""
+    profiling_sample_rate: float = 0.0
+    profiling_interval_ms: float = 5
+    profiling_max_seconds: float = 60
+    # Finished profiles kept, as files in this directory shared by the node's
+    # workers (server.py uses a temporary one if unset), else per process
+    profiling_buffer_size: int = 50
+    profiling_dir: str = ""
+
+    # SQLite Configuration
+    sqlite_path: str = "media.db"
+    sqlite_pool_size: int = 8
+
+    # Storage Configuration
+    storage_backend: str = "azure"  # "azure" or "local"
+
     # Azure Blob Storage Configuration
-    azure_storage_connection_string: str
+    azure_storage_connection_string: str = ""
     blob_container_name: str = "media-files"
 
+    # Local Filesystem Storage Configuration
+    local_storage_path: str = "media-files"
+    local_storage_url_expiry_hours: int = 24 * 365
+    # Internal location prefix for nginx X-Accel-Redirect; empty serves in-process
+    local_storage_accel_redirect: str = ""
+
     # JWT Configuration
     jwt_secret_key: str
     jwt_algorithm: str = "HS256"
@@ -22,6 +87,73 @@ class Settings(BaseSettings):
     api_port: int = 8000
     allowed_origins: str = "http://localhost:4200"
 
+    # Production Server Configuration (python server.py)
+    server_workers: int = 0  # 0 = one per CPU
+    server_loop: str = "auto"  # "uvloop" when installed, else "asyncio"
+    server_http: str = "auto"  # "httptools" when installed, else "h11"
+    # Import the app once in the master so workers share its pages
+    server_preload_app: bool = True
+    server_keepalive_seconds: int = 5
+    server_backlog: int = 2048
+    # Recycle each worker after this many requests (plus up to the jitter);
+    # 0 never recycles
+    server_max_requests: int = 0
+    server_max_requests_jitter: int = 0
+    # SIGTERM drains in-flight requests for up to this long
+    server_graceful_timeout_seconds: int = 30
+    server_worker_timeout_seconds: int = 60
+    # Directory where workers save metrics snapshots, so /api/metrics on any
+    # of them reports the whole node; server.py uses a temporary one if unset
+    metrics_multiprocess_dir: str = ""
+
+    # Startup Configuration
+    # Resources are created by `python provision.py`; set this to create them
+    # on boot instead (needs management permissions on both accounts)
+    provision_on_startup: bool = False
+    warmup_connections: int = 4
+
+    # In-memory per-user indexes (tags, perceptual hashes): rebuilt from the
+    # database after this long, so writes handled by other worker processes
+    # show up
+    user_index_ttl_seconds: int = 300
+    user_index_max_users: int = 10000
+    # Hamming distance (of 64 bits) up to which images count as similar, and
+    # as duplicates in the duplicate report
+    similar_max_distance: int = 10
+    duplicate_max_distance: int = 4
+
+    # Per-user rate limits (token buckets: steady rate, burst size) for
+    # uploads and other writes, reads and searches. The "memory" store
+    # limits each worker process separately; "sqlite" shares the buckets
+    # between the worker processes of a node through rate_limit_sqlite_path
+    rate_limit_enabled: bool = True
+    rate_limit_store: str = "memory"
+    rate_limit_sqlite_path: str = "rate_limits.db"
+    rate_limit_uploads_per_minute: float = 60
+    rate_limit_upload_burst: int = 20
+    rate_limit_reads_per_second: float = 20
+    rate_limit_read_burst: int = 100
+    rate_limit_searches_per_second: float = 5
+    rate_limit_search_burst: int = 20
+
+    # Library export: blobs downloaded ahead of the one being sent
+    export_prefetch_blobs: int = 4
+
+    # Change feed processor (python change_feed.py): a leased range is
+    # polled again after this long when it had no changes, and a lease not
+    # renewed within change_feed_lease_seconds is taken over by another process
+    change_feed_poll_seconds: float = 1.0
+    change_feed_batch_size: int = 100
+    change_feed_lease_seconds: int = 30
+    # A new processor reads the whole feed instead of only later changes
+    change_feed_start_from_beginning: bool = True
+    recent_items_view_size: int = 50
+
+    # Delta sync (GET /media/changes): deletes are remembered this long, and
+    # changes younger than the settle time (Cosmos DB) wait for the next call
+    tombstone_ttl_days: int = 30
+    changes_settle_seconds: int = 5
+
     # File Upload Configuration
     max_file_size_mb: int = 100
     allowed_image_types: str = "image/jpeg,image/png,image/gif,image/webp"
@@ -35,6 +167,12 @@ class Settings(BaseSettings):
     def allowed_origins_list(self) -> List[str]:
         return [origin.strip() for origin in self.allowed_origins.split(",")]
 
+    @property
+    def profiling_user_ids_list(self) -> List[str]:
+        return [
+            user_id.strip() for user_id in self.profiling_user_ids.split(",") if user_id.strip()
+        ]
+
     @property
     def allowed_image_types_list(self) -> List[str]:
         return [t.strip() for t in self.allowed_image_types.split(",")]
@@ -0,0 +1,4 @@
+import os
+
+# Settings requires this; the unit tests never sign tokens
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
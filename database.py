@@ -1,53 +1,217 @@
+from azure.core import MatchConditions
+from azure.core.paging import ItemPaged
 from azure.cosmos import CosmosClient, exceptions, PartitionKey
+from azure.cosmos._retry_options import RetryOptions
 from azure.cosmos.container import ContainerProxy
-from typing import Optional, List, Dict, Any
+from azure.cosmos.database import DatabaseProxy
+from azure.cosmos.documents import ConnectionPolicy
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import cached_property
+from itertools import islice
+from typing import Optional, List, Dict, Any, Iterator
 from config import settings
+from delta_sync import WatermarkExpiredError, decode_watermark, encode_watermark
+from hedging import hedged
+from ru_limiter import BULK, WRITE, execute
+from singleflight import coalesced, single_flight
+from indexing_policy import (
+    MEDIA_COMPOSITE_INDEX_FILTERS,
+    MEDIA_INDEXING_POLICY,
+    TOMBSTONES_INDEXING_POLICY,
+    USERS_INDEXING_POLICY,
+    apply_indexing_policy,
+)
+import heapq
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 
 class CosmosDBClient:
     def __init__(self):
-        self.client = CosmosClient(settings.cosmos_endpoint, settings.cosmos_key)
-        self.database = None
-        self.users_container = None
-        self.media_container = None
-
-    def initialize(self):
-        """Initialize database and containers"""
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> CosmosClient:
+        """SDK client, created on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    # With the limiter on, 429s are retried by ru_limiter, which
+                    # also slows the whole process down, so the SDK must not
+                    # retry them itself; with it off the SDK's retries are kept
+                    connection_policy = ConnectionPolicy()
+                    if settings.cosmos_ru_per_second > 0:
+                        connection_policy.RetryOptions = RetryOptions(max_retry_attempt_count=0)
+                    self._client = CosmosClient(
+                        settings.cosmos_endpoint,
+                        settings.cosmos_key,
+                        connection_policy=connection_policy,
+                    )
+        return self._client
+
+    def reset_after_fork(self):
+        """Forget the client inherited from a parent process"""
+        self._client = None
+        self._client_lock = threading.Lock()
+        for name in (
+            "database",
+            "users_container",
+            "media_container",
+            "tombstones_container",
+            "leases_container",
+            "views_container",
+        ):
+            self.__dict__.pop(name, None)
+
+    # Container proxies are built locally and assume the resources exist;
+    # provision() is responsible for creating them.
+    @cached_property
+    def database(self) -> DatabaseProxy:
+        return self.client.get_database_client(settings.cosmos_database_name)
+
+    @cached_property
+    def users_container(self) -> ContainerProxy:
+        return self.database.get_container_client("users")
+
+    @cached_property
+    def media_container(self) -> ContainerProxy:
+        return self.database.get_container_client("media")
+
+    @cached_property
+    def tombstones_container(self) -> ContainerProxy:
+        return self.database.get_container_client("tombstones")
+
+    @cached_property
+    def leases_container(self) -> ContainerProxy:
+        return self.database.get_container_client("leases")
+
+    @cached_property
+    def views_container(self) -> ContainerProxy:
+        return self.database.get_container_client("views")
+
+    def provision(self, migrate_indexing_policy: bool = True):
+        """Create the database and containers and migrate indexing policies"""
         try:
             # Create database if it doesn't exist
-            self.database = self.client.create_database_if_not_exists(
+            database = self.client.create_database_if_not_exists(
                 id=settings.cosmos_database_name
             )
             logger.info(f"Database '{settings.cosmos_database_name}' is ready")
 
             # Create users container if it doesn't exist
-            self.users_container = self.database.create_container_if_not_exists(
+            database.create_container_if_not_exists(
                 id="users",
                 partition_key=PartitionKey(path="/id"),
+                indexing_policy=USERS_INDEXING_POLICY,
                 offer_throughput=400,
             )
+            if migrate_indexing_policy:
+                apply_indexing_policy(database, "users")
             logger.info("Users container is ready")
 
             # Create media container if it doesn't exist
-            self.media_container = self.database.create_container_if_not_exists(
+            database.create_container_if_not_exists(
                 id="media",
                 partition_key=PartitionKey(path="/userId"),
+                indexing_policy=MEDIA_INDEXING_POLICY,
                 offer_throughput=400,
             )
+            if migrate_indexing_policy:
+                apply_indexing_policy(database, "media")
             logger.info("Media container is ready")
 
+            # Deleted media ids for delta sync, expired by the container TTL
+            database.create_container_if_not_exists(
+                id="tombstones",
+                partition_key=PartitionKey(path="/userId"),
+                indexing_policy=TOMBSTONES_INDEXING_POLICY,
+                default_ttl=settings.tombstone_ttl_days * 86400,
+                offer_throughput=400,
+            )
+            if migrate_indexing_policy:
+                apply_indexing_policy(database, "tombstones")
+            logger.info("Tombstones container is ready")
+
+            # Change feed leases and the views its projectors maintain
+            database.create_container_if_not_exists(
+                id="leases",
+                partition_key=PartitionKey(path="/id"),
+                offer_throughput=400,
+            )
+            database.create_container_if_not_exists(
+                id="views",
+                partition_key=PartitionKey(path="/userId"),
+                offer_throughput=400,
+            )
+            logger.info("Leases and views containers are ready")
+
         except exceptions.CosmosHttpResponseError as e:
-            logger.error(f"Failed to initialize Cosmos DB: {e}")
+            logger.error(f"Failed to provision Cosmos DB: {e}")
             raise
 
+    def warm_up(self, connections: int = 4):
+        """
+        Open connections and load routing metadata with cheap point reads
+        Reads of a missing item cost 1 RU and need only data-plane permissions.
+        """
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            reads = [
+                executor.submit(self.get_user_by_id, "__warmup__")
+                for _ in range(connections)
+            ]
+            reads.append(
+                executor.submit(self.get_media_by_id, "__warmup__", "__warmup__")
+            )
+            for read in reads:
+                read.result()
+
+    @staticmethod
+    def _query(
+        container: ContainerProxy, operation: str, query: str, parameters: list, **kwargs
+    ) -> list:
+        """Run a query to completion within the container's RU budget"""
+
+        def request(call):
+            items = list(
+                container.query_items(
+                    query=query, parameters=parameters, response_hook=call.hook, **kwargs
+                )
+            )
+            call.items = len(items)
+            return items
+
+        return execute(container.id, operation, request, query)
+
+    @staticmethod
+    def _point_read(container: ContainerProxy, operation: str, item: str, partition_key: str):
+        """Read one item within the RU budget, hedged when enabled"""
+
+        def request(call):
+            result = container.read_item(
+                item=item, partition_key=partition_key, response_hook=call.hook
+            )
+            call.items = 1
+            return result
+
+        return hedged(operation, lambda: execute(container.id, operation, request))
+
     # User operations
     def create_user(self, user_data: dict) -> dict:
         """Create a new user"""
         try:
-            return self.users_container.create_item(body=user_data)
+            return execute(
+                "users",
+                "create_user",
+                lambda call: self.users_container.create_item(
+                    body=user_data, response_hook=call.hook
+                ),
+                priority=WRITE,
+            )
         except exceptions.CosmosResourceExistsError:
             raise ValueError("User already exists")
         except exceptions.CosmosHttpResponseError as e:
@@ -59,10 +223,12 @@ class CosmosDBClient:
         try:
             query = "SELECT * FROM users u WHERE u.email = @email"
             parameters = [{"name": "@email", "value": email}]
-            items = list(
-                self.users_container.query_items(
-                    query=query, parameters=parameters, enable_cross_partition_query=True
-                )
+            items = self._query(
+                self.users_container,
+                "get_user_by_email",
+                query,
+                parameters,
+                enable_cross_partition_query=True,
             )
             return items[0] if items else None
         except exceptions.CosmosHttpResponseError as e:
@@ -72,67 +238,198 @@ class CosmosDBClient:
     def get_user_by_id(self, user_id: str) -> Optional[dict]:
         """Get user by ID"""
         try:
-            return self.users_container.read_item(item=user_id, partition_key=user_id)
+            return self._point_read(
+                self.users_container, "get_user_by_id", user_id, user_id
+            )
         except exceptions.CosmosResourceNotFoundError:
             return None
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Failed to get user by ID: {e}")
             raise
 
+    def iter_users(
+        self,
+        page_size: int = 500,
+        after_id: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Iterator[List[dict]]:
+        """
+        Stream all users in pages ordered by id
+        Each page is one keyset query (id > the last id seen), so a scan can be
+        resumed from the id of the last user of any page. fields limits the
+        properties returned; id is always included.
+        """
+        projection = "*"
+        if fields:
+            projection = ", ".join(f"u.{field}" for field in dict.fromkeys(["id", *fields]))
+        while True:
+            query = f"SELECT TOP @pageSize {projection} FROM users u"
+            parameters = [{"name": "@pageSize", "value": page_size}]
+            if after_id is not None:
+                query += " WHERE u.id > @afterId"
+                parameters.append({"name": "@afterId", "value": after_id})
+            query += " ORDER BY u.id"
+            page = self._query(
+                self.users_container,
+                "iter_users",
+                query,
+                parameters,
+                enable_cross_partition_query=True,
+            )
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after_id = page[-1]["id"]
+
+    def patch_user(self, user_id: str, fields: dict) -> dict:
+        """Set fields on a user without rewriting the whole document"""
+        try:
+            return execute(
+                "users",
+                "patch_user",
+                lambda call: self.users_container.patch_item(
+                    item=user_id,
+                    partition_key=user_id,
+                    patch_operations=[
+                        {"op": "set", "path": f"/{field}", "value": value}
+                        for field, value in fields.items()
+                    ],
+                    response_hook=call.hook,
+                ),
+                priority=WRITE,
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            raise ValueError("User not found")
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to patch user: {e}")
+            raise
+
     # Media operations
     def create_media(self, media_data: dict) -> dict:
         """Create a new media item"""
         try:
-            return self.media_container.create_item(body=media_data)
+            return execute(
+                "media",
+                "create_media",
+                lambda call: self.media_container.create_item(
+                    body=media_data, response_hook=call.hook
+                ),
+                priority=WRITE,
+            )
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Failed to create media: {e}")
             raise
+        finally:
+            # Reads started before the write must not be joined after it
+            single_flight.forget(media_data["userId"])
 
+    @coalesced("get_media_by_id")
     def get_media_by_id(self, media_id: str, user_id: str) -> Optional[dict]:
         """Get media by ID"""
         try:
-            return self.media_container.read_item(item=media_id, partition_key=user_id)
+            return self._point_read(
+                self.media_container, "get_media_by_id", media_id, user_id
+            )
         except exceptions.CosmosResourceNotFoundError:
             return None
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Failed to get media by ID: {e}")
             raise
 
+    def get_media_by_ids(self, user_id: str, media_ids: List[str]) -> List[dict]:
+        """Get several of a user's media items in one query (missing ids are skipped)"""
+        if not media_ids:
+            return []
+        try:
+            return self._query(
+                self.media_container,
+                "get_media_by_ids",
+                "SELECT * FROM media m WHERE m.userId = @userId AND ARRAY_CONTAINS(@ids, m.id)",
+                [
+                    {"name": "@userId", "value": user_id},
+                    {"name": "@ids", "value": list(media_ids)},
+                ],
+            )
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to get media by IDs: {e}")
+            raise
+
+    @coalesced("get_user_media")
     def get_user_media(
         self,
         user_id: str,
         page: int = 1,
         page_size: int = 20,
         media_type: Optional[str] = None,
+        orientation: Optional[str] = None,
+        camera_model: Optional[str] = None,
+        min_width: Optional[int] = None,
+        min_height: Optional[int] = None,
+        captured_after: Optional[str] = None,
+        captured_before: Optional[str] = None,
     ) -> tuple[List[dict], int]:
         """Get paginated list of user's media"""
         try:
-            # Build query
-            query = "SELECT * FROM media m WHERE m.userId = @userId"
+            # Build filter
+            where = "WHERE m.userId = @userId"
             parameters = [{"name": "@userId", "value": user_id}]
 
-            if media_type:
-                query += " AND m.mediaType = @mediaType"
-                parameters.append({"name": "@mediaType", "value": media_type})
-
-            query += " ORDER BY m.uploadedAt DESC"
+            equality_filters = {
+                "mediaType": media_type,
+                "orientation": orientation,
+                "cameraModel": camera_model,
+            }
+            for field, value in equality_filters.items():
+                if value is not None:
+                    where += f" AND m.{field} = @{field}"
+                    parameters.append({"name": f"@{field}", "value": value})
+
+            range_filters = [
+                ("width", ">=", "@minWidth", min_width),
+                ("height", ">=", "@minHeight", min_height),
+                ("capturedAt", ">=", "@capturedAfter", captured_after),
+                ("capturedAt", "<=", "@capturedBefore", captured_before),
+            ]
+            for field, operator, name, value in range_filters:
+                if value is not None:
+                    where += f" AND m.{field} {operator} {name}"
+                    parameters.append({"name": name, "value": value})
 
             # Get total count
-            count_query = query.replace("SELECT *", "SELECT VALUE COUNT(1)")
-            count_result = list(
-                self.media_container.query_items(
-                    query=count_query, parameters=parameters
-                )
+            count_query = f"SELECT VALUE COUNT(1) FROM media m {where}"
+            count_result = self._query(
+                self.media_container, "get_user_media.count", count_query, parameters
             )
             total = count_result[0] if count_result else 0
 
             # Apply pagination
             offset = (page - 1) * page_size
-            query += f" OFFSET {offset} LIMIT {page_size}"
-
-            items = list(
-                self.media_container.query_items(query=query, parameters=parameters)
-            )
+            pagination = f" OFFSET {offset} LIMIT {page_size}"
+            indexed_fields = [
+                field for field, value in equality_filters.items() if value is not None
+            ]
+            query = f"SELECT * FROM media m {where} "
+
+            try:
+                items = self._query(
+                    self.media_container,
+                    "get_user_media",
+                    query + _media_order_by(indexed_fields) + pagination,
+                    parameters,
+                )
+            except exceptions.CosmosHttpResponseError as e:
+                # The composite index may still be building on an older container
+                if not _missing_composite_index(e):
+                    raise
+                logger.warning(f"Composite ORDER BY rejected, falling back: {e.message}")
+                items = self._query(
+                    self.media_container,
+                    "get_user_media",
+                    query + "ORDER BY m.uploadedAt DESC" + pagination,
+                    parameters,
+                )
 
             return items, total
 
@@ -140,6 +437,52 @@ class CosmosDBClient:
             logger.error(f"Failed to get user media: {e}")
             raise
 
+    def iter_user_media(
+        self,
+        user_id: str,
+        media_type: Optional[str] = None,
+        tag: Optional[str] = None,
+        page_size: int = 100,
+    ) -> Iterator[dict]:
+        """
+        Stream all of a user's media, newest first
+        Pages are fetched one at a time with continuation tokens, so memory use
+        does not grow with the size of the library.
+        """
+        where = "WHERE m.userId = @userId"
+        parameters = [{"name": "@userId", "value": user_id}]
+        if media_type is not None:
+            where += " AND m.mediaType = @mediaType"
+            parameters.append({"name": "@mediaType", "value": media_type})
+        if tag is not None:
+            where += " AND ARRAY_CONTAINS(m.tags, @tag)"
+            parameters.append({"name": "@tag", "value": tag})
+        order_by = _media_order_by(["mediaType"] if media_type is not None else [])
+        query = f"SELECT * FROM media m {where} {order_by}"
+
+        continuation = None
+        while True:
+
+            def request(call):
+                pages = self.media_container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    partition_key=user_id,
+                    max_item_count=page_size,
+                    response_hook=call.hook,
+                ).by_page(continuation)
+                page = list(next(pages, []))
+                call.items = len(page)
+                return page, pages.continuation_token
+
+            # A failed page is retried from the same continuation token
+            page, continuation = execute(
+                self.media_container.id, "iter_user_media", request, query, BULK
+            )
+            yield from page
+            if not continuation:
+                return
+
     def update_media(self, media_id: str, user_id: str, updates: dict) -> dict:
         """Update media metadata"""
         try:
@@ -152,24 +495,165 @@ class CosmosDBClient:
             existing.update(updates)
 
             # Save updated item
-            return self.media_container.replace_item(
-                item=media_id, body=existing
+            return execute(
+                "media",
+                "update_media",
+                lambda call: self.media_container.replace_item(
+                    item=media_id, body=existing, response_hook=call.hook
+                ),
+                priority=WRITE,
             )
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Failed to update media: {e}")
             raise
+        finally:
+            single_flight.forget(user_id)
 
     def delete_media(self, media_id: str, user_id: str) -> bool:
-        """Delete media item"""
+        """Delete media item, leaving a tombstone for delta sync"""
+        tombstone = {
+            "id": media_id,
+            "userId": user_id,
+            "deleted": True,
+            "deletedAt": datetime.utcnow().isoformat(),
+        }
         try:
-            self.media_container.delete_item(item=media_id, partition_key=user_id)
+            # The tombstone is written first so that a client syncing in
+            # between cannot miss the delete; it is taken back if the delete
+            # does not happen
+            execute(
+                "tombstones",
+                "write_tombstone",
+                lambda call: self.tombstones_container.upsert_item(
+                    body=tombstone, response_hook=call.hook
+                ),
+                priority=WRITE,
+            )
+            try:
+                execute(
+                    "media",
+                    "delete_media",
+                    lambda call: self.media_container.delete_item(
+                        item=media_id, partition_key=user_id, response_hook=call.hook
+                    ),
+                    priority=WRITE,
+                )
+            except BaseException:
+                self._remove_tombstone(media_id, user_id)
+                raise
             return True
         except exceptions.CosmosResourceNotFoundError:
             return False
         except exceptions.CosmosHttpResponseError as e:
             logger.error(f"Failed to delete media: {e}")
             raise
+        finally:
+            single_flight.forget(user_id)
 
+    def _remove_tombstone(self, media_id: str, user_id: str):
+        try:
+            execute(
+                "tombstones",
+                "delete_tombstone",
+                lambda call: self.tombstones_container.delete_item(
+                    item=media_id, partition_key=user_id, response_hook=call.hook
+                ),
+                priority=WRITE,
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+        except exceptions.CosmosHttpResponseError as e:
+            # A stray tombstone only makes clients drop an item they then
+            # fetch again on their next full sync
+            logger.warning(f"Failed to remove tombstone for {media_id}: {e}")
+
+    def get_media_changes(
+        self, user_id: str, since: Optional[str], limit: int = 500
+    ) -> tuple[List[dict], List[dict], str, bool]:
+        """
+        Media created, updated or deleted after a watermark, oldest first
+        A watermark is the (_ts, id) of the last change returned, or of the
+        settle point when there was none, and the time up to which the client
+        is known to be caught up, which is what tombstone expiry is measured
+        from. _ts has one-second resolution and comes from the server, so
+        changes from the last settings.changes_settle_seconds are held back
+        until no write still in flight can commit at or before the watermark
+        handed out.
+
+        Returns:
+            tuple: (media documents, tombstones, watermark, whether more follow)
+
+        Raises:
+            ValueError: If since is not a watermark from this method
+            WatermarkExpiredError: If tombstones after since may have expired
+        """
+        now = int(time.time())
+        until = now - settings.changes_settle_seconds
+        ts, last_id = 0, ""
+        if since is not None:
+            position = decode_watermark(since)
+            if (
+                len(position) not in (2, 3)
+                or not all(isinstance(value, int) for value in position[::2])
+                or not isinstance(position[1], str)
+            ):
+                raise ValueError("Invalid watermark")
+            # Watermarks from before the caught-up time was recorded use _ts
+            ts, last_id, caught_up = (position + [position[0]])[:3]
+            if caught_up < now - settings.tombstone_ttl_days * 86400:
+                raise WatermarkExpiredError()
+        parameters = [
+            {"name": "@userId", "value": user_id},
+            {"name": "@until", "value": until},
+            {"name": "@ts", "value": ts},
+            {"name": "@id", "value": last_id},
+            {"name": "@limit", "value": limit},
+        ]
+
+        def changes(container: ContainerProxy, projection: str) -> list:
+            return self._query(
+                container,
+                "get_media_changes",
+                f"SELECT TOP @limit {projection} FROM c WHERE c.userId = @userId "
+                "AND c._ts <= @until AND (c._ts > @ts OR (c._ts = @ts AND c.id > @id)) "
+                "ORDER BY c.userId ASC, c._ts ASC, c.id ASC",
+                parameters,
+            )
+
+        try:
+            media = changes(self.media_container, "*")
+            tombstones = changes(
+                self.tombstones_container, "c.id, c.userId, c.deletedAt, c._ts"
+            )
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to get media changes: {e}")
+            raise
+
+        merged = list(
+            islice(
+                heapq.merge(
+                    ((doc["_ts"], doc["id"], False, doc) for doc in media),
+                    ((doc["_ts"], doc["id"], True, doc) for doc in tombstones),
+                ),
+                limit,
+            )
+        )
+        more = len(media) == limit or len(tombstones) == limit
+        if merged:
+            ts, last_id = merged[-1][:2]
+        elif ts < until:
+            # Nothing changed up to the settle point, so the next poll can
+            # start there; nothing can still commit at or before it
+            ts, last_id = until, ""
+        return (
+            [doc for _, _, deleted, doc in merged if not deleted],
+            [doc for _, _, deleted, doc in merged if deleted],
+            # A client with more to read is only caught up to its position
+            encode_watermark([ts, last_id, ts if more else until]),
+            more,
+        )
+
+    @coalesced("search_media")
     def search_media(
         self, user_id: str, query: str, page: int = 1, page_size: int = 20
     ) -> tuple[List[dict], int]:
@@ -193,10 +677,8 @@ class CosmosDBClient:
 
             # Get total count
             count_query = search_query.replace("SELECT *", "SELECT VALUE COUNT(1)")
-            count_result = list(
-                self.media_container.query_items(
-                    query=count_query, parameters=parameters
-                )
+            count_result = self._query(
+                self.media_container, "search_media.count", count_query, parameters
             )
             total = count_result[0] if count_result else 0
 
@@ -204,10 +686,8 @@ class CosmosDBClient:
             offset = (page - 1) * page_size
             search_query += f" OFFSET {offset} LIMIT {page_size}"
 
-            items = list(
-                self.media_container.query_items(
-                    query=search_query, parameters=parameters
-                )
+            items = self._query(
+                self.media_container, "search_media", search_query, parameters
             )
 
             return items, total
@@ -216,6 +696,320 @@ class CosmosDBClient:
             logger.error(f"Failed to search media: {e}")
             raise
 
+    def get_tag_counts(self, user_id: str) -> Dict[str, int]:
+        """Number of the user's media items carrying each tag"""
+        try:
+            query = (
+                "SELECT t AS tag, COUNT(1) AS mediaCount FROM media m JOIN t IN m.tags "
+                "WHERE m.userId = @userId GROUP BY t"
+            )
+            rows = self._query(
+                self.media_container,
+                "get_tag_counts",
+                query,
+                [{"name": "@userId", "value": user_id}],
+            )
+            return {row["tag"]: row["mediaCount"] for row in rows if isinstance(row["tag"], str)}
+
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to count tags: {e}")
+            raise
+
+    def get_perceptual_hashes(self, user_id: str) -> List[tuple[str, str]]:
+        """(media id, perceptual hash) of each of the user's hashed images"""
+        try:
+            rows = self._query(
+                self.media_container,
+                "get_perceptual_hashes",
+                "SELECT m.id, m.perceptualHash FROM media m "
+                "WHERE m.userId = @userId AND IS_STRING(m.perceptualHash)",
+                [{"name": "@userId", "value": user_id}],
+            )
+            return [(row["id"], row["perceptualHash"]) for row in rows]
+
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to get perceptual hashes: {e}")
+            raise
+
+    def get_media_stats(self, user_id: str) -> Dict[str, dict]:
+        """Item count and total bytes of the user's media, per media type"""
+        try:
+            rows = self._query(
+                self.media_container,
+                "get_media_stats",
+                "SELECT m.mediaType, COUNT(1) AS mediaCount, SUM(m.fileSize) AS totalBytes "
+                "FROM media m WHERE m.userId = @userId GROUP BY m.mediaType",
+                [{"name": "@userId", "value": user_id}],
+            )
+            return {
+                row["mediaType"]: {"count": row["mediaCount"], "bytes": row.get("totalBytes") or 0}
+                for row in rows
+            }
+
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to get media stats: {e}")
+            raise
+
+    # Blob references, for the orphan blob reconciler
+    BLOB_REFERENCE_FIELDS = ("fileName", "thumbnailFileName")
+
+    def _iter_sorted_field(self, user_id: str, field: str, page_size: int) -> Iterator[str]:
+        after = None
+        while True:
+            query = (
+                f"SELECT TOP @pageSize VALUE m.{field} FROM media m "
+                f"WHERE m.userId = @userId AND IS_STRING(m.{field})"
+            )
+            parameters = [
+                {"name": "@pageSize", "value": page_size},
+                {"name": "@userId", "value": user_id},
+            ]
+            if after is not None:
+                query += f" AND m.{field} > @after"
+                parameters.append({"name": "@after", "value": after})
+            page = self._query(
+                self.media_container,
+                "iter_blob_references",
+                query + f" ORDER BY m.{field}",
+                parameters,
+            )
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1]
+
+    def iter_blob_references(self, user_id: str, page_size: int = 1000) -> Iterator[str]:
+        """
+        Blob names referenced by the user's media (files and thumbnails), in
+        name order; each field is read in keyset pages of page_size
+        """
+        return heapq.merge(
+            *(
+                self._iter_sorted_field(user_id, field, page_size)
+                for field in self.BLOB_REFERENCE_FIELDS
+            )
+        )
+
+    def find_media_by_blob(self, user_id: str, blob_name: str) -> Optional[dict]:
+        """The user's media item stored in or thumbnailed by blob_name, if any"""
+        rows = self._query(
+            self.media_container,
+            "find_media_by_blob",
+            "SELECT TOP 1 * FROM media m WHERE m.userId = @userId "
+            "AND (m.fileName = @blobName OR m.thumbnailFileName = @blobName)",
+            [
+                {"name": "@userId", "value": user_id},
+                {"name": "@blobName", "value": blob_name},
+            ],
+        )
+        return rows[0] if rows else None
+
+    def get_unnamed_thumbnails(self, user_id: str) -> List[dict]:
+        """The user's media with a thumbnail URL but no thumbnailFileName (older uploads)"""
+        return self._query(
+            self.media_container,
+            "get_unnamed_thumbnails",
+            "SELECT m.id, m.userId, m.thumbnailUrl FROM media m WHERE m.userId = @userId "
+            "AND IS_STRING(m.thumbnailUrl) AND NOT IS_DEFINED(m.thumbnailFileName)",
+            [{"name": "@userId", "value": user_id}],
+        )
+
+    def get_videos_without_metadata(self, user_id: str) -> List[dict]:
+        """
+        The user's videos without a duration that backfill_video_metadata has
+        not looked at yet
+        """
+        return self._query(
+            self.media_container,
+            "get_videos_without_metadata",
+            "SELECT m.id, m.userId, m.fileName, m.fileSize FROM media m WHERE m.userId = @userId "
+            "AND m.mediaType = 'video' AND NOT IS_DEFINED(m.durationSeconds) "
+            "AND NOT IS_DEFINED(m.videoMetadataChecked)",
+            [{"name": "@userId", "value": user_id}],
+        )
+
+    # Change feed
+    def _feed_container(self, feed: str) -> ContainerProxy:
+        if feed == "media":
+            return self.media_container
+        if feed == "tombstones":
+            return self.tombstones_container
+        raise ValueError(f"Unknown change feed: '{feed}'")
+
+    def change_feed_ranges(self, feed: str = "media") -> List[str]:
+        """Partition key ranges of a feed's container; each has its own change feed"""
+        ranges = self.client.client_connection._ReadPartitionKeyRanges(
+            self._feed_container(feed).container_link
+        )
+        return [partition_key_range["id"] for partition_key_range in ranges]
+
+    def read_changes(
+        self,
+        feed: str,
+        range_id: str,
+        continuation: Optional[str],
+        max_items: int = 100,
+        start_from_beginning: bool = True,
+    ) -> tuple[List[dict], Optional[str]]:
+        """
+        Next documents created or updated in a partition key range of the
+        media or tombstones container (feed "media" or "tombstones")
+        Without a continuation the feed starts at the beginning or at the
+        current time. Each document appears in its latest version only.
+
+        Returns:
+            tuple: (documents in modification order, continuation to read on from)
+        """
+        container = self._feed_container(feed)
+        etag = {"value": None}
+
+        def request(call):
+            def hook(headers, result):
+                call.hook(headers, result)
+                if not isinstance(result, ItemPaged):
+                    etag["value"] = headers.get("etag")
+
+            pages = container.query_items_change_feed(
+                partition_key_range_id=range_id,
+                is_start_from_beginning=start_from_beginning and continuation is None,
+                continuation=continuation,
+                max_item_count=max_items,
+                response_hook=hook,
+            ).by_page()
+            page = list(next(pages, []))
+            call.items = len(page)
+            return page
+
+        try:
+            changes = execute(container.id, "read_changes", request, priority=BULK)
+            return changes, etag["value"] or continuation
+
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error(f"Failed to read the {feed} change feed: {e}")
+            raise
+
+    def read_lease(self, lease_id: str) -> Optional[dict]:
+        """A change feed lease, with its _etag"""
+        try:
+            return self._point_read(self.leases_container, "read_lease", lease_id, lease_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def write_lease(self, lease: dict, etag: Optional[str]) -> Optional[dict]:
+        """
+        Create a lease (etag None) or replace it if it still has the given etag
+
+        Returns:
+            dict | None: The stored lease, or None if another owner changed it first
+        """
+        try:
+            if etag is None:
+                return execute(
+                    self.leases_container.id,
+                    "write_lease",
+                    lambda call: self.leases_container.create_item(
+                        body=lease, response_hook=call.hook
+                    ),
+                    priority=BULK,
+                )
+            return execute(
+                self.leases_container.id,
+                "write_lease",
+                lambda call: self.leases_container.replace_item(
+                    item=lease["id"],
+                    body=lease,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                    response_hook=call.hook,
+                ),
+                priority=BULK,
+            )
+        except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+            return None
+
+    # Views maintained by change feed projectors
+    def get_view(self, user_id: str, name: str) -> Optional[dict]:
+        try:
+            return self._point_read(self.views_container, "get_view", name, user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def upsert_view(self, user_id: str, name: str, view: dict) -> dict:
+        body = {**view, "id": name, "userId": user_id}
+        return execute(
+            self.views_container.id,
+            "upsert_view",
+            lambda call: self.views_container.upsert_item(body=body, response_hook=call.hook),
+            priority=BULK,
+        )
+
+    def write_view(
+        self, user_id: str, name: str, view: dict, etag: Optional[str]
+    ) -> Optional[dict]:
+        """
+        Create a view (etag None) or replace it if it still has the given etag
+
+        Returns:
+            dict | None: The stored view, or None if it was written by someone else first
+        """
+        body = {**view, "id": name, "userId": user_id}
+        try:
+            if etag is None:
+                return execute(
+                    self.views_container.id,
+                    "write_view",
+                    lambda call: self.views_container.create_item(
+                        body=body, response_hook=call.hook
+                    ),
+                    priority=BULK,
+                )
+            return execute(
+                self.views_container.id,
+                "write_view",
+                lambda call: self.views_container.replace_item(
+                    item=name,
+                    body=body,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                    response_hook=call.hook,
+                ),
+                priority=BULK,
+            )
+        except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+            return None
+
+
+def _media_order_by(equality_fields: List[str]) -> str:
+    """
+    Build an ORDER BY clause matching the widest composite index whose
+    fields are all pinned by equality filters
+    """
+    candidates = [
+        fields
+        for fields in MEDIA_COMPOSITE_INDEX_FILTERS
+        if set(fields) <= set(equality_fields)
+    ]
+    fields = max(candidates, key=len)
+    order = ["m.userId ASC"] + [f"m.{field} ASC" for field in fields]
+    order.append("m.uploadedAt DESC")
+    return "ORDER BY " + ", ".join(order)
+
+
+def _missing_composite_index(error: exceptions.CosmosHttpResponseError) -> bool:
+    """Whether Cosmos DB refused an ORDER BY for lack of a composite index"""
+    return error.status_code == 400 and "composite index" in str(error.message or "").lower()
+
+
+def create_metadata_client():
+    """Create the metadata backend selected by settings.metadata_backend"""
+    if settings.metadata_backend == "cosmos":
+        return CosmosDBClient()
+    if settings.metadata_backend == "sqlite":
+        from database_sqlite import SQLiteMetadataClient
+
+        return SQLiteMetadataClient()
+    raise ValueError(f"Unknown metadata backend: '{settings.metadata_backend}'")
+
 
 # Global instance
-cosmos_db = CosmosDBClient()
+cosmos_db = create_metadata_client()
@@ -0,0 +1,762 @@
+"""
+Embedded SQLite metadata backend
+Implements the CosmosDBClient interface on a single SQLite file in WAL mode
+for single-node deployments and offline runs. Documents are stored as JSON
+next to the columns that are filtered or sorted on; search uses an FTS5
+trigram index so substring matches behave like Cosmos CONTAINS.
+"""
+
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Optional, List, Dict, Iterator
+from config import settings
+from delta_sync import WatermarkExpiredError, decode_watermark, encode_watermark
+import heapq
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email);
+
+CREATE TABLE IF NOT EXISTS media (
+    pk INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    uploaded_at TEXT NOT NULL,
+    media_type TEXT,
+    orientation TEXT,
+    camera_model TEXT,
+    width INTEGER,
+    height INTEGER,
+    captured_at TEXT,
+    seq INTEGER,
+    doc TEXT NOT NULL,
+    UNIQUE (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS ix_media_user_uploaded ON media (user_id, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS ix_media_user_type_uploaded
+    ON media (user_id, media_type, uploaded_at DESC);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5 (
+    original_file_name, description, tokenize = 'trigram'
+);
+
+-- Every media write and delete takes the next number, which orders the
+-- change feeds and delta sync; tombstones_pruned is the highest number of a
+-- tombstone dropped after settings.tombstone_ttl_days
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO sequences (name, value) VALUES ('media', 0);
+INSERT OR IGNORE INTO sequences (name, value) VALUES ('tombstones_pruned', 0);
+
+CREATE TABLE IF NOT EXISTS tombstones (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    deleted_at REAL NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS ix_tombstones_user_seq ON tombstones (user_id, seq);
+CREATE INDEX IF NOT EXISTS ix_tombstones_seq ON tombstones (seq);
+CREATE INDEX IF NOT EXISTS ix_tombstones_deleted_at ON tombstones (deleted_at);
+
+CREATE TABLE IF NOT EXISTS leases (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    doc TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS views (
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+"""
+
+# The single change feed range of the SQLite backend
+CHANGE_FEED_RANGE = "0"
+
+# Document field -> column for fields stored outside the JSON document
+MEDIA_COLUMNS = {
+    "id": "id",
+    "userId": "user_id",
+    "uploadedAt": "uploaded_at",
+    "mediaType": "media_type",
+    "orientation": "orientation",
+    "cameraModel": "camera_model",
+    "width": "width",
+    "height": "height",
+    "capturedAt": "captured_at",
+}
+
+# The trigram tokenizer cannot match queries shorter than this
+FTS_MIN_QUERY_LENGTH = 3
+
+
+class SQLiteMetadataClient:
+    def __init__(self, path: Optional[str] = None, pool_size: Optional[int] = None):
+        self.path = path or settings.sqlite_path
+        self.pool_size = pool_size or settings.sqlite_pool_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def reset_after_fork(self):
+        """
+        Forget connections inherited from a parent process
+        SQLite connections must not be used across fork; the child opens its own.
+        """
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False, timeout=30
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=30000")
+        return connection
+
+    def _get_pool(self) -> queue.Queue:
+        """Connection pool, created (with the schema) on first use"""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    pool = queue.Queue()
+                    first = self._connect()
+                    first.executescript(SCHEMA)
+                    self._migrate(first)
+                    pool.put(first)
+                    for _ in range(self.pool_size - 1):
+                        pool.put(self._connect())
+                    self._pool = pool
+        return self._pool
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection):
+        """Bring databases created by earlier versions up to SCHEMA"""
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(media)")}
+        if "seq" not in columns:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("ALTER TABLE media ADD COLUMN seq INTEGER")
+            connection.execute("UPDATE media SET seq = pk")
+            connection.execute(
+                "UPDATE sequences SET value = (SELECT coalesce(max(seq), 0) FROM media) "
+                "WHERE name = 'media'"
+            )
+            connection.execute("COMMIT")
+        view_columns = {row[1] for row in connection.execute("PRAGMA table_info(views)")}
+        if "version" not in view_columns:
+            connection.execute(
+                "ALTER TABLE views ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+            )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_media_seq ON media (seq)")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_media_user_seq ON media (user_id, seq)"
+        )
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        pool = self._get_pool()
+        connection = pool.get()
+        try:
+            yield connection
+        finally:
+            pool.put(connection)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def provision(self, migrate_indexing_policy: bool = True):
+        """Create the database file and schema"""
+        self._get_pool()
+        logger.info(f"SQLite database '{self.path}' is ready")
+
+    def warm_up(self, connections: int = 4):
+        """Open the pool and run a query on up to connections of its connections"""
+        # Held together, so each query gets a different connection
+        with ExitStack() as stack:
+            for _ in range(min(connections, self.pool_size)):
+                connection = stack.enter_context(self._connection())
+                connection.execute("SELECT 1").fetchone()
+
+    # User operations
+    def create_user(self, user_data: dict) -> dict:
+        """Create a new user"""
+        try:
+            with self._transaction() as connection:
+                connection.execute(
+                    "INSERT INTO users (id, email, doc) VALUES (?, ?, ?)",
+                    (user_data["id"], user_data["email"], json.dumps(user_data)),
+                )
+            return user_data
+        except sqlite3.IntegrityError:
+            raise ValueError("User already exists")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to create user: {e}")
+            raise
+
+    def get_user_by_email(self, email: str) -> Optional[dict]:
+        """Get user by email"""
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT doc FROM users WHERE email = ?", (email,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        """Get user by ID"""
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT doc FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_users(
+        self,
+        page_size: int = 500,
+        after_id: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Iterator[List[dict]]:
+        """Stream all users in pages ordered by id, resumable from any page's last id"""
+        while True:
+            with self._connection() as connection:
+                rows = connection.execute(
+                    "SELECT doc FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                    (after_id or "", page_size),
+                ).fetchall()
+            page = [json.loads(row[0]) for row in rows]
+            if fields:
+                keep = {"id", *fields}
+                page = [{key: value for key, value in user.items() if key in keep} for user in page]
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after_id = page[-1]["id"]
+
+    def patch_user(self, user_id: str, fields: dict) -> dict:
+        """Set fields on a user"""
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT doc FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+            if not row:
+                raise ValueError("User not found")
+            user = json.loads(row[0])
+            user.update(fields)
+            connection.execute(
+                "UPDATE users SET email = ?, doc = ? WHERE id = ?",
+                (user["email"], json.dumps(user), user_id),
+            )
+        return user
+
+    # Media operations
+    @staticmethod
+    def _write_media(connection: sqlite3.Connection, media_data: dict, replace: bool):
+        seq = connection.execute(
+            "UPDATE sequences SET value = value + 1 WHERE name = 'media' RETURNING value"
+        ).fetchone()[0]
+        columns = list(MEDIA_COLUMNS.values()) + ["seq", "doc"]
+        values = [media_data.get(field) for field in MEDIA_COLUMNS] + [seq, json.dumps(media_data)]
+        if replace:
+            assignments = ", ".join(f"{column} = ?" for column in columns)
+            cursor = connection.execute(
+                f"UPDATE media SET {assignments} WHERE user_id = ? AND id = ? RETURNING pk",
+                values + [media_data["userId"], media_data["id"]],
+            )
+        else:
+            placeholders = ", ".join("?" for _ in columns)
+            cursor = connection.execute(
+                f"INSERT INTO media ({', '.join(columns)}) VALUES ({placeholders}) RETURNING pk",
+                values,
+            )
+        pk = cursor.fetchone()[0]
+        connection.execute("DELETE FROM media_fts WHERE rowid = ?", (pk,))
+        connection.execute(
+            "INSERT INTO media_fts (rowid, original_file_name, description) VALUES (?, ?, ?)",
+            (pk, media_data.get("originalFileName") or "", media_data.get("description") or ""),
+        )
+
+    def create_media(self, media_data: dict) -> dict:
+        """Create a new media item"""
+        try:
+            with self._transaction() as connection:
+                self._write_media(connection, media_data, replace=False)
+            return media_data
+        except sqlite3.Error as e:
+            logger.error(f"Failed to create media: {e}")
+            raise
+
+    def get_media_by_id(self, media_id: str, user_id: str) -> Optional[dict]:
+        """Get media by ID"""
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT doc FROM media WHERE user_id = ? AND id = ?", (user_id, media_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_media_by_ids(self, user_id: str, media_ids: List[str]) -> List[dict]:
+        """Get several of a user's media items in one query (missing ids are skipped)"""
+        if not media_ids:
+            return []
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT doc FROM media WHERE user_id = ? "
+                "AND id IN (SELECT value FROM json_each(?))",
+                (user_id, json.dumps(list(media_ids))),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _paginated(
+        self, where: str, parameters: list, page: int, page_size: int
+    ) -> tuple[List[dict], int]:
+        offset = (page - 1) * page_size
+        with self._connection() as connection:
+            total = connection.execute(
+                f"SELECT COUNT(*) FROM media WHERE {where}", parameters
+            ).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT doc FROM media WHERE {where} "
+                "ORDER BY uploaded_at DESC LIMIT ? OFFSET ?",
+                parameters + [page_size, offset],
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+
+    def get_user_media(
+        self,
+        user_id: str,
+        page: int = 1,
+        page_size: int = 20,
+        media_type: Optional[str] = None,
+        orientation: Optional[str] = None,
+        camera_model: Optional[str] = None,
+        min_width: Optional[int] = None,
+        min_height: Optional[int] = None,
+        captured_after: Optional[str] = None,
+        captured_before: Optional[str] = None,
+    ) -> tuple[List[dict], int]:
+        """Get paginated list of user's media"""
+        where = "user_id = ?"
+        parameters = [user_id]
+        filters = [
+            ("media_type = ?", media_type),
+            ("orientation = ?", orientation),
+            ("camera_model = ?", camera_model),
+            ("width >= ?", min_width),
+            ("height >= ?", min_height),
+            ("captured_at >= ?", captured_after),
+            ("captured_at <= ?", captured_before),
+        ]
+        for condition, value in filters:
+            if value is not None:
+                where += f" AND {condition}"
+                parameters.append(value)
+        return self._paginated(where, parameters, page, page_size)
+
+    def iter_user_media(
+        self,
+        user_id: str,
+        media_type: Optional[str] = None,
+        tag: Optional[str] = None,
+        page_size: int = 100,
+    ) -> Iterator[dict]:
+        """Stream all of a user's media, newest first, one keyset page at a time"""
+        where = "user_id = ?"
+        parameters = [user_id]
+        if media_type is not None:
+            where += " AND media_type = ?"
+            parameters.append(media_type)
+        if tag is not None:
+            where += " AND EXISTS (SELECT 1 FROM json_each(media.doc, '$.tags') WHERE value = ?)"
+            parameters.append(tag)
+
+        after = None
+        while True:
+            keyset = ""
+            keyset_parameters = []
+            if after is not None:
+                keyset = " AND (uploaded_at < ? OR (uploaded_at = ? AND pk < ?))"
+                keyset_parameters = [after[0], after[0], after[1]]
+            with self._connection() as connection:
+                rows = connection.execute(
+                    f"SELECT pk, uploaded_at, doc FROM media WHERE {where}{keyset} "
+                    "ORDER BY uploaded_at DESC, pk DESC LIMIT ?",
+                    parameters + keyset_parameters + [page_size],
+                ).fetchall()
+            for _, _, doc in rows:
+                yield json.loads(doc)
+            if len(rows) < page_size:
+                return
+            after = (rows[-1][1], rows[-1][0])
+
+    def update_media(self, media_id: str, user_id: str, updates: dict) -> dict:
+        """Update media metadata"""
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT doc FROM media WHERE user_id = ? AND id = ?", (user_id, media_id)
+            ).fetchone()
+            if not row:
+                raise ValueError("Media not found")
+            existing = json.loads(row[0])
+            existing.update(updates)
+            self._write_media(connection, existing, replace=True)
+        return existing
+
+    def delete_media(self, media_id: str, user_id: str) -> bool:
+        """Delete media item, leaving a tombstone for delta sync"""
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "DELETE FROM media WHERE user_id = ? AND id = ? RETURNING pk",
+                (user_id, media_id),
+            ).fetchone()
+            if not row:
+                return False
+            connection.execute("DELETE FROM media_fts WHERE rowid = ?", (row[0],))
+            seq = connection.execute(
+                "UPDATE sequences SET value = value + 1 WHERE name = 'media' RETURNING value"
+            ).fetchone()[0]
+            tombstone = {
+                "id": media_id,
+                "userId": user_id,
+                "deleted": True,
+                "deletedAt": datetime.utcnow().isoformat(),
+            }
+            connection.execute(
+                "INSERT OR REPLACE INTO tombstones (user_id, id, seq, deleted_at, doc) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, media_id, seq, now, json.dumps(tombstone)),
+            )
+            self._prune_tombstones(connection, now - settings.tombstone_ttl_days * 86400)
+        return True
+
+    @staticmethod
+    def _prune_tombstones(connection: sqlite3.Connection, cutoff: float):
+        pruned = connection.execute(
+            "DELETE FROM tombstones WHERE deleted_at < ? RETURNING seq", (cutoff,)
+        ).fetchall()
+        if pruned:
+            connection.execute(
+                "UPDATE sequences SET value = max(value, ?) WHERE name = 'tombstones_pruned'",
+                (max(seq for seq, in pruned),),
+            )
+
+    def get_media_changes(
+        self, user_id: str, since: Optional[str], limit: int = 500
+    ) -> tuple[List[dict], List[dict], str, bool]:
+        """
+        Media created, updated or deleted after a watermark, oldest first
+        A watermark is the sequence number of the last change returned;
+        writers are serialized, so numbers become visible in order.
+
+        Returns:
+            tuple: (media documents, tombstones, watermark, whether more follow)
+
+        Raises:
+            ValueError: If since is not a watermark from this method
+            WatermarkExpiredError: If tombstones after since have been pruned
+        """
+        after = 0
+        if since is not None:
+            position = decode_watermark(since)
+            if len(position) != 1 or not isinstance(position[0], int):
+                raise ValueError("Invalid watermark")
+            after = position[0]
+        with self._connection() as connection:
+            pruned = connection.execute(
+                "SELECT value FROM sequences WHERE name = 'tombstones_pruned'"
+            ).fetchone()[0]
+            if since is not None and after < pruned:
+                raise WatermarkExpiredError()
+            rows = connection.execute(
+                "SELECT seq, doc, 0 FROM media WHERE user_id = ? AND seq > ? "
+                "UNION ALL SELECT seq, doc, 1 FROM tombstones WHERE user_id = ? AND seq > ? "
+                "ORDER BY seq LIMIT ?",
+                (user_id, after, user_id, after, limit + 1),
+            ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            after = rows[-1][0]
+        return (
+            [json.loads(doc) for _, doc, deleted in rows if not deleted],
+            [json.loads(doc) for _, doc, deleted in rows if deleted],
+            encode_watermark([after]),
+            more,
+        )
+
+    def search_media(
+        self, user_id: str, query: str, page: int = 1, page_size: int = 20
+    ) -> tuple[List[dict], int]:
+        """Search media by filename, description, or tags"""
+        tag_match = (
+            "EXISTS (SELECT 1 FROM json_each(media.doc, '$.tags') "
+            "WHERE lower(json_each.value) = lower(?))"
+        )
+        if len(query) >= FTS_MIN_QUERY_LENGTH:
+            text_match = (
+                "pk IN (SELECT rowid FROM media_fts WHERE media_fts MATCH ?)"
+            )
+            text_parameters = ['"' + query.replace('"', '""') + '"']
+        else:
+            text_match = (
+                "(instr(lower(json_extract(doc, '$.originalFileName')), lower(?)) > 0 "
+                "OR instr(lower(coalesce(json_extract(doc, '$.description'), '')), lower(?)) > 0)"
+            )
+            text_parameters = [query, query]
+
+        where = f"user_id = ? AND ({text_match} OR {tag_match})"
+        return self._paginated(where, [user_id] + text_parameters + [query], page, page_size)
+
+    def get_tag_counts(self, user_id: str) -> Dict[str, int]:
+        """Number of the user's media items carrying each tag"""
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT tags.value, COUNT(DISTINCT media.pk) "
+                "FROM media, json_each(media.doc, '$.tags') AS tags "
+                "WHERE media.user_id = ? AND tags.type = 'text' GROUP BY tags.value",
+                (user_id,),
+            ).fetchall()
+        return dict(rows)
+
+    def get_perceptual_hashes(self, user_id: str) -> List[tuple[str, str]]:
+        """(media id, perceptual hash) of each of the user's hashed images"""
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT id, json_extract(doc, '$.perceptualHash') FROM media "
+                "WHERE user_id = ? AND json_type(doc, '$.perceptualHash') = 'text'",
+                (user_id,),
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def get_media_stats(self, user_id: str) -> Dict[str, dict]:
+        """Item count and total bytes of the user's media, per media type"""
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT media_type, COUNT(*), coalesce(SUM(json_extract(doc, '$.fileSize')), 0) "
+                "FROM media WHERE user_id = ? GROUP BY media_type",
+                (user_id,),
+            ).fetchall()
+        return {media_type: {"count": count, "bytes": size} for media_type, count, size in rows}
+
+    # Blob references, for the orphan blob reconciler
+    BLOB_REFERENCE_FIELDS = ("fileName", "thumbnailFileName")
+
+    def _iter_sorted_field(self, user_id: str, field: str, page_size: int) -> Iterator[str]:
+        after = ""
+        while True:
+            with self._connection() as connection:
+                page = [
+                    row[0]
+                    for row in connection.execute(
+                        f"SELECT json_extract(doc, '$.{field}') AS name FROM media "
+                        f"WHERE user_id = ? AND json_type(doc, '$.{field}') = 'text' "
+                        "AND name > ? ORDER BY name LIMIT ?",
+                        (user_id, after, page_size),
+                    )
+                ]
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1]
+
+    def iter_blob_references(self, user_id: str, page_size: int = 1000) -> Iterator[str]:
+        """Blob names referenced by the user's media (files and thumbnails), in name order"""
+        return heapq.merge(
+            *(
+                self._iter_sorted_field(user_id, field, page_size)
+                for field in self.BLOB_REFERENCE_FIELDS
+            )
+        )
+
+    def find_media_by_blob(self, user_id: str, blob_name: str) -> Optional[dict]:
+        """The user's media item stored in or thumbnailed by blob_name, if any"""
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT doc FROM media WHERE user_id = ? AND (json_extract(doc, '$.fileName') = ? "
+                "OR json_extract(doc, '$.thumbnailFileName') = ?) LIMIT 1",
+                (user_id, blob_name, blob_name),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_unnamed_thumbnails(self, user_id: str) -> List[dict]:
+        """The user's media with a thumbnail URL but no thumbnailFileName (older uploads)"""
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT id, user_id, json_extract(doc, '$.thumbnailUrl') FROM media "
+                "WHERE user_id = ? AND json_type(doc, '$.thumbnailUrl') = 'text' "
+                "AND json_type(doc, '$.thumbnailFileName') IS NULL",
+                (user_id,),
+            ).fetchall()
+        return [{"id": id, "userId": user, "thumbnailUrl": url} for id, user, url in rows]
+
+    def get_videos_without_metadata(self, user_id: str) -> List[dict]:
+        """
+        The user's videos without a duration that backfill_video_metadata has
+        not looked at yet
+        """
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT id, user_id, json_extract(doc, '$.fileName'), "
+                "json_extract(doc, '$.fileSize') FROM media "
+                "WHERE user_id = ? AND media_type = 'video' "
+                "AND json_type(doc, '$.durationSeconds') IS NULL "
+                "AND json_type(doc, '$.videoMetadataChecked') IS NULL",
+                (user_id,),
+            ).fetchall()
+        return [
+            {"id": id, "userId": user, "fileName": name, "fileSize": size}
+            for id, user, name, size in rows
+        ]
+
+    # Change feed
+    def change_feed_ranges(self, feed: str = "media") -> List[str]:
+        return [CHANGE_FEED_RANGE]
+
+    def read_changes(
+        self,
+        feed: str,
+        range_id: str,
+        continuation: Optional[str],
+        max_items: int = 100,
+        start_from_beginning: bool = True,
+    ) -> tuple[List[dict], Optional[str]]:
+        """
+        Next media documents created or updated (feed "media") or tombstones
+        written (feed "tombstones"), in write order
+        The continuation is the sequence number of the last write returned.
+        """
+        if feed not in ("media", "tombstones"):
+            raise ValueError(f"Unknown change feed: '{feed}'")
+        with self._connection() as connection:
+            if continuation is not None:
+                after = int(continuation)
+            elif start_from_beginning:
+                after = 0
+            else:
+                after = connection.execute(
+                    "SELECT value FROM sequences WHERE name = 'media'"
+                ).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT seq, doc FROM {feed} WHERE seq > ? ORDER BY seq LIMIT ?",
+                (after, max_items),
+            ).fetchall()
+        changes = []
+        for seq, doc in rows:
+            change = json.loads(doc)
+            change["_lsn"] = seq
+            changes.append(change)
+        return changes, str(rows[-1][0] if rows else after)
+
+    def read_lease(self, lease_id: str) -> Optional[dict]:
+        """A change feed lease, with its _etag"""
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT version, doc FROM leases WHERE id = ?", (lease_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return {**json.loads(row[1]), "_etag": str(row[0])}
+
+    def write_lease(self, lease: dict, etag: Optional[str]) -> Optional[dict]:
+        """
+        Create a lease (etag None) or replace it if it still has the given etag
+
+        Returns:
+            dict | None: The stored lease, or None if another owner changed it first
+        """
+        doc = json.dumps({key: value for key, value in lease.items() if key != "_etag"})
+        with self._transaction() as connection:
+            if etag is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO leases (id, version, doc) VALUES (?, 1, ?) "
+                    "RETURNING version",
+                    (lease["id"], doc),
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE leases SET version = version + 1, doc = ? "
+                    "WHERE id = ? AND version = ? RETURNING version",
+                    (doc, lease["id"], int(etag)),
+                )
+            row = cursor.fetchone()
+        if not row:
+            return None
+        return {**lease, "_etag": str(row[0])}
+
+    # Views maintained by change feed projectors
+    def get_view(self, user_id: str, name: str) -> Optional[dict]:
+        """A view, with its _etag"""
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT version, doc FROM views WHERE user_id = ? AND name = ?",
+                (user_id, name),
+            ).fetchone()
+        if not row:
+            return None
+        return {**json.loads(row[1]), "_etag": str(row[0])}
+
+    def upsert_view(self, user_id: str, name: str, view: dict) -> dict:
+        body = {**view, "id": name, "userId": user_id}
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO views (user_id, name, doc) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, name) DO UPDATE SET "
+                "doc = excluded.doc, version = version + 1",
+                (user_id, name, json.dumps(body)),
+            )
+        return body
+
+    def write_view(
+        self, user_id: str, name: str, view: dict, etag: Optional[str]
+    ) -> Optional[dict]:
+        """
+        Create a view (etag None) or replace it if it still has the given etag
+
+        Returns:
+            dict | None: The stored view, or None if it was written by someone else first
+        """
+        body = {**view, "id": name, "userId": user_id}
+        with self._transaction() as connection:
+            if etag is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO views (user_id, name, version, doc) "
+                    "VALUES (?, ?, 1, ?) RETURNING version",
+                    (user_id, name, json.dumps(body)),
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE views SET version = version + 1, doc = ? "
+                    "WHERE user_id = ? AND name = ? AND version = ? RETURNING version",
+                    (json.dumps(body), user_id, name, int(etag)),
+                )
+            row = cursor.fetchone()
+        if not row:
+            return None
+        return {**body, "_etag": str(row[0])}
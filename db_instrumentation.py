@@ -0,0 +1,192 @@
+"""
+Data-layer instrumentation
+Each Cosmos DB call made by CosmosDBClient runs inside track(), which records
+its request charge (x-ms-request-charge), latency, item count and query shape
+per operation in the metrics registry, adds them to the totals of the HTTP
+request being served, and writes calls over the configured RU or latency
+thresholds to a structured slow-query log.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+from azure.core.paging import ItemPaged
+from starlette.datastructures import MutableHeaders
+from config import settings
+from tracing import current_span
+from metrics import (
+    DB_ITEMS_RETURNED,
+    DB_OPERATIONS,
+    DB_OPERATION_DURATION,
+    DB_REQUEST_CHARGE,
+    HTTP_REQUEST_CHARGE,
+    route_template,
+)
+import json
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger(f"{__name__}.slow")
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+
+
+def query_shape(query: str) -> str:
+    """Normalise a query for grouping: collapse whitespace, drop page offsets"""
+    shape = " ".join(query.split())
+    return re.sub(r"\b(OFFSET|LIMIT) \d+", r"\1 ?", shape)
+
+
+class RequestCost:
+    """Database cost accumulated while serving one HTTP request"""
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.request_charge = 0.0
+        self.calls = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, request_charge: float, duration: float):
+        # Calls may run concurrently in worker threads
+        with self._lock:
+            self.request_charge += request_charge
+            self.calls += 1
+            self.duration += duration
+
+
+# Set by RequestCostMiddleware; worker threads started with run_in_threadpool
+# inherit a copy of the context and so add to the same RequestCost
+_request_cost: ContextVar[Optional[RequestCost]] = ContextVar("request_cost", default=None)
+
+
+def current_request_cost() -> Optional[RequestCost]:
+    """Cost of the HTTP request being served, or None outside a request"""
+    return _request_cost.get()
+
+
+class TrackedCall:
+    """One data-layer call; pass .hook as the SDK response_hook"""
+
+    def __init__(self, operation: str, query: Optional[str] = None):
+        self.operation = operation
+        self.query = query
+        self.request_charge = 0.0
+        self.items = 0
+
+    def hook(self, headers, result):
+        # query_items also calls the hook once with the unstarted pager and the
+        # headers of whatever request the connection made last; skip that call
+        if isinstance(result, ItemPaged):
+            return
+        self.add_charge(headers)
+
+    def add_charge(self, headers):
+        if headers:
+            self.request_charge += float(headers.get(REQUEST_CHARGE_HEADER) or 0)
+
+
+@contextmanager
+def track(operation: str, query: Optional[str] = None) -> Iterator[TrackedCall]:
+    """
+    Record RU charge, latency and outcome of the data-layer call in the block
+
+    Usage:
+        with track("get_media_by_id") as call:
+            item = container.read_item(..., response_hook=call.hook)
+            call.items = 1
+    """
+    call = TrackedCall(operation, query)
+    status = "ok"
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        status_code = getattr(e, "status_code", None)
+        status = str(status_code) if status_code else type(e).__name__
+        # Failed calls are charged too (throttled requests included)
+        call.add_charge(getattr(e, "headers", None))
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        _record(call, status, duration)
+
+
+def _record(call: TrackedCall, status: str, duration: float):
+    DB_OPERATIONS.inc(operation=call.operation, status=status)
+    DB_OPERATION_DURATION.observe(duration, operation=call.operation)
+    DB_REQUEST_CHARGE.observe(call.request_charge, operation=call.operation)
+    if call.items:
+        DB_ITEMS_RETURNED.inc(call.items, operation=call.operation)
+
+    request_cost = _request_cost.get()
+    if request_cost is not None:
+        request_cost.add(call.request_charge, duration)
+
+    span = current_span()
+    if span is not None:
+        span.set("requestCharge", span.attributes.get("requestCharge", 0) + call.request_charge)
+        span.set("attempts", span.attributes.get("attempts", 0) + 1)
+
+    duration_ms = duration * 1000
+    if (
+        call.request_charge >= settings.slow_query_ru_threshold
+        or duration_ms >= settings.slow_query_ms_threshold
+    ):
+        slow_query_logger.warning(
+            json.dumps(
+                {
+                    "operation": call.operation,
+                    "status": status,
+                    "requestCharge": round(call.request_charge, 2),
+                    "durationMs": round(duration_ms, 1),
+                    "items": call.items,
+                    "query": query_shape(call.query) if call.query else None,
+                    "path": request_cost.path if request_cost else None,
+                }
+            )
+        )
+
+
+class RequestCostMiddleware:
+    """
+    ASGI middleware collecting the database cost of each request
+    The totals are returned in X-Request-Charge and Server-Timing headers and
+    recorded per route in the http_request_charge_ru histogram.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_cost = RequestCost(scope["path"])
+        token = _request_cost.set(request_cost)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and request_cost.calls:
+                headers = MutableHeaders(scope=message)
+                headers.append("X-Request-Charge", f"{request_cost.request_charge:.2f}")
+                headers.append(
+                    "Server-Timing",
+                    f'db;dur={request_cost.duration * 1000:.1f};'
+                    f'desc="{request_cost.calls} calls, {request_cost.request_charge:.2f} RU"',
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_cost.reset(token)
+            if request_cost.calls:
+                HTTP_REQUEST_CHARGE.observe(
+                    request_cost.request_charge,
+                    method=scope["method"],
+                    route=route_template(scope),
+                )
@@ -0,0 +1,36 @@
+"""
+Watermarks for delta sync (GET /media/changes)
+A watermark is the position of the last change a client has seen, encoded as
+an opaque token: Cosmos DB positions are (_ts, id), SQLite positions the
+write sequence number. Deletions are kept as tombstones for
+settings.tombstone_ttl_days; a watermark older than that may have missed
+some, and the client has to resync from scratch.
+"""
+
+from typing import List
+import base64
+import json
+
+
+class WatermarkExpiredError(Exception):
+    """The watermark predates the tombstones still kept"""
+
+
+def encode_watermark(position: List) -> str:
+    data = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_watermark(token: str) -> List:
+    """
+    Raises:
+        ValueError: If the token was not made by encode_watermark
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        position = json.loads(data)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid watermark: {e}") from e
+    if not isinstance(position, list) or not position:
+        raise ValueError("Invalid watermark")
+    return position
@@ -1,11 +1,32 @@
 #!/usr/bin/env python3
 """
 检查和修复数据库中的用户密码哈希
+按 id 分页流式扫描全部用户（每页一次键集查询，只取需要的字段），内存占用与
+用户总数无关。批量任务以有限并发执行，并以 bulk 优先级运行，不挤占线上请求
+的 RU 预算。每页处理完成后写入检查点，中断后加 --resume 从上次位置继续。
+
+离线无法重新计算哈希（没有明文密码）：outdated 的哈希在用户下次登录时由
+/api/auth/login 自动升级，check 只统计其数量。
+
+用法:
+    python fix_users.py [check]                    # 检查所有用户的密码哈希
+    python fix_users.py repair [--dry-run]         # 修复首尾带空白的哈希，报告无法恢复的
+    python fix_users.py fix <email> <new_password> # 修复单个用户（也可写作 --fix）
 """
-import sys
+import argparse
+import json
 import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+from auth import get_password_hash, pwd_context
 from database import cosmos_db
-from auth import get_password_hash
+from ru_limiter import bulk
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,66 +34,137 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BCRYPT_PATTERN = re.compile(r"^\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}$")
+# 哈希损坏的类别（outdated 仍可登录，下次登录时自动升级）
+BROKEN = ("empty", "too_long", "invalid_format", "whitespace")
+USER_FIELDS = ["email", "hashed_password"]
 
-def check_users():
-    """检查所有用户的密码哈希"""
-    logger.info("=" * 60)
-    logger.info("检查数据库中的用户...")
-    logger.info("=" * 60)
 
-    try:
-        # 初始化数据库
-        cosmos_db.initialize()
-
-        # 查询所有用户
-        query = "SELECT * FROM users u"
-        items = list(
-            cosmos_db.users_container.query_items(
-                query=query, enable_cross_partition_query=True
-            )
-        )
-
-        logger.info(f"\n找到 {len(items)} 个用户\n")
-
-        for user in items:
-            email = user.get("email", "未知")
-            hashed_password = user.get("hashed_password", "")
-
-            logger.info(f"用户: {email}")
-            logger.info(f"  用户ID: {user.get('id', '未知')}")
-            logger.info(f"  用户名: {user.get('username', '未知')}")
-            logger.info(f"  创建时间: {user.get('created_at', '未知')}")
-            logger.info(f"  密码哈希长度: {len(hashed_password)} 字节")
-
-            # 检查密码哈希格式
-            if not hashed_password:
-                logger.error(f"  ⚠️  警告: 密码哈希为空！")
-            elif len(hashed_password) > 200:
-                logger.error(f"  ⚠️  警告: 密码哈希过长 ({len(hashed_password)} 字节)！")
-            elif not hashed_password.startswith("$2b$"):
-                logger.warning(f"  ⚠️  警告: 密码哈希格式不正确（应以 $2b$ 开头）")
-            else:
-                logger.info(f"  ✓ 密码哈希格式正常")
-
-            logger.info("")
+def classify_hash(hashed_password: str) -> str:
+    """判断密码哈希的格式"""
+    if not hashed_password:
+        return "empty"
+    if len(hashed_password) > 200:
+        return "too_long"
+    if not BCRYPT_PATTERN.match(hashed_password):
+        if BCRYPT_PATTERN.match(hashed_password.strip()):
+            return "whitespace"
+        return "invalid_format"
+    if pwd_context.needs_update(hashed_password):
+        return "outdated"
+    return "ok"
 
-        return True
 
-    except Exception as e:
-        logger.error(f"检查失败: {e}", exc_info=True)
-        return False
+class Checkpoint:
+    """记录任务进度的 JSON 文件，原子写入"""
+
+    def __init__(self, path: str, job: str):
+        self.path = path
+        self.job = job
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("job") != self.job:
+            raise ValueError(f"检查点 {self.path} 属于任务 {state.get('job')}，不是 {self.job}")
+        return state
+
+    def save(self, position, counts: Counter):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"job": self.job, "position": position, "counts": counts}, f)
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_job(
+    job: str,
+    pages: Iterator[tuple[list, object]],
+    handle: Callable[[object], str],
+    concurrency: int,
+    checkpoint: Checkpoint,
+    counts: Counter,
+) -> Counter:
+    """
+    逐页处理：页内以 concurrency 个线程并发执行 handle，整页完成后再写检查点，
+    保证检查点之前的记录都已处理完
+    """
+    started = time.monotonic()
+    processed_at_start = sum(counts.values())
+
+    def handle_in_bulk(item) -> str:
+        with bulk():
+            try:
+                return handle(item)
+            except Exception as e:
+                logger.error(f"处理失败 {item}: {e}")
+                return "error"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, bulk():
+        for items, position in pages:
+            counts.update(executor.map(handle_in_bulk, items))
+            checkpoint.save(position, counts)
+
+            processed = sum(counts.values())
+            rate = (processed - processed_at_start) / max(time.monotonic() - started, 1e-6)
+            summary = ", ".join(f"{name}={count}" for name, count in sorted(counts.items()))
+            logger.info(f"[{job}] 已处理 {processed} 条 ({rate:.0f} 条/秒)  {summary}")
 
+    checkpoint.clear()
+    return counts
 
-def fix_user_password(email: str, new_password: str):
+
+def user_pages(after_id: Optional[str], page_size: int) -> Iterator[tuple[list, str]]:
+    """按 id 分页读取用户，位置为每页最后一个用户的 id"""
+    for page in cosmos_db.iter_users(page_size=page_size, after_id=after_id, fields=USER_FIELDS):
+        yield page, page[-1]["id"]
+
+
+def check_user(user: dict) -> str:
+    """检查一个用户，只为有问题的用户输出日志"""
+    kind = classify_hash(user.get("hashed_password", ""))
+    if kind in BROKEN:
+        logger.warning(f"  ⚠️  {user.get('email', '未知')} ({user['id']}): 密码哈希异常 [{kind}]")
+    return kind
+
+
+def make_repair(dry_run: bool) -> Callable[[dict], str]:
+    def repair_user(user: dict) -> str:
+        """
+        修复损坏的哈希：去掉首尾空白后有效的直接保存；其余无法恢复，
+        保持原样并报告，由管理员用 fix 为该用户设置新密码
+        """
+        hashed_password = user.get("hashed_password", "")
+        kind = classify_hash(hashed_password)
+        if kind not in BROKEN:
+            return kind
+
+        email = user.get("email", "未知")
+        if kind != "whitespace":
+            logger.warning(f"  ⚠️  无法自动修复 {email} ({user['id']}) [{kind}]，请使用 fix 重设密码")
+            return f"unrepairable_{kind}"
+        if dry_run:
+            logger.info(f"  [dry-run] 将修复 {email} [{kind}]")
+            return f"would_repair_{kind}"
+        cosmos_db.patch_user(user["id"], {"hashed_password": hashed_password.strip()})
+        logger.info(f"  ✓ 已修复 {email} [{kind}]")
+        return f"repaired_{kind}"
+
+    return repair_user
+
+
+def fix_user_password(email: str, new_password: str) -> bool:
     """修复用户密码"""
     logger.info("=" * 60)
     logger.info(f"修复用户密码: {email}")
     logger.info("=" * 60)
 
     try:
-        # 初始化数据库
-        cosmos_db.initialize()
-
         # 查找用户
         user = cosmos_db.get_user_by_email(email)
         if not user:
@@ -84,9 +176,8 @@ def fix_user_password(email: str, new_password: str):
         logger.info(f"新密码哈希长度: {len(new_hash)} 字节")
         logger.info(f"新密码哈希前缀: {new_hash[:10]}...")
 
-        # 更新用户
-        user["hashed_password"] = new_hash
-        cosmos_db.users_container.replace_item(item=user["id"], body=user)
+        # 只更新密码字段
+        cosmos_db.patch_user(user["id"], {"hashed_password": new_hash})
 
         logger.info(f"✓ 成功更新用户密码: {email}")
         return True
@@ -98,32 +189,70 @@ def fix_user_password(email: str, new_password: str):
 
 def main():
     """主函数"""
-    logger.info("用户密码诊断工具\n")
+    parser = argparse.ArgumentParser(description="用户密码诊断和批量修复工具")
+    subparsers = parser.add_subparsers(dest="job", required=True)
 
-    # 检查所有用户
-    success = check_users()
+    def add_batch_options(subparser):
+        subparser.add_argument("--page-size", type=int, default=500, help="每页条数")
+        subparser.add_argument("--concurrency", type=int, default=8, help="并发线程数")
+        subparser.add_argument("--checkpoint", help="检查点文件路径")
+        subparser.add_argument("--resume", action="store_true", help="从检查点继续")
 
-    if not success:
-        logger.error("\n❌ 检查失败")
+    add_batch_options(subparsers.add_parser("check", help="检查所有用户的密码哈希"))
+    repair_parser = subparsers.add_parser("repair", help="修复格式损坏的密码哈希")
+    add_batch_options(repair_parser)
+    repair_parser.add_argument("--dry-run", action="store_true", help="只输出将要修复的用户")
+    fix_parser = subparsers.add_parser("fix", help="修复单个用户的密码")
+    fix_parser.add_argument("email")
+    fix_parser.add_argument("new_password")
+    # 兼容旧用法：无参数即 check，--fix 即 fix
+    argv = sys.argv[1:] or ["check"]
+    if argv[0] == "--fix":
+        argv[0] = "fix"
+    args = parser.parse_args(argv)
+
+    if args.job == "fix":
+        return 0 if fix_user_password(args.email, args.new_password) else 1
+
+    checkpoint = Checkpoint(args.checkpoint or f".fix_users.{args.job}.checkpoint.json", args.job)
+    state = checkpoint.load() if args.resume else None
+    if state:
+        logger.info(f"从检查点继续: 位置 {state['position']}，已处理 {sum(state['counts'].values())} 条")
+    else:
+        checkpoint.clear()
+    position = state["position"] if state else None
+    counts = Counter(state["counts"] if state else {})
+
+    pages = user_pages(position, args.page_size)
+    handle = check_user if args.job == "check" else make_repair(args.dry_run)
+
+    logger.info("=" * 60)
+    logger.info(f"开始任务: {args.job}")
+    logger.info("=" * 60)
+    try:
+        counts = run_job(args.job, pages, handle, args.concurrency, checkpoint, counts)
+    except KeyboardInterrupt:
+        logger.warning(f"\n已中断，使用 --resume 从检查点 {checkpoint.path} 继续")
+        return 130
+    except Exception as e:
+        logger.error(f"任务失败: {e}，可使用 --resume 从检查点继续", exc_info=True)
         return 1
 
     logger.info("\n" + "=" * 60)
-    logger.info("检查完成")
+    logger.info("任务完成")
+    for name, count in sorted(counts.items()):
+        logger.info(f"  {name}: {count}")
     logger.info("=" * 60)
-    logger.info("\n如果发现问题用户，可以使用以下命令修复：")
-    logger.info("python fix_users.py --fix <email> <new_password>")
 
-    return 0
+    broken = sum(counts.get(kind, 0) for kind in BROKEN)
+    if args.job == "check" and broken:
+        logger.info(f"\n发现 {broken} 个问题用户，可以使用以下命令修复：")
+        logger.info("python fix_users.py repair [--dry-run]")
+        logger.info("python fix_users.py fix <email> <new_password>")
+    if args.job == "check" and counts.get("outdated"):
+        logger.info(f"\n{counts['outdated']} 个用户的哈希参数已过时，将在其下次登录时自动升级")
+    return 1 if counts.get("error") else 0
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == "--fix":
-        if len(sys.argv) < 4:
-            logger.error("用法: python fix_users.py --fix <email> <new_password>")
-            sys.exit(1)
-        email = sys.argv[2]
-        password = sys.argv[3]
-        success = fix_user_password(email, password)
-        sys.exit(0 if success else 1)
-    else:
-        sys.exit(main())
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Hedged requests
+A hedged call is sent once and, if it has not answered within the recent
+latency percentile of its operation, sent a second time; whichever attempt
+finishes first wins and the other is left to complete in the background.
+Hedges are drawn from a global budget that grows with the number of hedged
+calls, so at most settings.hedging_budget_percent extra requests are sent
+even when the backend is slow across the board.
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, TypeVar
+from config import settings
+from metrics import HEDGE_CALLS, HEDGE_DELAY, HEDGE_SENT, HEDGE_WINS
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Latencies kept per operation, and how often the percentile is recomputed
+LATENCY_WINDOW = 1000
+RECOMPUTE_EVERY = 50
+# Hedging starts once an operation has this many samples
+MIN_SAMPLES = 20
+# Most hedges that may be banked while traffic is quiet
+MAX_BUDGET_TOKENS = 10.0
+# Attempts block on network I/O, so the pool is sized for concurrency, not CPUs
+MAX_THREADS = 64
+
+
+class LatencyTracker:
+    """Sliding window of an operation's latencies and its hedge delay"""
+
+    def __init__(self):
+        self._samples = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._since_recompute = 0
+        self.delay = None
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            self._since_recompute += 1
+            if len(self._samples) < MIN_SAMPLES:
+                return
+            if self.delay is not None and self._since_recompute < RECOMPUTE_EVERY:
+                return
+            self._since_recompute = 0
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * settings.hedging_percentile / 100))
+        self.delay = max(ordered[index], settings.hedging_min_delay_ms / 1000)
+
+
+class HedgeBudget:
+    """Each hedged call earns a fraction of a token; each hedge spends one"""
+
+    def __init__(self):
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(
+                MAX_BUDGET_TOKENS, self._tokens + settings.hedging_budget_percent / 100
+            )
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+_trackers_lock = threading.Lock()
+_budget = HedgeBudget()
+# Losing attempts keep their thread until they return
+_executor = ThreadPoolExecutor(max_workers=MAX_THREADS, thread_name_prefix="hedge")
+
+
+def _tracker(operation: str) -> LatencyTracker:
+    tracker = _trackers.get(operation)
+    if tracker is None:
+        with _trackers_lock:
+            tracker = _trackers.setdefault(operation, LatencyTracker())
+    return tracker
+
+
+def _attempt(tracker: LatencyTracker, call: Callable[[], T]) -> T:
+    # Every attempt is timed, losers included, so hedging does not hide the
+    # tail it is measuring
+    started = time.perf_counter()
+    try:
+        return call()
+    finally:
+        tracker.observe(time.perf_counter() - started)
+
+
+def _submit(tracker: LatencyTracker, call: Callable[[], T]) -> Future:
+    # Each attempt runs in its own copy of the caller's context, so request
+    # accounting (db_instrumentation) still sees it
+    return _executor.submit(contextvars.copy_context().run, _attempt, tracker, call)
+
+
+def hedged(operation: str, call: Callable[[], T]) -> T:
+    """
+    Run call(), issuing a second identical call if the first is slow
+
+    call must be idempotent. The first attempt to finish, successfully or
+    not, decides the result. Without settings.hedging_enabled this is a
+    plain call.
+    """
+    if not settings.hedging_enabled:
+        return call()
+
+    tracker = _tracker(operation)
+    _budget.earn()
+    HEDGE_CALLS.inc(operation=operation)
+
+    if tracker.delay is None:
+        # Not enough history for a delay yet
+        return _attempt(tracker, call)
+
+    HEDGE_DELAY.set(tracker.delay, operation=operation)
+    primary = _submit(tracker, call)
+    done, _ = wait([primary], timeout=tracker.delay)
+    if done or not _budget.try_spend():
+        return primary.result()
+
+    HEDGE_SENT.inc(operation=operation)
+    hedge = _submit(tracker, call)
+    done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+    # Prefer the primary if both finished by the time we woke up
+    winner = primary if primary in done else hedge
+    if winner is hedge:
+        HEDGE_WINS.inc(operation=operation)
+    return winner.result()
@@ -0,0 +1,170 @@
+"""
+Cosmos DB indexing policies managed by the application
+The definitions here are the source of truth for the users, media and
+tombstones containers; bump INDEXING_POLICY_VERSION whenever a policy changes.
+"""
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.database import DatabaseProxy
+from typing import List
+import logging
+
+logger = logging.getLogger(__name__)
+
+# v1: default index-everything policy plus composite indexes
+# v2: index only queried paths, composite (userId, mediaType, uploadedAt DESC)
+# v3: fileName and thumbnailFileName, for the orphan blob reconciler
+# v4: composite (userId, _ts, id) on media and tombstones, for delta sync
+INDEXING_POLICY_VERSION = 4
+
+# Equality filters that have a composite index on the media container. Each
+# entry is indexed as (userId ASC, *fields ASC, uploadedAt DESC) so filtered
+# listings sorted by upload time are served from the index.
+MEDIA_COMPOSITE_INDEX_FILTERS = [
+    (),
+    ("mediaType",),
+    ("orientation",),
+    ("mediaType", "orientation"),
+    ("cameraModel",),
+]
+
+
+def _composite_index(fields: tuple) -> List[dict]:
+    """Build a composite index definition for the given equality fields"""
+    paths = [{"path": "/userId", "order": "ascending"}]
+    paths += [{"path": f"/{field}", "order": "ascending"} for field in fields]
+    paths.append({"path": "/uploadedAt", "order": "descending"})
+    return paths
+
+
+# Keyset order of GET /media/changes: modification time, then id
+CHANGES_COMPOSITE_INDEX = [
+    {"path": "/userId", "order": "ascending"},
+    {"path": "/_ts", "order": "ascending"},
+    {"path": "/id", "order": "ascending"},
+]
+
+USERS_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [{"path": "/email/?"}],
+    "excludedPaths": [{"path": "/*"}, {"path": '/"_etag"/?'}],
+}
+
+# blobUrl, thumbnailUrl and description are never filtered through the index
+# (search scans them inside a single userId partition), so they are excluded
+# to keep write RUs down.
+MEDIA_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [
+        {"path": "/userId/?"},
+        {"path": "/mediaType/?"},
+        {"path": "/uploadedAt/?"},
+        {"path": "/originalFileName/?"},
+        {"path": "/tags/[]/?"},
+        {"path": "/orientation/?"},
+        {"path": "/cameraModel/?"},
+        {"path": "/width/?"},
+        {"path": "/height/?"},
+        {"path": "/capturedAt/?"},
+        {"path": "/fileName/?"},
+        {"path": "/thumbnailFileName/?"},
+        {"path": "/_ts/?"},
+    ],
+    "excludedPaths": [{"path": "/*"}, {"path": '/"_etag"/?'}],
+    "compositeIndexes": [
+        _composite_index(fields) for fields in MEDIA_COMPOSITE_INDEX_FILTERS
+    ]
+    + [CHANGES_COMPOSITE_INDEX],
+}
+
+# Deletion tombstones are only read back by GET /media/changes
+TOMBSTONES_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [{"path": "/userId/?"}, {"path": "/_ts/?"}],
+    "excludedPaths": [{"path": "/*"}, {"path": '/"_etag"/?'}],
+    "compositeIndexes": [CHANGES_COMPOSITE_INDEX],
+}
+
+# Container id -> (partition key path, indexing policy)
+CONTAINER_POLICIES = {
+    "users": ("/id", USERS_INDEXING_POLICY),
+    "media": ("/userId", MEDIA_INDEXING_POLICY),
+    "tombstones": ("/userId", TOMBSTONES_INDEXING_POLICY),
+}
+
+
+def _normalize(policy: dict) -> dict:
+    """Reduce a policy to the parts we manage, in a comparable form"""
+    return {
+        "indexingMode": policy.get("indexingMode", "consistent").lower(),
+        "includedPaths": sorted(p["path"] for p in policy.get("includedPaths", [])),
+        "excludedPaths": sorted(p["path"] for p in policy.get("excludedPaths", [])),
+        "compositeIndexes": sorted(
+            [(p["path"], p.get("order", "ascending")) for p in index]
+            for index in policy.get("compositeIndexes", [])
+        ),
+    }
+
+
+def policy_diff(current: dict, desired: dict) -> dict:
+    """
+    Compare two indexing policies
+
+    Returns:
+        dict: Managed keys that differ, mapped to (current, desired)
+    """
+    current_norm = _normalize(current)
+    desired_norm = _normalize(desired)
+    return {
+        key: (current_norm[key], desired_norm[key])
+        for key in desired_norm
+        if current_norm[key] != desired_norm[key]
+    }
+
+
+def apply_indexing_policy(database: DatabaseProxy, container_id: str) -> bool:
+    """
+    Migrate a container to the indexing policy defined for it
+
+    Returns:
+        bool: True if the policy was replaced, False if already current
+    """
+    partition_key_path, desired = CONTAINER_POLICIES[container_id]
+    container = database.get_container_client(container_id)
+    properties = container.read()
+    current = properties.get("indexingPolicy", {})
+
+    diff = policy_diff(current, desired)
+    if not diff:
+        logger.info(
+            f"Indexing policy for '{container_id}' is current (v{INDEXING_POLICY_VERSION})"
+        )
+        return False
+
+    database.replace_container(
+        container,
+        partition_key=PartitionKey(path=partition_key_path),
+        indexing_policy=desired,
+        # Replacing a container resets settings that are not passed again
+        default_ttl=properties.get("defaultTtl"),
+    )
+    logger.info(
+        f"Migrated indexing policy for '{container_id}' to v{INDEXING_POLICY_VERSION} "
+        f"(changed: {', '.join(diff)})"
+    )
+    return True
+
+
+def index_transformation_progress(database: DatabaseProxy, container_id: str) -> int:
+    """Return the index transformation progress of a container (0-100)"""
+    container = database.get_container_client(container_id)
+    headers = {}
+    container.read(
+        populate_quota_info=True,
+        response_hook=lambda response_headers, _: headers.update(response_headers),
+    )
+    progress = headers.get("x-ms-documentdb-collection-index-transformation-progress")
+    return int(progress) if progress is not None else 100
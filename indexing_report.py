@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Report the RU cost of representative operations before and after
+migrating the containers to the indexing policy in indexing_policy.py
+
+Usage:
+    python indexing_report.py            # show policy diff and current RU costs
+    python indexing_report.py --apply    # migrate, then compare before/after
+"""
+import argparse
+import logging
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from database import _media_order_by, cosmos_db
+from db_instrumentation import TrackedCall
+from indexing_policy import (
+    CONTAINER_POLICIES,
+    INDEXING_POLICY_VERSION,
+    apply_indexing_policy,
+    index_transformation_progress,
+    policy_diff,
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+PROBE_USER_ID = "__indexing_report__"
+
+
+def _probe_media_document() -> dict:
+    """A media document shaped like a real upload, with long URL fields"""
+    now = datetime.utcnow().isoformat()
+    blob_name = f"{PROBE_USER_ID}/{uuid.uuid4().hex}.jpg"
+    url = f"https://account.blob.core.windows.net/media-files/{blob_name}?" + "sig" * 60
+    return {
+        "id": str(uuid.uuid4()),
+        "userId": PROBE_USER_ID,
+        "fileName": blob_name,
+        "originalFileName": "IMG_0001.jpg",
+        "mediaType": "image",
+        "fileSize": 2_483_112,
+        "mimeType": "image/jpeg",
+        "blobUrl": url,
+        "thumbnailUrl": url,
+        "description": "Sunset over the harbour, shot from the north pier " * 8,
+        "tags": ["sunset", "harbour", "holiday"],
+        "width": 4032,
+        "height": 3024,
+        "orientation": "landscape",
+        "capturedAt": now,
+        "cameraModel": "Pixel 7",
+        "uploadedAt": now,
+        "updatedAt": now,
+    }
+
+
+def measure_charges() -> dict:
+    """Run representative operations against the media container"""
+    container = cosmos_db.media_container
+    charges = {}
+
+    def record(name, call):
+        tracked = TrackedCall(name)
+        result = call(tracked.hook)
+        charges[name] = round(tracked.request_charge, 2)
+        return result
+
+    document = _probe_media_document()
+    record("create", lambda hook: container.create_item(body=document, response_hook=hook))
+    document["description"] = document["description"].upper()
+    record("replace", lambda hook: container.replace_item(
+        item=document["id"], body=document, response_hook=hook
+    ))
+
+    parameters = [
+        {"name": "@userId", "value": PROBE_USER_ID},
+        {"name": "@mediaType", "value": "image"},
+    ]
+    # Ordered as get_user_media orders them, so they use the same composite indexes
+    queries = {
+        "list": "SELECT * FROM media m WHERE m.userId = @userId "
+        f"{_media_order_by([])} OFFSET 0 LIMIT 20",
+        "list_by_type": "SELECT * FROM media m WHERE m.userId = @userId "
+        "AND m.mediaType = @mediaType "
+        f"{_media_order_by(['mediaType'])} OFFSET 0 LIMIT 20",
+        "count_by_type": "SELECT VALUE COUNT(1) FROM media m WHERE m.userId = @userId "
+        "AND m.mediaType = @mediaType",
+    }
+    for name, query in queries.items():
+        record(name, lambda hook: list(container.query_items(
+            query=query, parameters=parameters, response_hook=hook
+        )))
+
+    record("delete", lambda hook: container.delete_item(
+        item=document["id"], partition_key=PROBE_USER_ID, response_hook=hook
+    ))
+    return charges
+
+
+def wait_for_transformation(container_id: str, timeout_seconds: int):
+    """Block until the index transformation for a container has finished"""
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        progress = index_transformation_progress(cosmos_db.database, container_id)
+        logger.info(f"Index transformation for '{container_id}': {progress}%")
+        if progress >= 100 or time.monotonic() > deadline:
+            return
+        time.sleep(5)
+
+
+def print_report(before: dict, after: dict):
+    logger.info(f"{'operation':<16}{'before RU':>12}{'after RU':>12}{'delta':>10}")
+    for name, charge in before.items():
+        new_charge = after.get(name, charge)
+        delta = (new_charge - charge) / charge * 100 if charge else 0.0
+        logger.info(f"{name:<16}{charge:>12.2f}{new_charge:>12.2f}{delta:>9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--apply", action="store_true", help="migrate the containers")
+    parser.add_argument(
+        "--timeout", type=int, default=600,
+        help="seconds to wait for index transformation after --apply",
+    )
+    args = parser.parse_args()
+
+    pending = []
+    for container_id, (_, desired) in CONTAINER_POLICIES.items():
+        current = cosmos_db.database.get_container_client(container_id).read()
+        diff = policy_diff(current.get("indexingPolicy", {}), desired)
+        if diff:
+            pending.append(container_id)
+        for key, (old, new) in diff.items():
+            logger.info(f"[{container_id}] {key}: {old} -> {new}")
+
+    logger.info(f"Target indexing policy version: v{INDEXING_POLICY_VERSION}")
+    before = measure_charges()
+
+    if not args.apply or not pending:
+        print_report(before, before)
+        return 0
+
+    for container_id in pending:
+        apply_indexing_policy(cosmos_db.database, container_id)
+        wait_for_transformation(container_id, args.timeout)
+
+    after = measure_charges()
+    print_report(before, after)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Export of a user's library as a streamed ZIP archive
+Media documents are paged from the database and their blobs streamed from
+storage chunk by chunk straight into the archive; nothing is buffered whole or
+written to disk. While one blob is being sent, the next ones are already
+downloading into small bounded queues, so the export runs at network speed
+with memory use independent of file and library size.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+from config import settings
+from database import cosmos_db
+from storage import blob_storage
+from zip_stream import stream_zip
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Chunks a prefetched blob may hold before its download waits for the sender
+CHUNKS_PER_BLOB = 2
+# Name of the entry listing files that could not be read
+MISSING_FILES_ENTRY = "missing-files.txt"
+
+_END = object()
+
+
+class BlobPrefetcher:
+    """
+    Download the blobs of a sequence of media documents ahead of their use
+
+    Iterating yields (document, chunks) pairs in order. Up to depth blobs are
+    in flight at once; each keeps at most CHUNKS_PER_BLOB chunks in memory.
+    """
+
+    def __init__(self, documents: Iterable[dict], depth: int):
+        self._documents = iter(documents)
+        self._depth = max(1, depth)
+        self._executor = ThreadPoolExecutor(max_workers=self._depth, thread_name_prefix="export")
+        self._closed = threading.Event()
+
+    def close(self):
+        """Stop every download; safe to call from any thread, more than once"""
+        self._closed.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _put(self, chunks: queue.Queue, value) -> bool:
+        while not self._closed.is_set():
+            try:
+                chunks.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, chunks: queue.Queue):
+        while not self._closed.is_set():
+            try:
+                return chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise RuntimeError("Export was closed")
+
+    def _download(self, blob_name: str, chunks: queue.Queue):
+        try:
+            for chunk in blob_storage.iter_file(blob_name):
+                if not self._put(chunks, chunk):
+                    return
+            self._put(chunks, _END)
+        except Exception as e:
+            self._put(chunks, e)
+
+    def _start(self, pending: deque) -> bool:
+        document = next(self._documents, None)
+        if document is None:
+            return False
+        chunks = queue.Queue(maxsize=CHUNKS_PER_BLOB)
+        self._executor.submit(self._download, document["fileName"], chunks)
+        pending.append((document, chunks))
+        return True
+
+    def _drain(self, chunks: queue.Queue, first) -> Iterator[bytes]:
+        value = first
+        while value is not _END:
+            if isinstance(value, Exception):
+                raise value
+            yield value
+            value = self._get(chunks)
+
+    def __iter__(self) -> Iterator[tuple[dict, Optional[Iterator[bytes]]]]:
+        """
+        Yields:
+            tuple: (document, chunks), with chunks None if the blob could not
+            be read at all; an error after the first chunk is raised from chunks
+        """
+        pending = deque()
+        try:
+            while len(pending) < self._depth and self._start(pending):
+                pass
+            while pending:
+                document, chunks = pending.popleft()
+                # Peek, so a missing blob is skipped rather than half-written
+                first = self._get(chunks)
+                if isinstance(first, Exception):
+                    logger.warning(f"Export skipped {document['fileName']}: {first}")
+                    yield document, None
+                else:
+                    yield document, self._drain(chunks, first)
+                self._start(pending)
+        finally:
+            self.close()
+
+
+def _modified(document: dict) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(document.get("capturedAt") or document["uploadedAt"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def export_files(
+    prefetcher: BlobPrefetcher,
+) -> Iterator[tuple[str, Optional[datetime], Iterable[bytes]]]:
+    missing: List[str] = []
+    for document, chunks in prefetcher:
+        name = document.get("originalFileName") or document["id"]
+        if chunks is None:
+            missing.append(name)
+            continue
+        yield name, _modified(document), chunks
+    if missing:
+        listing = "Files that could not be read when this archive was created:\n"
+        listing += "".join(f"{name}\n" for name in missing)
+        yield MISSING_FILES_ENTRY, datetime.utcnow(), [listing.encode("utf-8")]
+
+
+def export_archive(prefetcher: BlobPrefetcher) -> Iterator[bytes]:
+    """The ZIP archive of the prefetcher's documents, as a stream of byte strings"""
+    try:
+        yield from stream_zip(export_files(prefetcher))
+    finally:
+        prefetcher.close()
+
+
+def library_prefetcher(
+    user_id: str, media_type: Optional[str] = None, tag: Optional[str] = None
+) -> BlobPrefetcher:
+    documents = cosmos_db.iter_user_media(user_id, media_type=media_type, tag=tag)
+    return BlobPrefetcher(documents, settings.export_prefetch_blobs)
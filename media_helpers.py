@@ -4,6 +4,7 @@ Provides common validation and verification logic
 """
 
 from fastapi import HTTPException, status
+from urllib.parse import unquote, urlparse
 from database import cosmos_db
 import logging
 
@@ -77,16 +78,19 @@ def extract_thumbnail_blob_identifier(media_document: dict) -> str | None:
     Returns:
         str | None: The thumbnail blob name or None if not applicable
     """
+    if media_document.get("thumbnailFileName"):
+        return media_document["thumbnailFileName"]
     if not media_document.get("thumbnailUrl"):
         return None
 
+    # Documents from before thumbnailFileName was stored: the blob name,
+    # '<user_id>/<file>', ends the thumbnail URL's path
     try:
-        original_filename = media_document["originalFileName"].split("/")[-1]
-        thumbnail_identifier = media_document["fileName"].replace(
-            original_filename,
-            f"thumb_{original_filename}"
-        )
-        return thumbnail_identifier
+        path = unquote(urlparse(media_document["thumbnailUrl"]).path)
+        start = path.rfind(f"/{media_document['userId']}/")
+        if start < 0:
+            raise ValueError(f"no user prefix in '{path}'")
+        return path[start + 1:]
     except Exception as e:
         logger.warning(f"Unable to extract thumbnail identifier: {e}")
         return None
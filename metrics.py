@@ -0,0 +1,429 @@
+"""
+Prometheus-style metrics
+A small in-process registry (counters, gauges and histograms with labels)
+rendered in the Prometheus text exposition format by GET /api/metrics, plus
+the ASGI middleware and event-loop lag sampler that feed it. Each
+observation is a dict lookup and a bisect under a lock, cheap enough to
+leave on in production. Metrics are kept per process; with
+settings.metrics_multiprocess_dir set, each worker saves a snapshot there
+every few seconds and a scrape of any worker sums the counters and
+histograms of all of them, labelling gauges with the worker's pid.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Size buckets in bytes (64 KB .. 1 GB)
+SIZE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+# Cosmos DB request unit buckets
+RU_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+# How often workers save their snapshot, and how long a worker that stopped
+# saving keeps its gauges in the aggregate
+SNAPSHOT_INTERVAL_SECONDS = 5
+SNAPSHOT_STALE_SECONDS = 3 * SNAPSHOT_INTERVAL_SECONDS
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self, items: Optional[list] = None, labelnames: Optional[tuple] = None) -> List[str]:
+        """Exposition lines for this process, or for snapshot items merged from several"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self._samples(
+            self.snapshot() if items is None else items, labelnames or self.labelnames
+        ))
+        return lines
+
+    def snapshot(self) -> list:
+        """[label values, state] per series, as JSON-serialisable lists"""
+        raise NotImplementedError
+
+    def merge(self, snapshots: List[list]) -> list:
+        """Sum the series of several processes' snapshots"""
+        raise NotImplementedError
+
+    def _samples(self, items: list, labelnames: tuple) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, snapshots):
+        totals: Dict[Tuple[str, ...], float] = {}
+        for items in snapshots:
+            for key, value in items:
+                totals[tuple(key)] = totals.get(tuple(key), 0) + value
+        return [[list(key), value] for key, value in totals.items()]
+
+    def _samples(self, items, labelnames):
+        return [
+            f"{self.name}{_format_labels(labelnames, tuple(key))} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of the block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(series[0]), series[1], series[2]]]
+                    for key, series in self._series.items()]
+
+    def merge(self, snapshots):
+        totals: Dict[Tuple[str, ...], list] = {}
+        for items in snapshots:
+            for key, (counts, total, count) in items:
+                series = totals.setdefault(tuple(key), [[0] * len(counts), 0.0, 0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+        return [[list(key), series] for key, series in totals.items()]
+
+    def _samples(self, items, labelnames):
+        lines = []
+        for key, (counts, total, count) in items:
+            key = tuple(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labelnames, key, le)} {cumulative}"
+                )
+            labels = _format_labels(labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicate metric: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, list]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def render(
+        self, snapshots: Optional[Dict[str, Dict[str, list]]] = None, live: tuple = ()
+    ) -> str:
+        """
+        Text exposition of this process's metrics, or of the snapshots of
+        several processes (keyed by pid): counters and histograms are summed,
+        and the gauges of the live processes are reported with a pid label
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            if snapshots is None:
+                lines.extend(metric.render())
+            elif isinstance(metric, Gauge):
+                items = [
+                    [key + [pid], value]
+                    for pid in live
+                    for key, value in snapshots[pid].get(metric.name, [])
+                ]
+                lines.extend(metric.render(items, metric.labelnames + ("pid",)))
+            else:
+                merged = metric.merge([
+                    snapshot.get(metric.name, []) for snapshot in snapshots.values()
+                ])
+                lines.extend(metric.render(merged))
+        return "\n".join(lines) + "\n"
+
+
+# Global registry and application metrics
+registry = Registry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route and status",
+    ("method", "route", "status"),
+)
+HTTP_REQUESTS_IN_FLIGHT = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being served"
+)
+UPLOAD_BYTES = registry.histogram(
+    "media_upload_bytes", "Size of uploaded media files", ("media_type",), SIZE_BUCKETS
+)
+UPLOAD_DURATION = registry.histogram(
+    "media_upload_duration_seconds", "Time to store an upload end to end", ("media_type",)
+)
+TRACES_DROPPED = registry.counter(
+    "traces_dropped_total", "Finished traces dropped because the export queue was full"
+)
+RATE_LIMITED = registry.counter(
+    "rate_limited_requests_total", "Requests refused by per-user rate limits", ("budget",)
+)
+UPLOADS_REJECTED = registry.counter(
+    "media_uploads_rejected_total", "Uploads refused before their body was ingested", ("reason",)
+)
+THUMBNAIL_DURATION = registry.histogram(
+    "thumbnail_generation_seconds", "Time spent generating thumbnails"
+)
+EVENT_LOOP_LAG = registry.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop in running a scheduled wakeup"
+)
+DB_OPERATIONS = registry.counter(
+    "db_operations_total", "Data-layer calls by operation and outcome", ("operation", "status")
+)
+DB_OPERATION_DURATION = registry.histogram(
+    "db_operation_duration_seconds", "Data-layer call latency by operation", ("operation",)
+)
+DB_REQUEST_CHARGE = registry.histogram(
+    "db_request_charge_ru", "Cosmos DB request units consumed per call", ("operation",),
+    RU_BUCKETS,
+)
+DB_ITEMS_RETURNED = registry.counter(
+    "db_items_returned_total", "Documents returned by data-layer calls", ("operation",)
+)
+DB_THROTTLED = registry.counter(
+    "db_throttled_total", "Cosmos DB 429 responses by container", ("container",)
+)
+DB_BUDGET_RATE = registry.gauge(
+    "db_ru_budget_rate", "Current client-side RU/s refill rate by container", ("container",)
+)
+DB_BUDGET_WAIT = registry.histogram(
+    "db_ru_budget_wait_seconds", "Time calls waited for RU budget by priority", ("priority",)
+)
+SINGLEFLIGHT_CALLS = registry.counter(
+    "db_singleflight_calls_total",
+    "Coalescable reads: leaders sent a request, followers shared one in flight",
+    ("operation", "role"),
+)
+HEDGE_CALLS = registry.counter(
+    "hedge_calls_total", "Calls made through the hedging policy", ("operation",)
+)
+HEDGE_SENT = registry.counter(
+    "hedge_requests_total", "Second requests sent because the first was slow", ("operation",)
+)
+HEDGE_WINS = registry.counter(
+    "hedge_wins_total", "Hedge requests that answered before the original", ("operation",)
+)
+HEDGE_DELAY = registry.gauge(
+    "hedge_delay_seconds", "Current delay before a hedge is sent", ("operation",)
+)
+HTTP_REQUEST_CHARGE = registry.histogram(
+    "http_request_charge_ru", "Cosmos DB request units consumed per HTTP request",
+    ("method", "route"), RU_BUCKETS,
+)
+
+
+# id(app) -> {endpoint: path template}
+_route_paths: Dict[int, dict] = {}
+
+
+def route_template(scope) -> str:
+    """Path template of the route that handled a request, e.g. /api/media/{media_id}"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    app = scope["app"]
+    paths = _route_paths.get(id(app))
+    if paths is None:
+        # Starlette records the matched endpoint, not its path template
+        paths = _route_paths[id(app)] = {
+            getattr(route, "endpoint", None): route.path
+            for route in app.routes
+            if hasattr(route, "path")
+        }
+    return paths.get(endpoint, "unmatched")
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=route_template(scope),
+                status=status_code,
+            )
+
+
+async def sample_event_loop_lag(interval: float = 0.25):
+    """Measure how late the loop wakes up from a timed sleep, forever"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+def write_snapshot(directory: str):
+    """Save this process's metrics for render_all() in the other workers"""
+    path = Path(directory) / f"{os.getpid()}.json"
+    temporary = path.with_suffix(".tmp")
+    temporary.write_text(json.dumps(registry.snapshot()))
+    os.replace(temporary, path)
+
+
+def render_all(directory: str) -> str:
+    """
+    Metrics of every worker that saved a snapshot in directory
+    Snapshots of workers that have exited are kept, so counters do not go
+    back when a worker is recycled; server.py empties the directory at start.
+    """
+    write_snapshot(directory)
+    snapshots, live = {}, []
+    for path in Path(directory).glob("*.json"):
+        try:
+            age = time.time() - path.stat().st_mtime
+            snapshots[path.stem] = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # Removed since the listing
+            continue
+        if age < SNAPSHOT_STALE_SECONDS:
+            live.append(path.stem)
+    return registry.render(snapshots, tuple(sorted(live)))
+
+
+async def export_snapshots(directory: str):
+    """Save this process's snapshot every few seconds, forever"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, write_snapshot, directory)
+        except OSError as e:
+            logger.warning(f"Could not save metrics snapshot: {e}")
+        await asyncio.sleep(SNAPSHOT_INTERVAL_SECONDS)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, Field, validator
-from typing import Optional, List
+from typing import Dict, Optional, List
 from datetime import datetime
 
 
@@ -62,6 +62,15 @@ class MediaResponse(MediaBase):
     mime_type: str = Field(alias="mimeType")
     blob_url: str = Field(alias="blobUrl")
     thumbnail_url: Optional[str] = Field(None, alias="thumbnailUrl")
+    width: Optional[int] = None
+    height: Optional[int] = None
+    orientation: Optional[str] = None
+    captured_at: Optional[datetime] = Field(None, alias="capturedAt")
+    camera_model: Optional[str] = Field(None, alias="cameraModel")
+    duration_seconds: Optional[float] = Field(None, alias="durationSeconds")
+    video_codec: Optional[str] = Field(None, alias="videoCodec")
+    audio_codec: Optional[str] = Field(None, alias="audioCodec")
+    perceptual_hash: Optional[str] = Field(None, alias="perceptualHash")
     uploaded_at: datetime = Field(alias="uploadedAt")
     updated_at: datetime = Field(alias="updatedAt")
 
@@ -79,6 +88,16 @@ class MediaInDB(BaseModel):
     mime_type: str
     blob_url: str
     thumbnail_url: Optional[str] = None
+    thumbnail_file_name: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    orientation: Optional[str] = None
+    captured_at: Optional[datetime] = None
+    camera_model: Optional[str] = None
+    duration_seconds: Optional[float] = None
+    video_codec: Optional[str] = None
+    audio_codec: Optional[str] = None
+    perceptual_hash: Optional[str] = None
     description: Optional[str] = None
     tags: Optional[List[str]] = None
     uploaded_at: datetime
@@ -95,6 +114,89 @@ class MediaListResponse(BaseModel):
         populate_by_name = True
 
 
+class SimilarMedia(BaseModel):
+    item: MediaResponse
+    distance: int
+
+
+class SimilarMediaResponse(BaseModel):
+    items: List[SimilarMedia]
+
+
+class DuplicateGroup(BaseModel):
+    items: List[MediaResponse]
+
+
+class DuplicateReportResponse(BaseModel):
+    groups: List[DuplicateGroup]
+    total: int
+
+
+class TagCount(BaseModel):
+    tag: str
+    count: int
+
+
+class TagListResponse(BaseModel):
+    items: List[TagCount]
+
+
+class MediaTypeStats(BaseModel):
+    count: int
+    bytes: int
+
+
+class MediaOverviewResponse(BaseModel):
+    count: int
+    bytes: int
+    by_type: Dict[str, MediaTypeStats] = Field(alias="byType")
+    recent: List[MediaResponse]
+    updated_at: Optional[datetime] = Field(None, alias="updatedAt")
+
+    class Config:
+        populate_by_name = True
+
+
+class DeletedMedia(BaseModel):
+    id: str
+    deleted_at: datetime = Field(alias="deletedAt")
+
+    class Config:
+        populate_by_name = True
+
+
+class MediaChangesResponse(BaseModel):
+    items: List[MediaResponse]
+    deleted: List[DeletedMedia]
+    next: str
+    has_more: bool = Field(alias="hasMore")
+
+    class Config:
+        populate_by_name = True
+
+
+class ProfileSummary(BaseModel):
+    id: str
+    method: str
+    path: str
+    route: str
+    trigger: str
+    status_code: Optional[int] = Field(None, alias="statusCode")
+    started_at: datetime = Field(alias="startedAt")
+    duration_ms: float = Field(alias="durationMs")
+    interval_ms: float = Field(alias="intervalMs")
+    samples: int
+    truncated: bool
+    breakdown_ms: Dict[str, float] = Field(alias="breakdownMs")
+
+    class Config:
+        populate_by_name = True
+
+
+class ProfileListResponse(BaseModel):
+    items: List[ProfileSummary]
+
+
 # Error Models
 class ErrorDetail(BaseModel):
     code: str
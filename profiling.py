@@ -0,0 +1,358 @@
+"""
+On-demand request profiling
+A request is profiled when settings.profiling_enabled is on and either it
+carries an X-Profile header with a bearer token of one of
+settings.profiling_user_ids, or it is picked at random at
+settings.profiling_sample_rate. While it runs, a sampler thread records every
+settings.profiling_interval_ms the stacks of the threads working on it: the
+event loop thread while the request's task is the one running, and worker
+threads while they run a call the request handed to run_in_threadpool (use
+the one from this module). Samples are classified by the innermost Cosmos DB,
+Blob Storage, SQLite, local storage or Pillow frame on the stack, so the
+time spent in each can be read off a profile; ticks in which nothing was
+running for the request count as waiting.
+
+The last settings.profiling_buffer_size finished profiles are served by
+/api/profiles, as collapsed stacks ("frame;frame count" per line) that
+flamegraph.pl, speedscope and inferno read. They are saved as files in
+settings.profiling_dir, which the workers of a node share, so any worker can
+serve a profile another captured; without it they are kept in memory by the
+process that captured them.
+"""
+
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from typing import Callable, Deque, Dict, List, Optional, TypeVar
+from auth import bearer_user_id
+from config import settings
+from metrics import route_template
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+PROFILE_HEADER = "x-profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+# Requests profiled at the same time; further ones run unprofiled
+MAX_ACTIVE_PROFILES = 4
+MAX_STACK_DEPTH = 128
+
+# Module prefix -> category of the time spent below it
+CATEGORIES = (
+    ("azure.cosmos", "cosmos"),
+    ("azure.storage", "blob"),
+    ("database_sqlite", "sqlite"),
+    ("storage_local", "local_storage"),
+    ("PIL", "pillow"),
+)
+
+
+def _category(module: str) -> Optional[str]:
+    for prefix, category in CATEGORIES:
+        if module == prefix or module.startswith(prefix + "."):
+            return category
+    return None
+
+
+def _walk(frame) -> tuple[List[str], str]:
+    """(frame names outermost first, category) of a thread's stack"""
+    names = []
+    category = None
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        module = frame.f_globals.get("__name__", "?")
+        if module != __name__:
+            names.append(f"{module}:{frame.f_code.co_qualname}")
+            category = category or _category(module)
+        frame = frame.f_back
+    names.reverse()
+    return names, category or "python"
+
+
+class Profile:
+    """Samples of one request"""
+
+    def __init__(self, method: str, path: str, trigger: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.route = "unmatched"
+        self.status_code: Optional[int] = None
+        self.started_at = datetime.utcnow()
+        self.duration = 0.0
+        self.samples = 0
+        self.truncated = False
+        self.stacks: Counter = Counter()
+        self.breakdown: Counter = Counter()
+        self._started = time.perf_counter()
+        # Set in the request's task, on the event loop thread
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._loop_thread = threading.get_ident()
+        self._threads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def attached(self, func: Callable[..., T]) -> Callable[..., T]:
+        """func, with the thread that runs it sampled for this profile"""
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            thread = threading.get_ident()
+            with self._lock:
+                self._threads[thread] = self._threads.get(thread, 0) + 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._threads[thread] -= 1
+                    if not self._threads[thread]:
+                        del self._threads[thread]
+
+        return call
+
+    def sample(self, frames: dict):
+        """Record one tick, given sys._current_frames()"""
+        if time.perf_counter() - self._started > settings.profiling_max_seconds:
+            self.truncated = True
+            return
+        running = []
+        if (
+            asyncio.current_task(self._loop) is self._task
+            and self._loop_thread in frames
+        ):
+            running.append(("event_loop", frames[self._loop_thread]))
+        with self._lock:
+            threads = list(self._threads)
+        running += [("worker_thread", frames[thread]) for thread in threads if thread in frames]
+
+        self.samples += 1
+        if not running:
+            self.stacks["waiting"] += 1
+            self.breakdown["waiting"] += 1
+        for root, frame in running:
+            names, category = _walk(frame)
+            self.stacks[";".join([root] + names)] += 1
+            self.breakdown[category] += 1
+
+    def finish(self, status_code: Optional[int], route: str):
+        self.duration = time.perf_counter() - self._started
+        self.status_code = status_code
+        self.route = route
+        self._task = None
+
+    def summary(self) -> dict:
+        interval_ms = settings.profiling_interval_ms
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "trigger": self.trigger,
+            "statusCode": self.status_code,
+            "startedAt": self.started_at,
+            "durationMs": round(self.duration * 1000, 1),
+            "intervalMs": interval_ms,
+            "samples": self.samples,
+            "truncated": self.truncated,
+            # Thread time: workers running in parallel each add their samples
+            "breakdownMs": {
+                category: round(count * interval_ms, 1)
+                for category, count in self.breakdown.most_common()
+            },
+        }
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """The profiles of this process: the ones being sampled and the last finished"""
+
+    def __init__(self):
+        self._active: List[Profile] = []
+        self._finished: Deque[Profile] = deque(maxlen=settings.profiling_buffer_size)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, method: str, path: str, trigger: str) -> Optional[Profile]:
+        """Start sampling for the current request; None if too many are running"""
+        with self._lock:
+            if len(self._active) >= MAX_ACTIVE_PROFILES:
+                return None
+            profile = Profile(method, path, trigger)
+            self._active.append(profile)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+            self._wake.set()
+        return profile
+
+    def finish(self, profile: Profile, status_code: Optional[int], route: str):
+        """Stop sampling a profile and keep it; writes a file with profiling_dir set"""
+        with self._lock:
+            self._active.remove(profile)
+            profile.finish(status_code, route)
+            if not settings.profiling_dir:
+                self._finished.append(profile)
+                return
+        self._save(profile)
+
+    def summaries(self) -> List[dict]:
+        """Summaries of the finished profiles, newest first"""
+        if settings.profiling_dir:
+            return [saved["summary"] for saved in map(self._load, self._saved()) if saved]
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._finished)]
+
+    def collapsed(self, profile_id: str) -> Optional[str]:
+        """A finished profile's collapsed stacks, or None if it is not kept"""
+        if settings.profiling_dir:
+            if not profile_id.isalnum():
+                return None
+            saved = self._load(Path(settings.profiling_dir) / f"{profile_id}.json")
+            return saved and saved["collapsed"]
+        with self._lock:
+            profile = next((p for p in self._finished if p.id == profile_id), None)
+        return profile and profile.collapsed()
+
+    def _save(self, profile: Profile):
+        """Write a profile to profiling_dir, dropping the oldest beyond the buffer size"""
+        directory = Path(settings.profiling_dir)
+        summary = profile.summary()
+        summary["startedAt"] = summary["startedAt"].isoformat()
+        path = directory / f"{profile.id}.json"
+        temporary = path.with_suffix(".tmp")
+        try:
+            temporary.write_text(json.dumps({"summary": summary, "collapsed": profile.collapsed()}))
+            os.replace(temporary, path)
+            for old in self._saved()[settings.profiling_buffer_size:]:
+                old.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Could not save profile {profile.id}: {e}")
+
+    @staticmethod
+    def _saved() -> List[Path]:
+        """Files of the saved profiles, newest first"""
+        modified = []
+        for path in Path(settings.profiling_dir).glob("*.json"):
+            try:
+                modified.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                # Dropped by another worker since the listing
+                continue
+        return [path for _, path in sorted(modified, reverse=True)]
+
+    @staticmethod
+    def _load(path: Path) -> Optional[dict]:
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def reset_after_fork(self):
+        """Forget the sampler thread and profiles inherited from a parent process"""
+        self._active = []
+        self._finished = deque(maxlen=settings.profiling_buffer_size)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                active = list(self._active)
+                if not active:
+                    self._wake.clear()
+            if not active:
+                self._wake.wait()
+                continue
+            frames = sys._current_frames()
+            for profile in active:
+                try:
+                    profile.sample(frames)
+                except Exception as e:
+                    logger.warning(f"Profile {profile.id} sample failed: {e}")
+            del frames
+            time.sleep(settings.profiling_interval_ms / 1000)
+
+
+profiler = Profiler()
+
+# Set by ProfilingMiddleware for the request being profiled
+_profile: ContextVar[Optional[Profile]] = ContextVar("profile", default=None)
+
+
+async def run_in_threadpool(func: Callable[..., T], *args, **kwargs) -> T:
+    """starlette.concurrency.run_in_threadpool, sampling the worker thread if profiling"""
+    profile = _profile.get()
+    if profile is not None:
+        func = profile.attached(func)
+    return await _run_in_threadpool(func, *args, **kwargs)
+
+
+def _trigger(scope) -> Optional[str]:
+    if scope["path"].startswith("/api/profiles"):
+        return None
+    headers = Headers(scope=scope)
+    if PROFILE_HEADER in headers:
+        user_id = bearer_user_id(headers.get("authorization", ""))
+        if user_id is not None and user_id in settings.profiling_user_ids_list:
+            return "header"
+    if settings.profiling_sample_rate > 0 and random.random() < settings.profiling_sample_rate:
+        return "sampled"
+    return None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests that ask for it or are sampled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.profiling_enabled:
+            await self.app(scope, receive, send)
+            return
+        trigger = _trigger(scope)
+        profile = profiler.start(scope["method"], scope["path"], trigger) if trigger else None
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = None
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append(PROFILE_ID_HEADER, profile.id)
+            await send(message)
+
+        token = _profile.set(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _profile.reset(token)
+            # Saving a profile writes a file
+            await _run_in_threadpool(profiler.finish, profile, status_code, route_template(scope))
+            logger.info(
+                f"Profiled {scope['method']} {scope['path']} ({trigger}): {profile.id}, "
+                f"{profile.duration * 1000:.0f} ms"
+            )
@@ -0,0 +1,104 @@
+"""
+Views maintained from the media and tombstones change feeds
+Each projector writes one document per user to the views container, keyed by
+the view name. Replaying a batch rewrites the same documents, so a change
+delivered twice (see change_feed) does no harm. A projector reading both
+feeds may handle batches of the same user at once, on different threads or
+processes, so views that are updated rather than recomputed are written
+with compare-and-swap.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List
+from change_feed import Projector
+from config import settings
+from database import cosmos_db
+
+# Read-modify-write rounds of a view before the batch is given up (and
+# redelivered, as it is not checkpointed)
+VIEW_WRITE_ATTEMPTS = 5
+
+
+def _by_user(changes: List[dict]) -> Dict[str, List[dict]]:
+    users = defaultdict(list)
+    for change in changes:
+        users[change["userId"]].append(change)
+    return users
+
+
+def _public(document: dict) -> dict:
+    """A media document without its system properties"""
+    return {key: value for key, value in document.items() if not key.startswith("_")}
+
+
+class RecentItemsProjector(Projector):
+    """Each user's most recently uploaded media, newest first"""
+
+    name = "recent"
+    feeds = ("media", "tombstones")
+
+    def project(self, changes: List[dict]):
+        for user_id, documents in _by_user(changes).items():
+            for _ in range(VIEW_WRITE_ATTEMPTS):
+                view = cosmos_db.get_view(user_id, self.name)
+                recent = self._recent(user_id, view or {}, documents)
+                etag = view["_etag"] if view else None
+                if cosmos_db.write_view(
+                    user_id,
+                    self.name,
+                    {"items": recent, "updatedAt": datetime.utcnow().isoformat()},
+                    etag,
+                ):
+                    break
+            else:
+                raise RuntimeError(f"View '{self.name}' of user {user_id} kept changing")
+
+    def _recent(self, user_id: str, view: dict, documents: List[dict]) -> List[dict]:
+        items = {item["id"]: item for item in view.get("items", [])}
+        deleted = False
+        for document in documents:
+            if document.get("deleted"):
+                deleted = items.pop(document["id"], None) is not None or deleted
+            else:
+                # Updates replace the stored copy
+                items[document["id"]] = _public(document)
+        size = settings.recent_items_view_size
+        recent = sorted(items.values(), key=lambda item: item["uploadedAt"], reverse=True)
+        recent = recent[:size]
+        # The feeds are read independently, so an item may come back after its
+        # tombstone was handled: any items that are gone, or a delete that left
+        # the list short, refill it from the media container
+        existing = cosmos_db.get_media_by_ids(user_id, [item["id"] for item in recent])
+        if len(existing) < len(recent) or deleted:
+            recent, _ = cosmos_db.get_user_media(user_id, page=1, page_size=size)
+            recent = [_public(document) for document in recent]
+        return recent
+
+
+class UserStatsProjector(Projector):
+    """Each user's item count and storage used, in total and per media type"""
+
+    name = "stats"
+    feeds = ("media", "tombstones")
+
+    def project(self, changes: List[dict]):
+        # A change may be a re-delivery or an update that leaves the totals as
+        # they were, so the touched users' totals are recounted, not adjusted
+        for user_id in _by_user(changes):
+            by_type = cosmos_db.get_media_stats(user_id)
+            cosmos_db.upsert_view(
+                user_id,
+                self.name,
+                {
+                    "count": sum(stats["count"] for stats in by_type.values()),
+                    "bytes": sum(stats["bytes"] for stats in by_type.values()),
+                    "byType": by_type,
+                    "updatedAt": datetime.utcnow().isoformat(),
+                },
+            )
+
+
+PROJECTORS = {
+    projector.name: projector for projector in (RecentItemsProjector, UserStatsProjector)
+}
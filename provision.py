@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+One-time provisioning of the Azure resources used by the API
+Creates the Cosmos DB database and containers, migrates their indexing
+policies and creates the blob container. Run this from a deployment step
+with management permissions; the API itself assumes everything exists.
+
+Usage:
+    python provision.py [--skip-indexing-policy]
+"""
+import argparse
+import logging
+import sys
+
+from database import cosmos_db
+from storage import blob_storage
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision Azure resources")
+    parser.add_argument(
+        "--skip-indexing-policy",
+        action="store_true",
+        help="create missing resources but leave indexing policies untouched",
+    )
+    args = parser.parse_args()
+
+    try:
+        cosmos_db.provision(migrate_indexing_policy=not args.skip_indexing_policy)
+        blob_storage.provision()
+    except Exception as e:
+        logger.error(f"Provisioning failed: {e}", exc_info=True)
+        return 1
+
+    logger.info("Provisioning complete")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
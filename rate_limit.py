@@ -0,0 +1,195 @@
+"""
+Per-user admission control
+Each authenticated user has a token bucket per budget (uploads and other
+writes, reads, searches), refilled at a steady rate up to a burst size. A
+request that finds its bucket empty is refused with 429 and a Retry-After
+of the time until a token is available, before it reaches the database, so
+one user's scripted bulk upload or rapid paging cannot use up the RU budget
+and worker capacity everyone shares.
+
+Buckets live in process memory by default, so each worker process admits up
+to the configured rates on its own. With settings.rate_limit_store = "sqlite"
+they are kept in a SQLite file shared by the worker processes of a node.
+"""
+
+from dataclasses import dataclass
+from fastapi import Depends, HTTPException, status
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, Dict
+from auth import get_current_user_id
+from config import settings
+from metrics import RATE_LIMITED
+import math
+import sqlite3
+import threading
+import time
+
+
+@dataclass(frozen=True)
+class Budget:
+    name: str
+    rate: float  # tokens per second
+    burst: int
+
+
+BUDGETS: Dict[str, Budget] = {
+    "upload": Budget(
+        "upload", settings.rate_limit_uploads_per_minute / 60, settings.rate_limit_upload_burst
+    ),
+    "read": Budget("read", settings.rate_limit_reads_per_second, settings.rate_limit_read_burst),
+    "search": Budget(
+        "search", settings.rate_limit_searches_per_second, settings.rate_limit_search_burst
+    ),
+}
+
+
+class RateLimitedError(HTTPException):
+    """The user has used up a budget; the client should retry later"""
+
+    def __init__(self, budget: str, retry_after_seconds: float):
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many {budget} requests, please retry shortly",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after_seconds)))},
+        )
+        self.retry_after_seconds = retry_after_seconds
+
+
+def _take(tokens: float, elapsed: float, budget: Budget) -> tuple[float, float]:
+    """(tokens left, seconds to wait) after refilling for elapsed and taking one"""
+    tokens = min(budget.burst, tokens + elapsed * budget.rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / budget.rate
+
+
+class MemoryBucketStore:
+    """Buckets in this process; full buckets are dropped once there are too many"""
+
+    blocking = False
+
+    def __init__(self, max_buckets: int = 100_000):
+        self.max_buckets = max_buckets
+        self._buckets: Dict[tuple[str, str], tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, user_id: str, budget: Budget) -> float:
+        """Take a token; returns 0, or the seconds until one is available"""
+        key = (budget.name, user_id)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (budget.burst, now))
+            tokens, wait = _take(tokens, now - updated, budget)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+        return wait
+
+    def reset_after_fork(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        for (name, user_id), (tokens, updated) in list(self._buckets.items()):
+            budget = BUDGETS.get(name)
+            if budget is None or tokens + (now - updated) * budget.rate >= budget.burst:
+                del self._buckets[(name, user_id)]
+
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file, updated atomically so worker processes share them"""
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "budget TEXT NOT NULL, user_id TEXT NOT NULL, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL, PRIMARY KEY (budget, user_id)) WITHOUT ROWID"
+            )
+            self._local.connection = connection
+        return connection
+
+    def take(self, user_id: str, budget: Budget) -> float:
+        """Take a token; returns 0, or the seconds until one is available"""
+        connection = self._connection()
+        # Wall clock time, which (unlike monotonic time) processes agree on
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE budget = ? AND user_id = ?",
+                (budget.name, user_id),
+            ).fetchone()
+            tokens, updated = row or (budget.burst, now)
+            tokens, wait = _take(tokens, max(0.0, now - updated), budget)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (budget, user_id, tokens, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (budget.name, user_id, tokens, now),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return wait
+
+    def reset_after_fork(self):
+        self._local = threading.local()
+
+
+def create_bucket_store():
+    if settings.rate_limit_store == "memory":
+        return MemoryBucketStore()
+    if settings.rate_limit_store == "sqlite":
+        return SQLiteBucketStore(settings.rate_limit_sqlite_path)
+    raise ValueError(f"Unknown rate limit store: '{settings.rate_limit_store}'")
+
+
+bucket_store = create_bucket_store()
+
+
+async def admit(user_id: str, budget_name: str):
+    """
+    Take a token from the user's bucket for the named budget
+
+    Raises:
+        RateLimitedError: 429 with Retry-After when the bucket is empty
+    """
+    if not settings.rate_limit_enabled:
+        return
+    budget = BUDGETS[budget_name]
+    if bucket_store.blocking:
+        wait = await run_in_threadpool(bucket_store.take, user_id, budget)
+    else:
+        wait = bucket_store.take(user_id, budget)
+    if wait > 0:
+        RATE_LIMITED.inc(budget=budget_name)
+        raise RateLimitedError(budget_name, wait)
+
+
+def rate_limited(budget_name: str) -> Callable:
+    """
+    Dependency returning the current user's id once the request is admitted
+    under the named budget
+
+    Uploads are admitted by upload_guard instead: dependencies run after
+    FastAPI has read the request body.
+    """
+    if budget_name not in BUDGETS:
+        raise ValueError(f"Unknown rate limit budget: '{budget_name}'")
+
+    async def dependency(user_id: str = Depends(get_current_user_id)) -> str:
+        await admit(user_id, budget_name)
+        return user_id
+
+    return dependency
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Orphan blob reconciler
+Deletes stored files that no media document refers to: blobs left by uploads
+whose document was never written and by deletes that failed part way. For
+each user the blobs under the user's prefix are listed in name order and
+merge-joined against the fileName and thumbnailFileName references, read
+from the database in sorted keyset pages, so memory does not grow with the
+size of a library. Blobs modified within the grace period are kept (an
+upload writes its blobs before its document), and each candidate is looked
+up once more right before it is deleted. Deletes are paced to a fixed rate
+and database reads run at bulk priority.
+
+Documents from before thumbnailFileName was stored get it filled in from
+their thumbnail URL first (not with --dry-run).
+
+Usage:
+    python reconcile_blobs.py [--dry-run] [--grace-hours 24] [--deletes-per-second 10]
+                              [--user USER_ID ...] [--after USER_ID]
+"""
+import argparse
+import logging
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, Set
+
+from database import cosmos_db
+from media_helpers import extract_thumbnail_blob_identifier
+from storage import blob_storage
+from user_batch import add_user_arguments, run_per_user
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class Pacer:
+    """Spaces calls to wait() at least 1 / rate seconds apart"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self._next:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+
+def unreferenced(
+    blobs: Iterable[tuple[str, datetime]], references: Iterator[str]
+) -> Iterator[tuple[str, datetime]]:
+    """Blobs whose name is not in references; both must be in name order"""
+    reference = next(references, None)
+    for name, modified in blobs:
+        while reference is not None and reference < name:
+            reference = next(references, None)
+        if reference != name:
+            yield name, modified
+
+
+def name_thumbnails(user_id: str, dry_run: bool) -> Set[str]:
+    """
+    Thumbnail blob names of the user's documents that do not store one,
+    storing them unless dry_run
+    """
+    names = set()
+    for document in cosmos_db.get_unnamed_thumbnails(user_id):
+        name = extract_thumbnail_blob_identifier(document)
+        if not name:
+            continue
+        names.add(name)
+        if not dry_run:
+            cosmos_db.update_media(document["id"], user_id, {"thumbnailFileName": name})
+    return names
+
+
+def reconcile_user(
+    user_id: str, cutoff: datetime, dry_run: bool, pacer: Pacer, counts: Counter
+):
+    unnamed = name_thumbnails(user_id, dry_run)
+    blobs = blob_storage.list_files(user_id)
+    for name, modified in unreferenced(blobs, cosmos_db.iter_blob_references(user_id)):
+        if name in unnamed:
+            continue
+        if modified > cutoff:
+            counts["recent"] += 1
+            continue
+        # The join relies on both listings sorting names alike; confirm first
+        if cosmos_db.find_media_by_blob(user_id, name):
+            counts["referenced_on_recheck"] += 1
+            continue
+        counts["orphaned"] += 1
+        if dry_run:
+            logger.info(f"Would delete {name} (last modified {modified:%Y-%m-%d %H:%M})")
+            continue
+        pacer.wait()
+        if blob_storage.delete_file(name):
+            counts["deleted"] += 1
+        else:
+            counts["failed"] += 1
+    counts["users"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete blobs no media document refers to")
+    parser.add_argument("--dry-run", action="store_true", help="only list the orphaned blobs")
+    parser.add_argument(
+        "--grace-hours",
+        type=float,
+        default=24,
+        help="keep blobs modified more recently than this (default: 24)",
+    )
+    parser.add_argument(
+        "--deletes-per-second", type=float, default=10, help="delete rate limit (default: 10)"
+    )
+    add_user_arguments(parser, "reconcile")
+    args = parser.parse_args()
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=args.grace_hours)
+    pacer = Pacer(args.deletes_per_second)
+    counts = Counter()
+    code = run_per_user(
+        "Reconciliation",
+        lambda user_id: reconcile_user(user_id, cutoff, args.dry_run, pacer, counts),
+        args.user,
+        args.after,
+        counts,
+        args.dry_run,
+    )
+    return code or (1 if counts.get("failed") else 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
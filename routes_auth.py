@@ -2,11 +2,12 @@ from fastapi import APIRouter, HTTPException, status, Depends
 from models import UserCreate, LoginRequest, Token, UserResponse
 from auth import (
     get_password_hash,
-    verify_password,
+    verify_and_update_password,
     create_access_token,
     get_current_user_id,
 )
 from database import cosmos_db
+from profiling import run_in_threadpool
 from datetime import datetime
 import uuid
 import logging
@@ -24,7 +25,7 @@ async def register(user_data: UserCreate):
     try:
         # Check if user already exists
         logger.info(f"Registration attempt for email: {user_data.email}")
-        existing_user = cosmos_db.get_user_by_email(user_data.email)
+        existing_user = await run_in_threadpool(cosmos_db.get_user_by_email, user_data.email)
         if existing_user:
             logger.warning(f"Registration failed: Email already exists {user_data.email}")
             raise HTTPException(
@@ -38,12 +39,14 @@ async def register(user_data: UserCreate):
             "id": user_id,
             "username": user_data.username,
             "email": user_data.email,
-            "hashed_password": get_password_hash(user_data.password),
+            "hashed_password": await run_in_threadpool(
+                get_password_hash, user_data.password
+            ),
             "created_at": datetime.utcnow().isoformat(),
         }
 
         # Save to database
-        created_user = cosmos_db.create_user(user_doc)
+        created_user = await run_in_threadpool(cosmos_db.create_user, user_doc)
         logger.info(f"User created successfully: {user_data.email}")
 
         # Generate JWT token
@@ -84,7 +87,7 @@ async def login(login_data: LoginRequest):
     try:
         # Get user by email
         logger.info(f"Login attempt for email: {login_data.email}")
-        user = cosmos_db.get_user_by_email(login_data.email)
+        user = await run_in_threadpool(cosmos_db.get_user_by_email, login_data.email)
         if not user:
             logger.warning(f"Login failed: User not found for email {login_data.email}")
             raise HTTPException(
@@ -93,13 +96,25 @@ async def login(login_data: LoginRequest):
             )
 
         # Verify password
-        if not verify_password(login_data.password, user["hashed_password"]):
+        valid, new_hash = await run_in_threadpool(
+            verify_and_update_password, login_data.password, user["hashed_password"]
+        )
+        if not valid:
             logger.warning(f"Login failed: Invalid password for email {login_data.email}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid email or password",
             )
 
+        # Upgrade a hash made with outdated parameters while the password is known
+        if new_hash:
+            try:
+                await run_in_threadpool(
+                    cosmos_db.patch_user, user["id"], {"hashed_password": new_hash}
+                )
+            except Exception as e:
+                logger.warning(f"Failed to rehash password for user {user['id']}: {e}")
+
         # Generate JWT token
         access_token = create_access_token(
             data={"sub": user["id"], "email": user["email"]}
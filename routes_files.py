@@ -0,0 +1,176 @@
+"""
+Serving of files stored by the local filesystem backend
+Files are sent zero-copy when possible: through nginx X-Accel-Redirect if
+configured, otherwise via the ASGI zero-copy send extension when the server
+offers it, falling back to positioned reads streamed in chunks.
+"""
+
+from fastapi import APIRouter, HTTPException, status, Query, Request
+from fastapi.responses import Response
+from starlette.types import Receive, Scope, Send
+from email.utils import formatdate
+from pathlib import Path
+from typing import Optional
+from config import settings
+from profiling import run_in_threadpool
+from storage import blob_storage
+import mimetypes
+import os
+
+router = APIRouter(prefix="/files", tags=["Files"])
+
+CHUNK_SIZE = 256 * 1024
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[tuple[int, int]]:
+    """
+    Parse a single 'bytes=' range into an inclusive (start, end) pair
+
+    Returns:
+        tuple | None: The range, or None to serve the whole file (no header,
+        multiple ranges or a unit other than bytes)
+
+    Raises:
+        ValueError: If the range cannot be satisfied
+    """
+    if not range_header:
+        return None
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    start_text, _, end_text = ranges.strip().partition("-")
+    if not (start_text or end_text).isdigit() or (end_text and not end_text.isdigit()):
+        # Malformed ranges are ignored
+        return None
+
+    if not start_text:
+        # Suffix range: the last N bytes
+        suffix = int(end_text)
+        if suffix <= 0:
+            raise ValueError("Empty suffix range")
+        return max(0, file_size - suffix), file_size - 1
+
+    start = int(start_text)
+    end = int(end_text) if end_text else file_size - 1
+    if start >= file_size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, file_size - 1)
+
+
+class SendfileResponse(Response):
+    """Send a byte range of a file without copying it through Python buffers"""
+
+    def __init__(self, path: Path, offset: int, count: int, status_code: int, headers: dict):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.offset = offset
+        self.count = count
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope["method"] == "HEAD" or self.count == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb", buffering=0) as file:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": self.offset,
+                        "count": self.count,
+                    }
+                )
+                return
+
+            fd = file.fileno()
+            position, remaining = self.offset, self.count
+            while remaining > 0:
+                chunk = await run_in_threadpool(
+                    os.pread, fd, min(CHUNK_SIZE, remaining), position
+                )
+                if not chunk:
+                    break
+                position += len(chunk)
+                remaining -= len(chunk)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": remaining > 0,
+                    }
+                )
+            if remaining > 0:
+                # File shrank underneath us; end the body anyway
+                await send({"type": "http.response.body", "body": b""})
+
+
+@router.api_route("/{blob_name:path}", methods=["GET", "HEAD"])
+async def download_file(
+    blob_name: str,
+    request: Request,
+    expires: int = Query(...),
+    sig: str = Query(...),
+):
+    """
+    Download a locally stored file through a signed URL
+    """
+    path = blob_storage.resolve_signed(blob_name, expires, sig)
+    if path is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid or expired file URL",
+        )
+
+    try:
+        file_stat = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="File not found"
+        )
+
+    content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    headers = {
+        "Content-Type": content_type,
+        "Accept-Ranges": "bytes",
+        "Last-Modified": formatdate(file_stat.st_mtime, usegmt=True),
+        "ETag": f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"',
+        "Cache-Control": "private, max-age=3600",
+    }
+
+    if settings.local_storage_accel_redirect:
+        # nginx serves the file (with sendfile and range support) from an
+        # internal location mapped to the storage root
+        relative = path.relative_to(blob_storage.root).as_posix()
+        headers["X-Accel-Redirect"] = (
+            f"{settings.local_storage_accel_redirect.rstrip('/')}/{relative}"
+        )
+        return Response(headers=headers)
+
+    size = file_stat.st_size
+    try:
+        byte_range = parse_range(request.headers.get("range", ""), size)
+    except ValueError:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, status.HTTP_200_OK
+    else:
+        start, end = byte_range
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    count = max(0, end - start + 1)
+    headers["Content-Length"] = str(count)
+    return SendfileResponse(path, start, count, status_code, headers)
@@ -1,15 +1,47 @@
 from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Form, Query
-from typing import Optional, List
-from models import MediaResponse, MediaUpdate, MediaListResponse
+from typing import Iterator, Optional, List
+from models import (
+    MediaResponse,
+    MediaUpdate,
+    MediaListResponse,
+    SimilarMedia,
+    SimilarMediaResponse,
+    DuplicateGroup,
+    DuplicateReportResponse,
+    TagCount,
+    TagListResponse,
+    MediaTypeStats,
+    MediaOverviewResponse,
+    DeletedMedia,
+    MediaChangesResponse,
+)
 from auth import get_current_user_id
+from rate_limit import rate_limited
 from database import cosmos_db
+from delta_sync import WatermarkExpiredError
 from storage import blob_storage
-from utils import validate_file_type, validate_file_size, generate_thumbnail
+from utils import (
+    validate_file_type,
+    validate_file_size,
+    process_image,
+    captured_at_filter,
+)
 from media_helpers import fetch_and_verify_media_ownership, extract_thumbnail_blob_identifier
+from media_export import export_archive, library_prefetcher
+from metrics import UPLOAD_BYTES, UPLOAD_DURATION
+from profiling import run_in_threadpool
+from tracing import span
+from video_metadata import extract_video_metadata, file_reader
+from similarity import similarity_index
+from tag_index import tag_index
+from config import settings
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from datetime import datetime
 import uuid
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -21,54 +53,74 @@ async def upload_media(
     file: UploadFile = File(...),
     description: Optional[str] = Form(None),
     tags: Optional[str] = Form(None),
+    # Rate limited by upload_guard, before the body is read
     user_id: str = Depends(get_current_user_id),
 ):
     """
     Upload a new image or video file
     """
+    started = time.perf_counter()
     try:
-        # Validate file type
-        media_type = validate_file_type(file)
+        with span("upload.validate"):
+            # Validate file type
+            media_type = validate_file_type(file)
 
-        # Validate file size
-        file_size = validate_file_size(file)
+            # Validate file size
+            file_size = validate_file_size(file)
 
-        # Parse tags if provided
-        tags_list = None
-        if tags:
-            try:
-                tags_list = json.loads(tags)
-                if not isinstance(tags_list, list):
-                    raise ValueError("Tags must be an array")
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Invalid tags format. Must be a JSON array.",
-                )
+            # Parse tags if provided
+            tags_list = None
+            if tags:
+                try:
+                    tags_list = json.loads(tags)
+                    if not isinstance(tags_list, list):
+                        raise ValueError("Tags must be an array")
+                except json.JSONDecodeError:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Invalid tags format. Must be a JSON array.",
+                    )
 
-        # Read file content
-        file_content = await file.read()
-        await file.seek(0)
+        # Images are decoded from memory; videos are only inspected in place
+        if media_type == "image":
+            with span("upload.read", bytes=file_size):
+                file_content = await file.read()
+                await file.seek(0)
 
         # Upload to blob storage
-        blob_name, blob_url = blob_storage.upload_file(
-            file.file, user_id, file.filename, file.content_type
-        )
-
-        # Generate thumbnail for images
+        with span("upload.blob"):
+            blob_name, blob_url = await run_in_threadpool(
+                blob_storage.upload_file, file.file, user_id, file.filename, file.content_type
+            )
+
+        # Generate thumbnail and extract header metadata for images, and read
+        # duration, size and codecs from the container headers of videos
+        thumbnail_name = None
         thumbnail_url = None
+        image_hash = None
+        header_metadata = {}
+        if media_type == "video":
+            with span("upload.video_metadata"):
+                header_metadata = await run_in_threadpool(
+                    extract_video_metadata, file_reader(file.file), file_size
+                )
         if media_type == "image":
-            thumbnail_data = generate_thumbnail(file_content)
+            with span("upload.thumbnail"):
+                thumbnail_data, image_hash, header_metadata = await run_in_threadpool(
+                    process_image, file_content
+                )
             if thumbnail_data:
                 try:
                     import io
                     thumbnail_file = io.BytesIO(thumbnail_data)
-                    thumbnail_name, thumbnail_url = blob_storage.upload_file(
-                        thumbnail_file,
-                        user_id,
-                        f"thumb_{file.filename}",
-                        "image/jpeg",
-                    )
+                    with span("upload.thumbnail_blob"):
+                        thumbnail_name, thumbnail_url = await run_in_threadpool(
+                            blob_storage.upload_file,
+                            thumbnail_file,
+                            user_id,
+                            f"thumb_{file.filename}",
+                            "image/jpeg",
+                        )
                 except Exception as e:
                     logger.warning(f"Failed to upload thumbnail: {e}")
 
@@ -85,14 +137,29 @@ async def upload_media(
             "mimeType": file.content_type,
             "blobUrl": blob_url,
             "thumbnailUrl": thumbnail_url,
+            "thumbnailFileName": thumbnail_name,
+            "perceptualHash": image_hash,
             "description": description,
             "tags": tags_list,
             "uploadedAt": now,
             "updatedAt": now,
+            **header_metadata,
         }
 
-        # Save to database
-        created_media = cosmos_db.create_media(media_doc)
+        # Save to database; without a document the blobs would be orphaned
+        try:
+            with span("upload.create_media"):
+                created_media = await run_in_threadpool(cosmos_db.create_media, media_doc)
+        except Exception:
+            for orphan in filter(None, (blob_name, thumbnail_name)):
+                await run_in_threadpool(blob_storage.delete_file, orphan)
+            raise
+        tag_index.update(user_id, added=tags_list or [])
+        if image_hash:
+            similarity_index.add(user_id, media_id, image_hash)
+
+        UPLOAD_BYTES.observe(file_size, media_type=media_type)
+        UPLOAD_DURATION.observe(time.perf_counter() - started, media_type=media_type)
 
         # Return response
         return MediaResponse(**created_media)
@@ -112,13 +179,14 @@ async def search_media(
     query: str = Query(..., min_length=1),
     page: int = Query(1, ge=1),
     pageSize: int = Query(20, ge=1, le=100),
-    user_id: str = Depends(get_current_user_id),
+    user_id: str = Depends(rate_limited("search")),
 ):
     """
     Search media files by filename, description, or tags
     """
     try:
-        items, total = cosmos_db.search_media(
+        items, total = await run_in_threadpool(
+            cosmos_db.search_media,
             user_id=user_id, query=query, page=page, page_size=pageSize
         )
 
@@ -128,6 +196,8 @@ async def search_media(
             items=media_items, total=total, page=page, pageSize=pageSize
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Search media error: {e}")
         raise HTTPException(
@@ -141,14 +211,30 @@ async def get_media_list(
     page: int = Query(1, ge=1),
     pageSize: int = Query(20, ge=1, le=100),
     mediaType: Optional[str] = Query(None, regex="^(image|video)$"),
-    user_id: str = Depends(get_current_user_id),
+    orientation: Optional[str] = Query(None, regex="^(landscape|portrait|square)$"),
+    cameraModel: Optional[str] = Query(None, min_length=1),
+    minWidth: Optional[int] = Query(None, ge=1),
+    minHeight: Optional[int] = Query(None, ge=1),
+    capturedAfter: Optional[datetime] = Query(None),
+    capturedBefore: Optional[datetime] = Query(None),
+    user_id: str = Depends(rate_limited("read")),
 ):
     """
     Retrieve paginated list of user's media files
     """
     try:
-        items, total = cosmos_db.get_user_media(
-            user_id=user_id, page=page, page_size=pageSize, media_type=mediaType
+        items, total = await run_in_threadpool(
+            cosmos_db.get_user_media,
+            user_id=user_id,
+            page=page,
+            page_size=pageSize,
+            media_type=mediaType,
+            orientation=orientation,
+            camera_model=cameraModel,
+            min_width=minWidth,
+            min_height=minHeight,
+            captured_after=captured_at_filter(capturedAfter),
+            captured_before=captured_at_filter(capturedBefore),
         )
 
         media_items = [MediaResponse(**item) for item in items]
@@ -157,6 +243,8 @@ async def get_media_list(
             items=media_items, total=total, page=page, pageSize=pageSize
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get media list error: {e}")
         raise HTTPException(
@@ -165,16 +253,246 @@ async def get_media_list(
         )
 
 
+@router.get("/tags", response_model=TagListResponse, status_code=status.HTTP_200_OK)
+async def get_media_tags(
+    prefix: str = Query("", max_length=100),
+    limit: int = Query(10, ge=1, le=1000),
+    user_id: str = Depends(rate_limited("read")),
+):
+    """
+    List the user's tags starting with prefix, most used first, with counts
+    """
+    try:
+        # Served from memory; only a user's first lookup goes to the database
+        tags = tag_index.peek(user_id, prefix, limit)
+        if tags is None:
+            tags = await run_in_threadpool(tag_index.suggest, user_id, prefix, limit)
+
+        return TagListResponse(items=[TagCount(tag=tag, count=count) for tag, count in tags])
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get media tags error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve tags",
+        )
+
+
+@router.get("/overview", response_model=MediaOverviewResponse, status_code=status.HTTP_200_OK)
+async def get_media_overview(user_id: str = Depends(rate_limited("read"))):
+    """
+    Library totals and the most recent uploads, read from the views kept by
+    the change feed processor (a few seconds behind the latest writes)
+    """
+    try:
+        stats = await run_in_threadpool(cosmos_db.get_view, user_id, "stats") or {}
+        recent = await run_in_threadpool(cosmos_db.get_view, user_id, "recent") or {}
+
+        return MediaOverviewResponse(
+            count=stats.get("count", 0),
+            bytes=stats.get("bytes", 0),
+            byType={
+                media_type: MediaTypeStats(**totals)
+                for media_type, totals in stats.get("byType", {}).items()
+            },
+            recent=[MediaResponse(**item) for item in recent.get("items", [])],
+            updatedAt=max(
+                filter(None, (stats.get("updatedAt"), recent.get("updatedAt"))), default=None
+            ),
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get media overview error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve media overview",
+        )
+
+
+@router.get("/changes", response_model=MediaChangesResponse, status_code=status.HTTP_200_OK)
+async def get_media_changes(
+    since: Optional[str] = Query(None, min_length=1, max_length=200),
+    limit: int = Query(500, ge=1, le=1000),
+    user_id: str = Depends(rate_limited("read")),
+):
+    """
+    Media created, updated or deleted since a watermark, oldest first
+    Without since, the whole library; pass next back as since, and call
+    again straight away while hasMore is true.
+    """
+    try:
+        items, deleted, watermark, more = await run_in_threadpool(
+            cosmos_db.get_media_changes, user_id, since, limit
+        )
+
+        return MediaChangesResponse(
+            items=[MediaResponse(**item) for item in items],
+            deleted=[DeletedMedia(**tombstone) for tombstone in deleted],
+            next=watermark,
+            hasMore=more,
+        )
+
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid since watermark",
+        )
+    except WatermarkExpiredError:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Watermark expired, resync with /media/stream",
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get media changes error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve media changes",
+        )
+
+
+@router.get(
+    "/duplicates", response_model=DuplicateReportResponse, status_code=status.HTTP_200_OK
+)
+async def get_duplicate_media(
+    maxDistance: Optional[int] = Query(None, ge=0, le=8),
+    limit: int = Query(20, ge=1, le=100),
+    user_id: str = Depends(rate_limited("read")),
+):
+    """
+    Report groups of near-identical images (bursts, re-saved copies), largest first
+    """
+    try:
+        max_distance = settings.duplicate_max_distance if maxDistance is None else maxDistance
+        groups = await run_in_threadpool(similarity_index.duplicates, user_id, max_distance)
+
+        shown = groups[:limit]
+        documents = await run_in_threadpool(
+            cosmos_db.get_media_by_ids, user_id, [media_id for group in shown for media_id in group]
+        )
+        by_id = {document["id"]: MediaResponse(**document) for document in documents}
+
+        return DuplicateReportResponse(
+            groups=[
+                DuplicateGroup(items=[by_id[media_id] for media_id in group if media_id in by_id])
+                for group in shown
+            ],
+            total=len(groups),
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Duplicate report error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to build duplicate report",
+        )
+
+
+# Documents fetched per query page, and bytes of NDJSON sent per write
+STREAM_PAGE_SIZE = 500
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def ndjson_chunks(documents: Iterator[dict]) -> Iterator[bytes]:
+    """Media documents as NDJSON, one MediaResponse per line, in chunks"""
+    chunk = bytearray()
+    for document in documents:
+        chunk += MediaResponse(**document).model_dump_json(by_alias=True).encode()
+        chunk += b"\n"
+        if len(chunk) >= STREAM_CHUNK_BYTES:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+
+@router.get("/stream", status_code=status.HTTP_200_OK)
+async def stream_media(
+    mediaType: Optional[str] = Query(None, regex="^(image|video)$"),
+    tag: Optional[str] = Query(None, min_length=1),
+    user_id: str = Depends(rate_limited("read")),
+):
+    """
+    Enumerate the user's whole library, newest first, as newline-delimited JSON
+    """
+    chunks = ndjson_chunks(
+        cosmos_db.iter_user_media(
+            user_id, media_type=mediaType, tag=tag, page_size=STREAM_PAGE_SIZE
+        )
+    )
+    try:
+        # The first page is read before the response starts, so a failing
+        # query still gets a proper error status
+        first = await run_in_threadpool(next, chunks, b"")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Stream media error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to stream media",
+        )
+
+    async def body():
+        yield first
+        try:
+            async for chunk in iterate_in_threadpool(chunks):
+                yield chunk
+        except Exception as e:
+            # Raising aborts the response, so the client cannot take a
+            # truncated listing for a complete one
+            logger.error(f"Stream media error after the first page: {e}")
+            raise
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+@router.get("/export", status_code=status.HTTP_200_OK)
+async def export_media(
+    mediaType: Optional[str] = Query(None, regex="^(image|video)$"),
+    tag: Optional[str] = Query(None, min_length=1),
+    user_id: str = Depends(rate_limited("read")),
+):
+    """
+    Download the user's media as a ZIP archive, streamed as it is built
+    """
+    prefetcher = library_prefetcher(user_id, media_type=mediaType, tag=tag)
+
+    async def body():
+        try:
+            async for chunk in iterate_in_threadpool(export_archive(prefetcher)):
+                yield chunk
+        finally:
+            # Also runs when the client disconnects mid-download
+            prefetcher.close()
+
+    filename = f"media-export-{datetime.utcnow():%Y%m%d}.zip"
+    return StreamingResponse(
+        body(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @router.get("/{media_id}", response_model=MediaResponse, status_code=status.HTTP_200_OK)
 async def get_media_by_id(
     media_id: str,
-    user_id: str = Depends(get_current_user_id),
+    user_id: str = Depends(rate_limited("read")),
 ):
     """
     Retrieve details of a specific media file
     """
     try:
-        media_document = fetch_and_verify_media_ownership(media_id, user_id)
+        media_document = await run_in_threadpool(
+            fetch_and_verify_media_ownership, media_id, user_id
+        )
         return MediaResponse(**media_document)
 
     except HTTPException:
@@ -187,18 +505,66 @@ async def get_media_by_id(
         )
 
 
+@router.get(
+    "/{media_id}/similar", response_model=SimilarMediaResponse, status_code=status.HTTP_200_OK
+)
+async def get_similar_media(
+    media_id: str,
+    maxDistance: Optional[int] = Query(None, ge=0, le=32),
+    limit: int = Query(20, ge=1, le=100),
+    user_id: str = Depends(rate_limited("read")),
+):
+    """
+    List the user's images that look like this one, most similar first
+    """
+    try:
+        media_document = await run_in_threadpool(
+            fetch_and_verify_media_ownership, media_id, user_id
+        )
+        if not media_document.get("perceptualHash"):
+            return SimilarMediaResponse(items=[])
+
+        max_distance = settings.similar_max_distance if maxDistance is None else maxDistance
+        matches = await run_in_threadpool(
+            similarity_index.similar, user_id, media_id, max_distance, limit
+        )
+        documents = await run_in_threadpool(
+            cosmos_db.get_media_by_ids, user_id, [match_id for match_id, _ in matches]
+        )
+        by_id = {document["id"]: document for document in documents}
+
+        return SimilarMediaResponse(
+            items=[
+                SimilarMedia(item=MediaResponse(**by_id[match_id]), distance=distance)
+                for match_id, distance in matches
+                if match_id in by_id
+            ]
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get similar media error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to find similar media",
+        )
+
+
 @router.put("/{media_id}", response_model=MediaResponse, status_code=status.HTTP_200_OK)
 async def update_media_metadata(
     media_id: str,
     update_data: MediaUpdate,
-    user_id: str = Depends(get_current_user_id),
+    user_id: str = Depends(rate_limited("upload")),
 ):
     """
     Update description and tags of a media file
     """
     try:
         # Verify media exists and user has ownership
-        media_document = fetch_and_verify_media_ownership(media_id, user_id)
+        media_document = await run_in_threadpool(
+            fetch_and_verify_media_ownership, media_id, user_id
+        )
 
         # Prepare updates with timestamp
         metadata_updates = {"updatedAt": datetime.utcnow().isoformat()}
@@ -210,7 +576,13 @@ async def update_media_metadata(
             metadata_updates["tags"] = update_data.tags
 
         # Apply updates to database
-        updated_media = cosmos_db.update_media(media_id, user_id, metadata_updates)
+        updated_media = await run_in_threadpool(
+            cosmos_db.update_media, media_id, user_id, metadata_updates
+        )
+        if update_data.tags is not None:
+            tag_index.update(
+                user_id, removed=media_document.get("tags") or [], added=update_data.tags
+            )
 
         return MediaResponse(**updated_media)
 
@@ -231,29 +603,34 @@ async def update_media_metadata(
 @router.delete("/{media_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_media(
     media_id: str,
-    user_id: str = Depends(get_current_user_id),
+    user_id: str = Depends(rate_limited("upload")),
 ):
     """
     Delete a media file and its metadata
     """
     try:
         # Verify media exists and user has ownership
-        media_document = fetch_and_verify_media_ownership(media_id, user_id)
+        media_document = await run_in_threadpool(
+            fetch_and_verify_media_ownership, media_id, user_id
+        )
+
+        # Remove metadata first: blobs left behind by a failure below are
+        # collected by reconcile_blobs.py, a document without its blob is not
+        await run_in_threadpool(cosmos_db.delete_media, media_id, user_id)
+        tag_index.update(user_id, removed=media_document.get("tags") or [])
+        similarity_index.remove(user_id, media_id)
 
         # Remove primary file from blob storage
-        blob_storage.delete_file(media_document["fileName"])
+        await run_in_threadpool(blob_storage.delete_file, media_document["fileName"])
 
         # Remove thumbnail if present
         thumbnail_blob_id = extract_thumbnail_blob_identifier(media_document)
         if thumbnail_blob_id:
             try:
-                blob_storage.delete_file(thumbnail_blob_id)
+                await run_in_threadpool(blob_storage.delete_file, thumbnail_blob_id)
             except Exception as e:
                 logger.warning(f"Thumbnail deletion failed: {e}")
 
-        # Remove metadata from database
-        cosmos_db.delete_media(media_id, user_id)
-
         return None
 
     except HTTPException:
@@ -0,0 +1,48 @@
+"""
+Request profiles captured by profiling.ProfilingMiddleware, in any worker
+sharing settings.profiling_dir (or in this process without it), for the
+users listed in settings.profiling_user_ids
+"""
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from models import ProfileListResponse, ProfileSummary
+from auth import get_current_user_id
+from config import settings
+from profiling import profiler
+
+router = APIRouter(prefix="/profiles", tags=["Profiles"])
+
+
+async def get_profiling_user_id(user_id: str = Depends(get_current_user_id)) -> str:
+    """Dependency admitting only the users allowed to profile"""
+    if user_id not in settings.profiling_user_ids_list:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not allowed to read profiles",
+        )
+    return user_id
+
+
+@router.get("", response_model=ProfileListResponse, status_code=status.HTTP_200_OK)
+async def list_profiles(user_id: str = Depends(get_profiling_user_id)):
+    """
+    Profiles kept, newest first
+    """
+    summaries = await run_in_threadpool(profiler.summaries)
+    return ProfileListResponse(items=[ProfileSummary(**summary) for summary in summaries])
+
+
+@router.get("/{profile_id}", response_class=PlainTextResponse, status_code=status.HTTP_200_OK)
+async def download_profile(profile_id: str, user_id: str = Depends(get_profiling_user_id)):
+    """
+    A profile as collapsed stacks, for flamegraph.pl, speedscope or inferno
+    """
+    collapsed = await run_in_threadpool(profiler.collapsed, profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return PlainTextResponse(
+        collapsed,
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.txt"'},
+    )
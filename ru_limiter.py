@@ -0,0 +1,232 @@
+"""
+Client-side request unit budget for Cosmos DB
+Each container gets a token bucket refilled at settings.cosmos_ru_per_second
+and drained by the request charges calls actually report, so the process
+stays under its provisioned throughput instead of running into 429s. When
+Cosmos throttles anyway, the bucket pauses for x-ms-retry-after-ms and its
+refill rate backs off multiplicatively, recovering additively while calls
+succeed. Writes (and anything run under bulk()) may only spend tokens above a
+reserve, which keeps headroom for interactive reads. Calls made for a client
+request, reads and writes alike, give up with a 503 when budget does not free
+up in time; bulk calls wait as long as it takes.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, Optional, TypeVar
+from azure.cosmos import exceptions
+from fastapi import HTTPException, status
+from config import settings
+from db_instrumentation import TrackedCall, track
+from metrics import DB_BUDGET_RATE, DB_BUDGET_WAIT, DB_THROTTLED
+from tracing import span
+import logging
+import math
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+INTERACTIVE = "interactive"
+# Writes made for a client request: kept above the reserve like bulk calls,
+# but with the interactive deadline
+WRITE = "write"
+BULK = "bulk"
+
+RETRY_AFTER_HEADER = "x-ms-retry-after-ms"
+# Used when a 429 carries no retry-after header
+DEFAULT_RETRY_AFTER_MS = 100
+# Multiplicative decrease on throttling, and the floor it stops at
+BACKOFF_FACTOR = 0.7
+MIN_RATE_FRACTION = 0.1
+# Fraction of the configured rate recovered per second without throttling
+RECOVERY_PER_SECOND = 0.05
+
+_priority: ContextVar[Optional[str]] = ContextVar("ru_priority", default=None)
+
+
+@contextmanager
+def bulk() -> Iterator[None]:
+    """Run every data-layer call in the block at bulk priority (for scripts)"""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class ThrottledError(HTTPException):
+    """Cosmos DB throughput is exhausted; the client should retry later"""
+
+    def __init__(self, retry_after_seconds: float):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database is busy, please retry shortly",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after_seconds)))},
+        )
+        self.retry_after_seconds = retry_after_seconds
+
+
+class RUBudget:
+    """Token bucket of request units with adaptive (AIMD) refill rate"""
+
+    def __init__(self, name: str, ru_per_second: float, bulk_reserve: float):
+        self.name = name
+        self.max_rate = ru_per_second
+        self.rate = ru_per_second
+        self.capacity = ru_per_second
+        self.bulk_floor = ru_per_second * bulk_reserve
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+        DB_BUDGET_RATE.set(self.rate, container=name)
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if now < self.paused_until:
+            return
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        if self.rate < self.max_rate:
+            recovered = elapsed * self.max_rate * RECOVERY_PER_SECOND
+            self.rate = min(self.max_rate, self.rate + recovered)
+            DB_BUDGET_RATE.set(self.rate, container=self.name)
+
+    def acquire(self, priority: str, deadline: Optional[float]) -> bool:
+        """
+        Wait until the bucket has tokens for a call of the given priority
+
+        The call's cost is unknown until it returns, so a call may start with
+        any positive balance and charge() can take the bucket into debt.
+
+        Returns:
+            bool: False if the deadline passed first
+        """
+        floor = 0.0 if priority == INTERACTIVE else self.bulk_floor
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens > floor:
+                    return True
+                wait = max(self.paused_until - now, (floor - self.tokens) / self.rate, 0.001)
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now)
+                self._condition.wait(wait)
+
+    def charge(self, request_charge: float):
+        with self._condition:
+            self._refill(time.monotonic())
+            self.tokens -= request_charge
+
+    def throttled(self, retry_after: float):
+        """Record a 429: pause for retry_after seconds and back off the rate"""
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.tokens = min(self.tokens, 0.0)
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate * BACKOFF_FACTOR)
+        DB_THROTTLED.inc(container=self.name)
+        DB_BUDGET_RATE.set(self.rate, container=self.name)
+
+
+_budgets: Dict[str, RUBudget] = {}
+_budgets_lock = threading.Lock()
+
+
+def budget_for(container: str) -> RUBudget:
+    budget = _budgets.get(container)
+    if budget is None:
+        with _budgets_lock:
+            budget = _budgets.setdefault(
+                container,
+                RUBudget(container, settings.cosmos_ru_per_second, settings.cosmos_bulk_reserve),
+            )
+    return budget
+
+
+def _retry_after_seconds(error: exceptions.CosmosHttpResponseError) -> float:
+    headers = getattr(error, "headers", None) or {}
+    retry_after_ms = float(headers.get(RETRY_AFTER_HEADER) or DEFAULT_RETRY_AFTER_MS)
+    # Jitter spreads out the retries of calls throttled together
+    return retry_after_ms / 1000 * random.uniform(1.0, 1.2)
+
+
+def execute(
+    container: str,
+    operation: str,
+    request: Callable[[TrackedCall], T],
+    query: Optional[str] = None,
+    priority: str = INTERACTIVE,
+) -> T:
+    """
+    Run request(call) against the container's RU budget, retrying on 429
+
+    request receives the TrackedCall for the attempt and must pass call.hook
+    as the SDK response_hook. Calls inside bulk() always run at bulk priority.
+
+    Raises:
+        ThrottledError: If the call is still throttled after the configured
+            retries, or an interactive or write call waited too long for budget
+    """
+    priority = _priority.get() or priority
+    # One span per call, covering budget waits and retries
+    with span(f"cosmos.{operation}", container=container, priority=priority):
+        return _execute(container, operation, request, query, priority)
+
+
+def _execute(
+    container: str,
+    operation: str,
+    request: Callable[[TrackedCall], T],
+    query: Optional[str],
+    priority: str,
+) -> T:
+    if settings.cosmos_ru_per_second <= 0:
+        # The SDK retries 429s itself; what it gives up on becomes a 503
+        try:
+            with track(operation, query) as call:
+                return request(call)
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code != 429:
+                raise
+            raise ThrottledError(_retry_after_seconds(e)) from e
+
+    budget = budget_for(container)
+    deadline = None
+    if priority != BULK:
+        deadline = time.monotonic() + settings.cosmos_throttle_max_wait_ms / 1000
+
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        if not budget.acquire(priority, deadline):
+            DB_BUDGET_WAIT.observe(time.perf_counter() - started, priority=priority)
+            raise ThrottledError(max(budget.paused_until - time.monotonic(), 1))
+        DB_BUDGET_WAIT.observe(time.perf_counter() - started, priority=priority)
+
+        call = None
+        try:
+            with track(operation, query) as call:
+                return request(call)
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code != 429:
+                raise
+            retry_after = _retry_after_seconds(e)
+            budget.throttled(retry_after)
+            attempt += 1
+            if attempt > settings.cosmos_throttle_max_retries:
+                logger.warning(
+                    f"{operation} on '{container}' still throttled after {attempt} attempts"
+                )
+                raise ThrottledError(retry_after)
+        finally:
+            if call is not None:
+                budget.charge(call.request_charge)
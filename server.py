@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Production server
+Runs the API under gunicorn with uvicorn workers: several processes (so
+every core is used), uvloop and httptools, optional preloading of the app in
+the master, worker recycling after a number of requests and a graceful drain
+on SIGTERM. Everything is configured from Settings (SERVER_* variables).
+Where gunicorn is unavailable (Windows) uvicorn's own process manager is used,
+without recycling.
+
+Usage:
+    python server.py           # production
+    python app.py              # development, single process with reload
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import uvicorn
+
+from config import settings
+
+try:
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+except ImportError:
+    # gunicorn needs fcntl, so it is unavailable on Windows
+    BaseApplication = None
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def worker_count() -> int:
+    """Configured worker count; 0 means one per CPU"""
+    return settings.server_workers or multiprocessing.cpu_count()
+
+
+def share_node(workers: int):
+    """
+    Set up the settings the worker processes share
+    COSMOS_RU_PER_SECOND is the node's budget, so each worker gets an even
+    share of it. The workers save metrics to one directory, emptied here so
+    counters start from zero, and profiles to another. Workers that uvicorn
+    spawns read their settings from the environment again, so these are
+    exported there too.
+    """
+    settings.cosmos_ru_per_second /= workers
+    os.environ["COSMOS_RU_PER_SECOND"] = str(settings.cosmos_ru_per_second)
+    logger.info(
+        f"{workers} workers, each with {settings.cosmos_ru_per_second:g} RU/s per container"
+    )
+
+    for path in shared_dir("metrics_multiprocess_dir", "metrics-").glob("*.json"):
+        path.unlink()
+    if settings.profiling_enabled:
+        shared_dir("profiling_dir", "profiles-")
+
+
+def shared_dir(setting: str, prefix: str) -> Path:
+    """The directory a setting names, or a temporary one removed on exit"""
+    if not getattr(settings, setting):
+        setattr(settings, setting, tempfile.mkdtemp(prefix=prefix))
+        atexit.register(shutil.rmtree, getattr(settings, setting), True)
+    os.environ[setting.upper()] = getattr(settings, setting)
+    directory = Path(getattr(settings, setting))
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def reset_after_fork():
+    """
+    Drop SDK clients, pools and threads a worker inherited from the master
+    They are recreated lazily on first use inside the worker.
+    """
+    from database import cosmos_db
+    from profiling import profiler
+    from rate_limit import bucket_store
+    from storage import blob_storage
+    from tracing import tracer
+
+    cosmos_db.reset_after_fork()
+    blob_storage.reset_after_fork()
+    bucket_store.reset_after_fork()
+    profiler.reset_after_fork()
+    tracer.reset_after_fork()
+
+
+if BaseApplication is not None:
+
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = {
+            "loop": settings.server_loop,
+            "http": settings.server_http,
+            "timeout_graceful_shutdown": settings.server_graceful_timeout_seconds,
+        }
+
+    class GunicornServer(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{settings.api_host}:{settings.api_port}",
+                "workers": worker_count(),
+                "worker_class": f"{__name__}.Worker",
+                "preload_app": settings.server_preload_app,
+                "keepalive": settings.server_keepalive_seconds,
+                "backlog": settings.server_backlog,
+                "max_requests": settings.server_max_requests,
+                "max_requests_jitter": settings.server_max_requests_jitter,
+                # SIGTERM lets in-flight requests finish for this long
+                "graceful_timeout": settings.server_graceful_timeout_seconds,
+                "timeout": settings.server_worker_timeout_seconds,
+                "post_fork": lambda arbiter, worker: reset_after_fork(),
+                "accesslog": "-",
+                "errorlog": "-",
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+
+            return app
+
+
+def run_uvicorn():
+    if settings.server_max_requests:
+        logger.warning("Worker recycling needs gunicorn; SERVER_MAX_REQUESTS is ignored")
+    uvicorn.run(
+        "app:app",
+        host=settings.api_host,
+        port=settings.api_port,
+        workers=worker_count(),
+        loop=settings.server_loop,
+        http=settings.server_http,
+        backlog=settings.server_backlog,
+        timeout_keep_alive=settings.server_keepalive_seconds,
+        timeout_graceful_shutdown=settings.server_graceful_timeout_seconds,
+        log_level="info",
+    )
+
+
+def main():
+    share_node(worker_count())
+    if BaseApplication is None:
+        run_uvicorn()
+    else:
+        GunicornServer().run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
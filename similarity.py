@@ -0,0 +1,188 @@
+"""
+Near-duplicate detection over perceptual hashes
+Each user's 64-bit image hashes (utils.perceptual_hash) are kept in a packed
+uint64 array. Looking up the images near one hash XORs it against the whole
+array and counts bits, a single vectorised pass that takes about a
+millisecond for 100k images. The duplicate report avoids comparing every
+pair: hashes within distance d of each other agree exactly on at least one of
+d + 1 disjoint bit blocks, so only hashes sharing a block value are compared.
+"""
+
+from typing import Dict, List, Tuple
+from database import cosmos_db
+from user_cache import UserCache
+import numpy as np
+
+HASH_BITS = 64
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    """Set bits of each uint64"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # SWAR bit count, for NumPy before 2.0
+    values = values - ((values >> np.uint64(1)) & _M1)
+    values = (values & _M2) + ((values >> np.uint64(2)) & _M2)
+    values = (values + (values >> np.uint64(4))) & _M4
+    return (values * _H01) >> np.uint64(56)
+
+
+def parse_hash(value: str) -> int:
+    return int(value, 16)
+
+
+class UserHashes:
+    """A user's media ids and hashes, in parallel growable arrays"""
+
+    def __init__(self, rows: List[Tuple[str, str]]):
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self._hashes = np.zeros(max(16, len(rows)), dtype=np.uint64)
+        for media_id, value in rows:
+            self.add(media_id, value)
+
+    @property
+    def hashes(self) -> np.ndarray:
+        return self._hashes[: len(self.ids)]
+
+    def add(self, media_id: str, value: str):
+        if media_id in self.positions:
+            self._hashes[self.positions[media_id]] = parse_hash(value)
+            return
+        if len(self.ids) == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+        self._hashes[len(self.ids)] = parse_hash(value)
+        self.positions[media_id] = len(self.ids)
+        self.ids.append(media_id)
+
+    def remove(self, media_id: str):
+        position = self.positions.pop(media_id, None)
+        if position is None:
+            return
+        # Move the last entry into the gap
+        last = len(self.ids) - 1
+        last_id = self.ids.pop()
+        if position != last:
+            self._hashes[position] = self._hashes[last]
+            self.ids[position] = last_id
+            self.positions[last_id] = position
+
+    def near(self, media_id: str, max_distance: int, limit: int) -> List[Tuple[str, int]]:
+        """(id, distance) of the closest other images, nearest first"""
+        position = self.positions.get(media_id)
+        if position is None:
+            return []
+        distances = popcount(self.hashes ^ self.hashes[position])
+        distances[position] = HASH_BITS + 1
+        (candidates,) = np.nonzero(distances <= max_distance)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(distances[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [(self.ids[index], int(distances[index])) for index in candidates]
+
+    def snapshot(self) -> Tuple[List[str], np.ndarray]:
+        return list(self.ids), self.hashes.copy()
+
+
+def duplicate_groups(ids: List[str], hashes: np.ndarray, max_distance: int) -> List[List[str]]:
+    """
+    Groups of ids whose images are within max_distance of another member,
+    largest first (linked transitively, like connected components)
+    """
+    # Identical hashes are grouped by np.unique; only distinct ones are paired
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    parent: Dict[int, int] = {}
+
+    def find(node: int) -> int:
+        while parent.get(node, node) != node:
+            parent[node] = parent.get(parent[node], parent[node])
+            node = parent[node]
+        return node
+
+    for left, right in _close_pairs(unique, max_distance):
+        left_root, right_root = find(left), find(right)
+        if left_root != right_root:
+            parent[max(left_root, right_root)] = min(left_root, right_root)
+
+    roots = np.arange(len(unique))
+    for node in list(parent):
+        roots[node] = find(node)
+    labels = roots[inverse.reshape(-1)]
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    duplicates = [
+        [ids[index] for index in order[start:start + size].tolist()]
+        for start, size in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist())
+    ]
+    duplicates.sort(key=len, reverse=True)
+    return duplicates
+
+
+def _close_pairs(hashes: np.ndarray, max_distance: int) -> List[Tuple[int, int]]:
+    """Index pairs of distinct hashes within max_distance (hashes must be unique)"""
+    if len(hashes) < 2 or max_distance <= 0:
+        return []
+    blocks = min(max_distance + 1, HASH_BITS)
+    edges = np.linspace(0, HASH_BITS, blocks + 1).astype(np.uint64)
+    pairs = set()
+    for low, high in zip(edges[:-1], edges[1:]):
+        mask = np.uint64((1 << int(high - low)) - 1)
+        keys = (hashes >> low) & mask
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        # Compare each hash with the ones 1, 2, ... places after it in block
+        # order; a position whose run of equal block values has ended drops
+        # out, so the work is proportional to the candidate pairs
+        (starts,) = np.nonzero(sorted_keys[:-1] == sorted_keys[1:])
+        offset = 1
+        while len(starts):
+            left, right = order[starts], order[starts + offset]
+            close = popcount(hashes[left] ^ hashes[right]) <= max_distance
+            if close.any():
+                pairs.update(zip(left[close].tolist(), right[close].tolist()))
+            offset += 1
+            starts = starts[starts + offset < len(order)]
+            starts = starts[sorted_keys[starts] == sorted_keys[starts + offset]]
+    return list(pairs)
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self._cache = UserCache(
+            lambda user_id: UserHashes(cosmos_db.get_perceptual_hashes(user_id))
+        )
+
+    def similar(
+        self, user_id: str, media_id: str, max_distance: int, limit: int
+    ) -> List[Tuple[str, int]]:
+        """
+        (id, distance) of the user's images within max_distance of media_id
+        Blocks on a database query the first time a user is looked up.
+        """
+        hashes = self._cache.get(user_id)
+        with self._cache.lock:
+            return hashes.near(media_id, max_distance, limit)
+
+    def duplicates(self, user_id: str, max_distance: int) -> List[List[str]]:
+        """Groups of the user's near-duplicate images, largest first"""
+        hashes = self._cache.get(user_id)
+        # The report takes longer than a lookup, so it runs on a copy
+        with self._cache.lock:
+            ids, values = hashes.snapshot()
+        return duplicate_groups(ids, values, max_distance)
+
+    def add(self, user_id: str, media_id: str, value: str):
+        self._cache.update(user_id, lambda hashes: hashes.add(media_id, value))
+
+    def remove(self, user_id: str, media_id: str):
+        self._cache.update(user_id, lambda hashes: hashes.remove(media_id))
+
+
+similarity_index = SimilarityIndex()
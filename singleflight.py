@@ -0,0 +1,121 @@
+"""
+Single-flight coalescing of identical reads
+When a user's gallery is open in several tabs, or the frontend fires the same
+request twice, identical reads reach the data layer at the same moment. A
+method wrapped with coalesced() runs once per distinct set of arguments at a
+time: calls that arrive while an identical one is in flight wait for it and
+get a copy of its result (or its exception) instead of sending their own
+request.
+
+A write to a user's media calls forget(user_id), so a read issued after the
+write starts a new request rather than joining one that may predate it.
+"""
+
+from typing import Any, Callable, Dict, Hashable, Optional, TypeVar
+from config import settings
+from metrics import SINGLEFLIGHT_CALLS
+import copy
+import functools
+import inspect
+import threading
+
+T = TypeVar("T")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """In-flight calls by (user id, key)"""
+
+    def __init__(self):
+        self._flights: Dict[tuple, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, operation: str, user_id: str, key: Hashable, call: Callable[[], T]) -> T:
+        flight_key = (user_id, operation, key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = _Flight()
+            else:
+                flight.followers += 1
+        SINGLEFLIGHT_CALLS.inc(operation=operation, role="leader" if leader else "follower")
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            # Callers may modify what they get back, so each has its own copy
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = call()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(flight_key) is flight:
+                    del self._flights[flight_key]
+                shared = flight.followers > 0
+            if shared and flight.error is None:
+                # The leader keeps the original; followers copy from a
+                # snapshot the leader cannot change under them
+                flight.result = copy.deepcopy(flight.result)
+            flight.done.set()
+
+    def forget(self, user_id: str):
+        """Let later calls for the user start new requests instead of joining"""
+        with self._lock:
+            for flight_key in [key for key in self._flights if key[0] == user_id]:
+                del self._flights[flight_key]
+
+
+single_flight = SingleFlight()
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def coalesced(operation: str) -> Callable:
+    """
+    Coalesce concurrent calls of a data-layer method with equal arguments
+    The method must take user_id and only read.
+    """
+
+    def decorator(method: Callable[..., T]) -> Callable[..., T]:
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs) -> T:
+            if not settings.singleflight_enabled:
+                return method(self, *args, **kwargs)
+            # Positional, keyword and defaulted arguments give the same key
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            del arguments["self"]
+            key = _freeze(arguments)
+            return single_flight.do(
+                operation,
+                arguments["user_id"],
+                key,
+                lambda: method(self, *args, **kwargs),
+            )
+
+        return wrapper
+
+    return decorator
@@ -1,38 +1,134 @@
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions, ContentSettings
+from azure.storage.blob import (
+    BlobServiceClient,
+    ContainerClient,
+    generate_blob_sas,
+    BlobSasPermissions,
+    ContentSettings,
+)
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, BinaryIO
+from functools import cached_property
+from typing import Optional, BinaryIO, Iterator
 from config import settings
+from hedging import hedged
+from tracing import traced
 import logging
 import os
+import threading
 import uuid
 
 logger = logging.getLogger(__name__)
 
+# Size of the pieces iter_file yields; streamed downloads hold at most this
+# much of a blob in memory at a time
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class StorageBackend(ABC):
+    """
+    Interface of a media file store
+    Files are addressed by blob names of the form '<user_id>/<file>'.
+    """
+
+    @abstractmethod
+    def provision(self):
+        """Create the underlying container or directory"""
+
+    @abstractmethod
+    def warm_up(self, connections: int = 4):
+        """Prepare connections before the app reports ready"""
+
+    @abstractmethod
+    def upload_file(
+        self, file: BinaryIO, user_id: str, original_filename: str, content_type: str
+    ) -> tuple[str, str]:
+        """Store a file; returns (blob_name, blob_url)"""
+
+    @abstractmethod
+    def delete_file(self, blob_name: str) -> bool:
+        """Delete a file; returns False if it could not be deleted"""
+
+    @abstractmethod
+    def get_blob_url(self, blob_name: str) -> str:
+        """Get a time-limited URL the client can download the file from"""
+
+    @abstractmethod
+    def read_file(self, blob_name: str, offset: int = 0, length: Optional[int] = None) -> bytes:
+        """Read a file, or length bytes of it from offset"""
+
+    @abstractmethod
+    def iter_file(self, blob_name: str) -> Iterator[bytes]:
+        """Stream a file in chunks of at most STREAM_CHUNK_SIZE bytes"""
+
+    @abstractmethod
+    def list_files(self, user_id: str) -> Iterator[tuple[str, datetime]]:
+        """(blob name, last modified in UTC) of the files under the user's prefix, in name order"""
+
+    def reset_after_fork(self):
+        """Forget connections inherited from a parent process"""
+
+    @staticmethod
+    def generate_blob_name(user_id: str, original_filename: str) -> str:
+        """Generate a unique blob name under the user's prefix"""
+        file_extension = os.path.splitext(original_filename)[1]
+        timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        unique_id = str(uuid.uuid4())[:8]
+        return f"{user_id}/{timestamp}_{unique_id}{file_extension}"
+
+
+class BlobStorageClient(StorageBackend):
+    """Azure Blob Storage backend"""
 
-class BlobStorageClient:
     def __init__(self):
-        self.blob_service_client = BlobServiceClient.from_connection_string(
-            settings.azure_storage_connection_string
-        )
         self.container_name = settings.blob_container_name
-        self.container_client = None
-
-    def initialize(self):
-        """Initialize blob container"""
+        self._blob_service_client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def blob_service_client(self) -> BlobServiceClient:
+        """SDK client, created on first use"""
+        if self._blob_service_client is None:
+            with self._client_lock:
+                if self._blob_service_client is None:
+                    # Downloads fetch STREAM_CHUNK_SIZE ranges (instead of a
+                    # 32 MB first request) so streamed reads stay small
+                    self._blob_service_client = BlobServiceClient.from_connection_string(
+                        settings.azure_storage_connection_string,
+                        max_single_get_size=STREAM_CHUNK_SIZE,
+                        max_chunk_get_size=STREAM_CHUNK_SIZE,
+                    )
+        return self._blob_service_client
+
+    def reset_after_fork(self):
+        self._blob_service_client = None
+        self._client_lock = threading.Lock()
+        self.__dict__.pop("container_client", None)
+
+    @cached_property
+    def container_client(self) -> ContainerClient:
+        return self.blob_service_client.get_container_client(self.container_name)
+
+    def provision(self):
+        """Create blob container if it doesn't exist"""
         try:
-            # Create container if it doesn't exist
-            self.container_client = (
-                self.blob_service_client.get_container_client(self.container_name)
-            )
             if not self.container_client.exists():
                 self.container_client.create_container()
                 logger.info(f"Container '{self.container_name}' created")
             else:
                 logger.info(f"Container '{self.container_name}' already exists")
         except Exception as e:
-            logger.error(f"Failed to initialize blob storage: {e}")
+            logger.error(f"Failed to provision blob storage: {e}")
             raise
 
+    def warm_up(self, connections: int = 4):
+        """Open connections with HEAD requests for a blob that does not exist"""
+        blob_client = self.container_client.get_blob_client("__warmup__")
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for probe in [executor.submit(blob_client.exists) for _ in range(connections)]:
+                probe.result()
+
+    @traced("blob.upload_file")
     def upload_file(
         self, file: BinaryIO, user_id: str, original_filename: str, content_type: str
     ) -> tuple[str, str]:
@@ -42,10 +138,7 @@ class BlobStorageClient:
         """
         try:
             # Generate unique filename
-            file_extension = os.path.splitext(original_filename)[1]
-            timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            unique_id = str(uuid.uuid4())[:8]
-            blob_name = f"{user_id}/{timestamp}_{unique_id}{file_extension}"
+            blob_name = self.generate_blob_name(user_id, original_filename)
 
             # Upload to blob storage
             blob_client = self.blob_service_client.get_blob_client(
@@ -68,6 +161,7 @@ class BlobStorageClient:
             logger.error(f"Failed to upload file: {e}")
             raise
 
+    @traced("blob.delete_file")
     def delete_file(self, blob_name: str) -> bool:
         """Delete file from blob storage"""
         try:
@@ -81,6 +175,31 @@ class BlobStorageClient:
             logger.error(f"Failed to delete file: {e}")
             return False
 
+    @traced("blob.read_file")
+    def read_file(self, blob_name: str, offset: int = 0, length: Optional[int] = None) -> bytes:
+        """
+        Download a blob or a byte range of it
+        Reads of at most settings.hedging_max_blob_bytes are hedged.
+        """
+        blob_client = self.container_client.get_blob_client(blob_name)
+
+        def download() -> bytes:
+            return blob_client.download_blob(offset=offset, length=length).readall()
+
+        if length is not None and length <= settings.hedging_max_blob_bytes:
+            return hedged("read_file", download)
+        return download()
+
+    def iter_file(self, blob_name: str) -> Iterator[bytes]:
+        """Stream a blob as a sequence of ranged downloads"""
+        blob_client = self.container_client.get_blob_client(blob_name)
+        yield from blob_client.download_blob().chunks()
+
+    def list_files(self, user_id: str) -> Iterator[tuple[str, datetime]]:
+        """List the user's blobs; the service returns them in name order, page by page"""
+        for blob in self.container_client.list_blobs(name_starts_with=f"{user_id}/"):
+            yield blob.name, blob.last_modified
+
     def _generate_blob_url_with_sas(
         self, blob_name: str, expiry_hours: int = 24 * 365
     ) -> str:
@@ -119,5 +238,16 @@ class BlobStorageClient:
         return self._generate_blob_url_with_sas(blob_name)
 
 
+def create_storage_backend() -> StorageBackend:
+    """Create the storage backend selected by settings.storage_backend"""
+    if settings.storage_backend == "azure":
+        return BlobStorageClient()
+    if settings.storage_backend == "local":
+        from storage_local import LocalFileStorageClient
+
+        return LocalFileStorageClient()
+    raise ValueError(f"Unknown storage backend: '{settings.storage_backend}'")
+
+
 # Global instance
-blob_storage = BlobStorageClient()
+blob_storage = create_storage_backend()
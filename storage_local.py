@@ -0,0 +1,171 @@
+"""
+Local filesystem storage backend
+Files live under settings.local_storage_path in a sharded layout,
+<root>/<shard>/<user_id>/<file>, where the shard is derived from the user id
+so no single directory grows too large. Writes are atomic (temp file, fsync,
+rename) and files are served by routes_files through signed URLs.
+"""
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+from urllib.parse import quote
+from config import settings
+from storage import STREAM_CHUNK_SIZE, StorageBackend
+from tracing import traced
+import hashlib
+import hmac
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class LocalFileStorageClient(StorageBackend):
+    """Local filesystem backend"""
+
+    def __init__(self):
+        self.root = Path(settings.local_storage_path).resolve()
+
+    def provision(self):
+        """Create the storage root if it doesn't exist"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Local storage root '{self.root}' is ready")
+
+    def warm_up(self, connections: int = 4):
+        """Check the storage root is present; there are no connections to open"""
+        if not self.root.is_dir():
+            raise FileNotFoundError(f"Local storage root '{self.root}' does not exist")
+
+    def path_for(self, blob_name: str) -> Path:
+        """
+        Map a blob name to its sharded path on disk
+
+        Raises:
+            ValueError: If the blob name could escape the storage root
+        """
+        parts = blob_name.split("/")
+        if len(parts) < 2 or any(part in ("", ".", "..") or "\\" in part for part in parts):
+            raise ValueError(f"Invalid blob name: '{blob_name}'")
+        shard = hashlib.sha1(parts[0].encode()).hexdigest()[:2]
+        return self.root.joinpath(shard, *parts)
+
+    @traced("blob.upload_file")
+    def upload_file(
+        self, file: BinaryIO, user_id: str, original_filename: str, content_type: str
+    ) -> tuple[str, str]:
+        """
+        Write file atomically to local storage
+        Returns: (blob_name, blob_url)
+        """
+        try:
+            blob_name = self.generate_blob_name(user_id, original_filename)
+            path = self.path_for(blob_name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Write to a temp file in the same directory, then rename over the
+            # final name so readers never see a partial file
+            fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".upload-")
+            try:
+                with os.fdopen(fd, "wb") as temp_file:
+                    shutil.copyfileobj(file, temp_file, COPY_BUFFER_SIZE)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                # mkstemp creates 0600 files; let a fronting web server read them
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            self._fsync_directory(path.parent)
+
+            logger.info(f"File stored successfully: {blob_name}")
+            return blob_name, self.get_blob_url(blob_name)
+
+        except Exception as e:
+            logger.error(f"Failed to store file: {e}")
+            raise
+
+    @staticmethod
+    def _fsync_directory(directory: Path):
+        """Persist the rename itself (no-op where directories can't be opened)"""
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @traced("blob.delete_file")
+    def delete_file(self, blob_name: str) -> bool:
+        """Delete file from local storage"""
+        try:
+            self.path_for(blob_name).unlink()
+            logger.info(f"File deleted successfully: {blob_name}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to delete file: {e}")
+            return False
+
+    @traced("blob.read_file")
+    def read_file(self, blob_name: str, offset: int = 0, length: Optional[int] = None) -> bytes:
+        """Read a file, or length bytes of it from offset"""
+        with open(self.path_for(blob_name), "rb") as file:
+            file.seek(offset)
+            return file.read() if length is None else file.read(length)
+
+    def iter_file(self, blob_name: str) -> Iterator[bytes]:
+        """Stream a file in chunks"""
+        with open(self.path_for(blob_name), "rb") as file:
+            while chunk := file.read(STREAM_CHUNK_SIZE):
+                yield chunk
+
+    def list_files(self, user_id: str) -> Iterator[tuple[str, datetime]]:
+        """List the user's directory, including temp files left by interrupted uploads"""
+        directory = self.path_for(f"{user_id}/_").parent
+        try:
+            entries = sorted(
+                (entry.name, entry.stat().st_mtime)
+                for entry in os.scandir(directory)
+                if entry.is_file()
+            )
+        except FileNotFoundError:
+            return
+        for name, modified in entries:
+            yield f"{user_id}/{name}", datetime.fromtimestamp(modified, timezone.utc)
+
+    @staticmethod
+    def _signature(blob_name: str, expires: int) -> str:
+        message = f"{blob_name}\n{expires}".encode()
+        return hmac.new(
+            settings.jwt_secret_key.encode(), message, hashlib.sha256
+        ).hexdigest()
+
+    def get_blob_url(self, blob_name: str) -> str:
+        """Get a signed URL served by routes_files"""
+        expires = int(time.time()) + settings.local_storage_url_expiry_hours * 3600
+        signature = self._signature(blob_name, expires)
+        return f"/api/files/{quote(blob_name)}?expires={expires}&sig={signature}"
+
+    def resolve_signed(self, blob_name: str, expires: int, signature: str) -> Optional[Path]:
+        """
+        Check a signed URL and return the file path it grants access to
+
+        Returns:
+            Path | None: The path, or None if the signature is invalid or expired
+        """
+        if expires < time.time():
+            return None
+        if not hmac.compare_digest(self._signature(blob_name, expires), signature):
+            return None
+        try:
+            return self.path_for(blob_name)
+        except ValueError:
+            return None
@@ -0,0 +1,85 @@
+"""
+Per-user tag index for facets and autocomplete
+Each user's tags and the number of media items carrying them are loaded once
+with a single aggregate query and kept in a sorted list, so a prefix lookup is
+a binary search plus a scan of the matches. Uploads, updates and deletes
+adjust the counts in place (see user_cache for how copies are kept fresh).
+"""
+
+from bisect import bisect_left, insort
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+from database import cosmos_db
+from user_cache import UserCache
+import heapq
+
+
+class UserTags:
+    """A user's tag counts, with the tags sorted case-insensitively"""
+
+    def __init__(self, counts: Dict[str, int]):
+        self.counts = {tag: count for tag, count in counts.items() if count > 0}
+        self.keys = sorted((tag.casefold(), tag) for tag in self.counts)
+
+    def adjust(self, tag: str, delta: int):
+        count = self.counts.get(tag, 0) + delta
+        if count > 0:
+            if tag not in self.counts:
+                insort(self.keys, (tag.casefold(), tag))
+            self.counts[tag] = count
+        elif tag in self.counts:
+            del self.counts[tag]
+            del self.keys[bisect_left(self.keys, (tag.casefold(), tag))]
+
+    def suggest(self, prefix: str, limit: int) -> List[tuple[str, int]]:
+        """Tags starting with prefix (any case), most used first"""
+        folded = prefix.casefold()
+        keys = self.keys
+        matches = []
+        index = bisect_left(keys, (folded,))
+        while index < len(keys) and keys[index][0].startswith(folded):
+            matches.append(keys[index][1])
+            index += 1
+        best = heapq.nsmallest(
+            limit, matches, key=lambda tag: (-self.counts[tag], tag.casefold())
+        )
+        return [(tag, self.counts[tag]) for tag in best]
+
+
+class TagIndex:
+    def __init__(self):
+        self._cache = UserCache(lambda user_id: UserTags(cosmos_db.get_tag_counts(user_id)))
+
+    def peek(
+        self, user_id: str, prefix: str = "", limit: int = 10
+    ) -> Optional[List[tuple[str, int]]]:
+        """Like suggest(), but None instead of loading a user not in memory"""
+        with self._cache.lock:
+            tags = self._cache.peek(user_id)
+            return None if tags is None else tags.suggest(prefix, limit)
+
+    def suggest(self, user_id: str, prefix: str = "", limit: int = 10) -> List[tuple[str, int]]:
+        """
+        The user's tags starting with prefix and their counts, most used first
+        Blocks on a database query the first time a user is looked up.
+        """
+        tags = self._cache.get(user_id)
+        with self._cache.lock:
+            return tags.suggest(prefix, limit)
+
+    def update(
+        self, user_id: str, removed: Iterable[str] = (), added: Iterable[str] = ()
+    ):
+        """Record that a media item lost the removed tags and gained the added ones"""
+        deltas = Counter(set(added))
+        deltas.subtract(set(removed))
+
+        def change(tags: UserTags):
+            for tag, delta in deltas.items():
+                if tag and delta:
+                    tags.adjust(tag, delta)
+
+        self._cache.update(user_id, change)
+
+
+tag_index = TagIndex()
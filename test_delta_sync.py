@@ -0,0 +1,95 @@
+from database import CosmosDBClient
+from delta_sync import WatermarkExpiredError, decode_watermark
+import database
+import pytest
+
+NOW = 1_700_000_000
+DAY = 86400
+
+
+class FakeCosmos(CosmosDBClient):
+    """Answers get_media_changes queries from in-memory documents"""
+
+    def __init__(self, media=(), tombstones=()):
+        super().__init__()
+        self.media_container = list(media)
+        self.tombstones_container = list(tombstones)
+
+    @staticmethod
+    def _query(container, operation, query, parameters, **kwargs):
+        values = {parameter["name"]: parameter["value"] for parameter in parameters}
+        after = (values["@ts"], values["@id"])
+        found = sorted(
+            (doc for doc in container if (doc["_ts"], doc["id"]) > after and doc["_ts"] <= values["@until"]),
+            key=lambda doc: (doc["_ts"], doc["id"]),
+        )
+        return found[: values["@limit"]]
+
+
+def media(id: str, ts: int) -> dict:
+    return {"id": id, "userId": "u", "_ts": ts}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [NOW]
+    monkeypatch.setattr(database.time, "time", lambda: now[0])
+    return now
+
+
+def test_empty_library_watermark_does_not_expire(clock):
+    client = FakeCosmos()
+    changed, deleted, watermark, more = client.get_media_changes("u", None)
+    assert (changed, deleted, more) == ([], [], False)
+
+    for _ in range(3):
+        clock[0] += 20 * DAY
+        changed, _, watermark, _ = client.get_media_changes("u", watermark)
+        assert changed == []
+    assert decode_watermark(watermark)[0] > NOW
+
+
+def test_idle_library_watermark_does_not_expire(clock):
+    client = FakeCosmos(media=[media("a", NOW - 90 * DAY), media("b", NOW - 80 * DAY)])
+    changed, _, watermark, _ = client.get_media_changes("u", None)
+    assert [doc["id"] for doc in changed] == ["a", "b"]
+
+    for _ in range(3):
+        clock[0] += 20 * DAY
+        changed, _, watermark, _ = client.get_media_changes("u", watermark)
+        assert changed == []
+
+    client.media_container.append(media("c", clock[0] - 1))
+    clock[0] += 20 * DAY
+    changed, _, _, _ = client.get_media_changes("u", watermark)
+    assert [doc["id"] for doc in changed] == ["c"]
+
+
+def test_unsettled_changes_are_held_back(clock):
+    client = FakeCosmos(media=[media("a", NOW - 1)])
+    changed, _, watermark, _ = client.get_media_changes("u", None)
+    assert changed == []
+
+    clock[0] += 60
+    changed, _, _, _ = client.get_media_changes("u", watermark)
+    assert [doc["id"] for doc in changed] == ["a"]
+
+
+def test_watermark_left_unused_past_the_tombstone_ttl_expires(clock):
+    client = FakeCosmos(media=[media("a", NOW - DAY)], tombstones=[media("b", NOW - DAY)])
+    _, deleted, watermark, _ = client.get_media_changes("u", None)
+    assert [doc["id"] for doc in deleted] == ["b"]
+
+    clock[0] += 31 * DAY
+    with pytest.raises(WatermarkExpiredError):
+        client.get_media_changes("u", watermark)
+
+
+def test_client_paging_through_changes_is_caught_up_only_to_its_position(clock):
+    client = FakeCosmos(media=[media(f"m{i}", NOW - 40 * DAY + i) for i in range(3)])
+    changed, _, watermark, more = client.get_media_changes("u", None, limit=2)
+    assert more and len(changed) == 2
+
+    clock[0] += DAY
+    with pytest.raises(WatermarkExpiredError):
+        client.get_media_changes("u", watermark)
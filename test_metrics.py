@@ -0,0 +1,46 @@
+from metrics import Registry
+import json
+import metrics
+import os
+import pytest
+
+
+@pytest.fixture
+def worker_registry(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, "registry", registry)
+    return registry
+
+
+def test_render_all_sums_workers_and_labels_gauges_by_pid(tmp_path, worker_registry):
+    requests = worker_registry.counter("requests_total", "Requests", ("route",))
+    latency = worker_registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    in_flight = worker_registry.gauge("in_flight", "In flight")
+    requests.inc(route="/a")
+    latency.observe(0.05)
+    in_flight.set(2)
+
+    # Another worker's snapshot, and one left by a worker that has exited
+    other = {
+        "requests_total": [[["/a"], 3], [["/b"], 1]],
+        "latency_seconds": [[[], [[0, 1, 0], 0.5, 1]]],
+        "in_flight": [[[], 5]],
+    }
+    (tmp_path / "1.json").write_text(json.dumps(other))
+    (tmp_path / "2.json").write_text(json.dumps(other))
+    os.utime(tmp_path / "2.json", (0, 0))
+
+    lines = metrics.render_all(str(tmp_path)).splitlines()
+    assert 'requests_total{route="/a"} 7' in lines
+    assert 'requests_total{route="/b"} 2' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert "latency_seconds_count 3" in lines
+    assert f'in_flight{{pid="{os.getpid()}"}} 2' in lines
+    assert 'in_flight{pid="1"} 5' in lines
+    assert not any(line.startswith('in_flight{pid="2"}') for line in lines)
+
+
+def test_render_without_snapshots_is_this_process(worker_registry):
+    worker_registry.gauge("in_flight", "In flight").set(1)
+    assert worker_registry.render().splitlines()[-1] == "in_flight 1"
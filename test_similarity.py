@@ -0,0 +1,104 @@
+from similarity import HASH_BITS, UserHashes, _close_pairs, duplicate_groups, popcount
+import numpy as np
+import pytest
+
+
+def brute_force_pairs(hashes: np.ndarray, max_distance: int) -> set:
+    values = hashes.tolist()
+    return {
+        (left, right)
+        for left in range(len(values))
+        for right in range(left + 1, len(values))
+        if bin(values[left] ^ values[right]).count("1") <= max_distance
+    }
+
+
+def brute_force_groups(ids, hashes: np.ndarray, max_distance: int) -> list:
+    parent = list(range(len(ids)))
+
+    def find(node):
+        while parent[node] != node:
+            node = parent[node]
+        return node
+
+    values = hashes.tolist()
+    for left in range(len(values)):
+        for right in range(left + 1, len(values)):
+            if bin(values[left] ^ values[right]).count("1") <= max_distance:
+                parent[find(right)] = find(left)
+    groups = {}
+    for index in range(len(ids)):
+        groups.setdefault(find(index), []).append(ids[index])
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def clustered_hashes(rng, clusters: int, size: int, flips: int) -> np.ndarray:
+    """Random centres, each with neighbours a few bit flips away"""
+    values = []
+    for centre in rng.integers(0, 2**63, size=clusters, dtype=np.uint64).tolist():
+        values.append(centre)
+        for _ in range(size - 1):
+            bits = rng.choice(HASH_BITS, size=rng.integers(0, flips + 1), replace=False)
+            values.append(centre ^ sum(1 << int(bit) for bit in bits))
+    return np.array(values, dtype=np.uint64)
+
+
+def test_popcount_matches_python():
+    rng = np.random.default_rng(1)
+    values = rng.integers(0, 2**63, size=1000, dtype=np.uint64) << np.uint64(1)
+    values[:3] = [0, 2**64 - 1, 1 << 63]
+    assert popcount(values).tolist() == [bin(value).count("1") for value in values.tolist()]
+
+
+@pytest.mark.parametrize("max_distance", [1, 4, 8, 16])
+@pytest.mark.parametrize("seed", range(5))
+def test_close_pairs_matches_brute_force(seed, max_distance):
+    rng = np.random.default_rng(seed)
+    hashes = np.unique(clustered_hashes(rng, clusters=20, size=6, flips=max_distance + 2))
+    found = {tuple(sorted(pair)) for pair in _close_pairs(hashes, max_distance)}
+    assert found == brute_force_pairs(hashes, max_distance)
+
+
+@pytest.mark.parametrize("max_distance", [0, 2, 4, 8])
+@pytest.mark.parametrize("seed", range(5))
+def test_duplicate_groups_match_brute_force(seed, max_distance):
+    rng = np.random.default_rng(100 + seed)
+    hashes = clustered_hashes(rng, clusters=15, size=5, flips=max_distance + 1)
+    # Exact copies are grouped even at distance 0
+    hashes = np.concatenate([hashes, hashes[:7]])
+    ids = [f"m{index}" for index in range(len(hashes))]
+
+    groups = duplicate_groups(ids, hashes, max_distance)
+
+    assert sorted(map(sorted, groups)) == sorted(
+        map(sorted, brute_force_groups(ids, hashes, max_distance))
+    )
+    assert [len(group) for group in groups] == sorted(map(len, groups), reverse=True)
+
+
+def test_groups_link_transitively():
+    hashes = np.array([0b0000, 0b0011, 0b1111, 0xFFFF << 40], dtype=np.uint64)
+    assert duplicate_groups(["a", "b", "c", "d"], hashes, 2) == [["a", "b", "c"]]
+
+
+def test_user_hashes_near_add_and_remove():
+    hashes = UserHashes([("a", "0"), ("b", "1"), ("c", "3"), ("d", "ff")])
+    assert hashes.near("a", 2, 10) == [("b", 1), ("c", 2)]
+    assert hashes.near("a", 2, 1) == [("b", 1)]
+    assert hashes.near("missing", 2, 10) == []
+
+    hashes.remove("b")
+    hashes.add("c", "0")
+    assert hashes.near("a", 64, 10) == [("c", 0), ("d", 8)]
+    ids, values = hashes.snapshot()
+    assert dict(zip(ids, values.tolist())) == {"a": 0, "c": 0, "d": 0xFF}
+
+
+def test_user_hashes_grow_past_initial_capacity():
+    hashes = UserHashes([])
+    for index in range(100):
+        hashes.add(f"m{index}", format(index, "x"))
+    assert len(hashes.hashes) == 100
+    assert hashes.near("m0", 1, 100) == [
+        (f"m{1 << bit}", 1) for bit in range(7) if 1 << bit < 100
+    ]
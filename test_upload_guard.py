@@ -0,0 +1,72 @@
+from fastapi import HTTPException
+from upload_guard import FileSniffer
+import pytest
+
+BOUNDARY = b"xyz"
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(100)
+
+
+def part(headers: str, content: bytes) -> bytes:
+    return b"--" + BOUNDARY + b"\r\n" + headers.encode() + b"\r\n\r\n" + content + b"\r\n"
+
+
+def field(name: str, value: bytes) -> bytes:
+    return part(f'Content-Disposition: form-data; name="{name}"', value)
+
+
+def file(content: bytes, content_type: str = "image/png") -> bytes:
+    return part(
+        f'Content-Disposition: form-data; name="file"; filename="a.png"\r\n'
+        f"Content-Type: {content_type}",
+        content,
+    )
+
+
+def feed(body: bytes, chunk_size: int = 1000) -> FileSniffer:
+    sniffer = FileSniffer(BOUNDARY)
+    for offset in range(0, len(body), chunk_size):
+        if sniffer.done:
+            break
+        sniffer.feed(body[offset:offset + chunk_size], final=offset + chunk_size >= len(body))
+    return sniffer
+
+
+def rejected(body: bytes, chunk_size: int = 1000) -> str:
+    with pytest.raises(HTTPException) as raised:
+        feed(body, chunk_size)
+    assert raised.value.status_code == 415
+    return raised.value.detail
+
+
+END = b"--" + BOUNDARY + b"--\r\n"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_allowed_file_passes_whatever_the_chunking(chunk_size):
+    assert feed(field("description", b"hi") + file(PNG) + END, chunk_size).done
+
+
+def test_large_field_before_the_file_does_not_skip_the_check():
+    body = field("description", b"x" * 500_000) + file(b"MZ\x90\x00" + bytes(100)) + END
+    assert "not an allowed" in rejected(body, 65536)
+
+
+def test_large_field_before_an_allowed_file_is_scanned_in_bounded_memory():
+    sniffer = FileSniffer(BOUNDARY)
+    sniffer.feed(field("description", b"x" * 500_000), final=False)
+    assert len(sniffer._buffer) < len(BOUNDARY) + 2
+    sniffer.feed(file(PNG) + END, final=True)
+    assert sniffer.done
+
+
+def test_body_without_a_file_part_is_refused():
+    assert rejected(field("description", b"hi") + END) == "Upload has no file part"
+
+
+def test_declared_type_must_match_the_sniffed_one():
+    assert rejected(file(PNG, "image/jpeg") + END) == "File content is image/png, not image/jpeg"
+    assert rejected(file(PNG, "video/mp4") + END) == "File content is image/png, not video/mp4"
+
+
+def test_short_file_is_sniffed_at_the_end_of_the_body():
+    assert "not an allowed" in rejected(file(b"GIF8") + END, 3)
@@ -0,0 +1,186 @@
+from video_metadata import MAX_READS, WINDOW_BYTES, extract_video_metadata, file_reader
+import io
+import pytest
+import struct
+
+MP4_CREATED = 3_755_376_000  # 2023-01-01 in seconds since 1904
+
+
+# MP4 / QuickTime
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, payload: bytes) -> bytes:
+    return box(box_type, bytes(4) + payload)
+
+
+def mvhd(timescale: int, duration: int, created: int = MP4_CREATED) -> bytes:
+    times = struct.pack(">IIII", created, created, timescale, duration)
+    return full_box(b"mvhd", times + bytes(80))
+
+
+def tkhd(width: int, height: int, matrix: tuple) -> bytes:
+    return full_box(
+        b"tkhd",
+        struct.pack(">IIIII", 0, 0, 1, 0, 0)
+        + bytes(16)
+        + struct.pack(">9i", *matrix)
+        + struct.pack(">II", width << 16, height << 16),
+    )
+
+
+IDENTITY = (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+ROTATE_90 = (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+
+
+def trak(handler: bytes, codec: bytes, width=0, height=0, matrix=IDENTITY, seconds=12.345):
+    times = struct.pack(">IIII", 0, 0, 90000, round(seconds * 90000))
+    mdhd = full_box(b"mdhd", times + bytes(4))
+    hdlr = full_box(b"hdlr", bytes(4) + handler + bytes(12))
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + box(codec, bytes(20)))
+    minf = box(b"minf", box(b"stbl", stsd))
+    return box(b"trak", tkhd(width, height, matrix) + box(b"mdia", mdhd + hdlr + minf))
+
+
+FTYP = box(b"ftyp", b"isom" + bytes(4) + b"isom")
+
+
+def mp4(moov_first: bool, matrix=IDENTITY, movie_duration=12345, media_bytes=3_000_000) -> bytes:
+    moov = box(
+        b"moov",
+        mvhd(1000, movie_duration)
+        + trak(b"vide", b"avc1", 1920, 1080, matrix)
+        + trak(b"soun", b"mp4a"),
+    )
+    mdat = box(b"mdat", bytes(media_bytes))
+    return FTYP + moov + mdat if moov_first else FTYP + mdat + moov
+
+
+# WebM / Matroska
+def element(element_id: int, payload: bytes) -> bytes:
+    # Sizes are written as 8-byte vints, as muxers that patch them later do
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + (
+        b"\x01" + len(payload).to_bytes(7, "big")
+    ) + payload
+
+
+EBML = element(0x1A45DFA3, element(0x4282, b"webm"))
+INFO = element(
+    0x1549A966,
+    element(0x2AD7B1, (1_000_000).to_bytes(3, "big"))
+    + element(0x4489, struct.pack(">d", 5500.0))
+    + element(0x4461, struct.pack(">q", 694_224_000 * 10**9)),  # 2023-01-01
+)
+TRACKS = element(
+    0x1654AE6B,
+    element(
+        0xAE,
+        element(0x83, b"\x01")
+        + element(0x86, b"V_VP9")
+        + element(
+            0xE0,
+            element(0xB0, (1280).to_bytes(2, "big")) + element(0xBA, (720).to_bytes(2, "big")),
+        ),
+    )
+    + element(0xAE, element(0x83, b"\x02") + element(0x86, b"A_OPUS")),
+)
+CLUSTER = element(0x1F43B675, bytes(200_000))
+
+
+def seek_head(target: int, position: int) -> bytes:
+    seek = element(0x53AB, target.to_bytes(4, "big")) + element(0x53AC, position.to_bytes(4, "big"))
+    return element(0x114D9B74, element(0x4DBB, seek))
+
+
+def extract(data: bytes) -> tuple[dict, list]:
+    reads = []
+
+    def read(offset: int, length: int) -> bytes:
+        reads.append((offset, length))
+        return data[offset:offset + length]
+
+    return extract_video_metadata(read, len(data)), reads
+
+
+EXPECTED_MP4 = {
+    "durationSeconds": 12.345,
+    "videoCodec": "avc1",
+    "audioCodec": "mp4a",
+    "width": 1920,
+    "height": 1080,
+    "orientation": "landscape",
+    "capturedAt": "2023-01-01T00:00:00",
+}
+
+
+def test_mp4_with_moov_first_is_read_from_the_head_window():
+    metadata, reads = extract(mp4(moov_first=True))
+    assert metadata == EXPECTED_MP4
+    assert reads == [(0, WINDOW_BYTES)]
+
+
+def test_mp4_with_moov_last_reads_the_tail_window_not_the_media():
+    data = mp4(moov_first=False)
+    metadata, reads = extract(data)
+    assert metadata == EXPECTED_MP4
+    assert reads == [(0, WINDOW_BYTES), (len(data) - WINDOW_BYTES, WINDOW_BYTES)]
+
+
+def test_mp4_rotation_swaps_the_display_size():
+    metadata, _ = extract(mp4(moov_first=True, matrix=ROTATE_90))
+    assert (metadata["width"], metadata["height"]) == (1080, 1920)
+    assert metadata["orientation"] == "portrait"
+
+
+def test_mp4_unknown_movie_duration_falls_back_to_the_video_track():
+    metadata, _ = extract(mp4(moov_first=True, movie_duration=0xFFFFFFFF))
+    assert metadata["durationSeconds"] == 12.345
+
+
+def test_small_file_read_through_file_reader():
+    data = mp4(moov_first=False, media_bytes=1000)
+    assert extract_video_metadata(file_reader(io.BytesIO(data)), len(data)) == EXPECTED_MP4
+
+
+def test_webm_with_info_and_tracks_before_the_clusters():
+    data = EBML + element(0x18538067, INFO + TRACKS + CLUSTER)
+    metadata, reads = extract(data)
+    assert metadata == {
+        "durationSeconds": 5.5,
+        "videoCodec": "vp9",
+        "audioCodec": "opus",
+        "width": 1280,
+        "height": 720,
+        "orientation": "landscape",
+        "capturedAt": "2023-01-01T00:00:00",
+    }
+    assert len(reads) == 1
+
+
+def test_webm_tracks_after_the_clusters_are_found_through_the_seek_head():
+    # Seek positions are relative to the segment payload
+    head_length = len(seek_head(0x1654AE6B, 0))
+    seek = seek_head(0x1654AE6B, head_length + len(INFO) + len(CLUSTER))
+    data = EBML + element(0x18538067, seek + INFO + CLUSTER + TRACKS)
+    metadata, reads = extract(data)
+    assert metadata["videoCodec"] == "vp9"
+    assert (metadata["width"], metadata["height"]) == (1280, 720)
+    assert len(reads) <= 3
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"not a video at all" * 100,
+        FTYP + box(b"mdat", bytes(1000)),
+        mp4(moov_first=False)[:-100],
+        EBML + element(0x18538067, CLUSTER),
+    ],
+    ids=["empty", "junk", "no moov", "truncated moov", "webm without tracks"],
+)
+def test_unreadable_headers_give_no_metadata(data):
+    metadata, reads = extract(data)
+    assert metadata.get("durationSeconds") is None
+    assert len(reads) <= MAX_READS + 2
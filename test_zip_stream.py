@@ -0,0 +1,98 @@
+from datetime import datetime
+from zip_stream import ZipStream, dos_datetime, stream_zip
+import io
+import pytest
+import zipfile
+
+
+def read_archive(chunks) -> zipfile.ZipFile:
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert archive.testzip() is None
+    return archive
+
+
+def test_stream_zip_round_trips_through_zipfile():
+    files = [
+        ("a.jpg", datetime(2024, 5, 6, 7, 8, 10), [b"abc", b"", b"def"]),
+        ("clip.mp4", None, [bytes(range(256)) * 1000]),
+        ("empty.txt", datetime(2024, 1, 1), []),
+    ]
+    archive = read_archive(stream_zip(files))
+
+    assert archive.namelist() == ["a.jpg", "clip.mp4", "empty.txt"]
+    assert archive.read("a.jpg") == b"abcdef"
+    assert archive.read("clip.mp4") == bytes(range(256)) * 1000
+    assert archive.read("empty.txt") == b""
+    info = archive.getinfo("a.jpg")
+    assert info.date_time == (2024, 5, 6, 7, 8, 10)
+    assert info.compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo("clip.mp4").date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_empty_archive_is_valid():
+    assert read_archive(stream_zip([])).namelist() == []
+
+
+def test_names_are_utf8_and_deduplicated_case_insensitively():
+    files = [
+        ("Urlaub/Strand.jpg", None, [b"1"]),
+        ("urlaub_strand.JPG", None, [b"2"]),
+        ("Urlaub_Strand.jpg", None, [b"3"]),
+        ("照片.png", None, [b"4"]),
+        ("  ..  ", None, [b"5"]),
+    ]
+    archive = read_archive(stream_zip(files))
+
+    assert archive.namelist() == [
+        "Urlaub_Strand.jpg",
+        "urlaub_strand (1).JPG",
+        "Urlaub_Strand (2).jpg",
+        "照片.png",
+        "file",
+    ]
+    assert archive.read("Urlaub_Strand (2).jpg") == b"3"
+
+
+def test_unique_name_shortens_long_names_keeping_the_extension():
+    name = ZipStream().unique_name("é" * 300 + ".jpeg")
+    assert name.endswith(".jpeg")
+    assert len(name.encode("utf-8")) <= 255 - 8
+
+
+def test_chunks_are_passed_through_and_offsets_add_up():
+    archive = ZipStream()
+    chunk = b"x" * 10
+    sent = [archive.start_entry("a"), archive.data(chunk), archive.end_entry()]
+    assert sent[1] is chunk
+    sent.append(archive.finish())
+    assert read_archive(sent).read("a") == chunk
+
+
+def test_entries_must_be_closed():
+    archive = ZipStream()
+    archive.start_entry("a")
+    with pytest.raises(RuntimeError):
+        archive.start_entry("b")
+    with pytest.raises(RuntimeError):
+        archive.finish()
+
+
+@pytest.mark.parametrize(
+    "moment, expected",
+    [
+        (datetime(1970, 1, 1), datetime(1980, 1, 1)),
+        (datetime(2200, 1, 1), datetime(2107, 12, 31, 23, 59, 58)),
+        (datetime(2024, 2, 29, 13, 45, 59), datetime(2024, 2, 29, 13, 45, 58)),
+    ],
+)
+def test_dos_datetime_clamps_to_the_format(moment, expected):
+    time_field, date_field = dos_datetime(moment)
+    decoded = datetime(
+        (date_field >> 9) + 1980,
+        (date_field >> 5) & 0xF,
+        date_field & 0x1F,
+        time_field >> 11,
+        (time_field >> 5) & 0x3F,
+        (time_field & 0x1F) * 2,
+    )
+    assert decoded == expected
@@ -0,0 +1,375 @@
+"""
+Request tracing
+TracingMiddleware opens a root span for each sampled HTTP request (joining
+the trace of an incoming W3C traceparent header), and span() / traced() open
+child spans for the stages inside it: the upload steps in routes_media, each
+Cosmos DB call (ru_limiter.execute), blob reads and writes (storage,
+storage_local) and image work (utils). The current span is kept in a context
+variable, so spans opened in tasks and in threads started with
+run_in_threadpool (or an executor given contextvars.copy_context().run) get
+the right parent. Outside a traced request span() does nothing.
+
+When the root span ends, the trace is handed to the exporter on a background
+thread, with its critical path: the chain of spans that the request's
+latency actually waited on. settings.tracing_exporter picks the exporter:
+"console" logs each trace as an indented tree, "file" appends one JSON line
+per trace to settings.tracing_file_path, and "package.module:Class" loads
+any other SpanExporter.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from starlette.datastructures import Headers, MutableHeaders
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+from config import settings
+from metrics import TRACES_DROPPED, route_template
+import functools
+import importlib
+import json
+import logging
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TRACE_ID_HEADER = "X-Trace-Id"
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# Finished traces waiting for the exporter; more are dropped
+EXPORT_QUEUE_SIZE = 1000
+
+
+class _Trace:
+    """Spans of one trace recorded in this process"""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+        self.finished = False
+        self.lock = threading.Lock()
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace: _Trace,
+        parent_id: Optional[str],
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.error: Optional[str] = None
+        self.start = time.time()
+        self.duration = 0.0
+        self._started = time.perf_counter()
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration = time.perf_counter() - self._started
+        with self.trace.lock:
+            # Spans that end after the trace was exported are left out
+            if not self.trace.finished:
+                self.trace.spans.append(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "durationMs": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    """The innermost open span, or None outside a traced request"""
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Time the block as a child of the current span
+    Yields None, and records nothing, outside a traced request.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def traced(name: str) -> Callable:
+    """Decorator running a function inside span(name)"""
+
+    def decorator(function: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) -> T:
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def critical_path(spans: List[dict]) -> List[dict]:
+    """
+    Time each span spent on the critical path of a trace, in order
+    Working back from the end of the root span, the path follows the child
+    that finished last, then the one that finished last before that child
+    started, and so on; the gaps count toward the parent itself.
+    """
+    if not spans:
+        return []
+    ids = {span["spanId"] for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        if span["parentId"] in ids:
+            children[span["parentId"]].append(span)
+        else:
+            roots.append(span)
+    root = max(roots, key=lambda span: span["durationMs"])
+    segments = []
+
+    def walk(span: dict, until: float):
+        start = span["start"]
+        cursor = until
+        for child in sorted(
+            children[span["spanId"]],
+            key=lambda child: child["start"] + child["durationMs"] / 1000,
+            reverse=True,
+        ):
+            if child["start"] >= cursor:
+                continue
+            child_end = min(child["start"] + child["durationMs"] / 1000, cursor)
+            if child_end < cursor:
+                segments.append((span, cursor - child_end))
+            walk(child, child_end)
+            cursor = max(child["start"], start)
+            if cursor <= start:
+                break
+        if cursor > start:
+            segments.append((span, cursor - start))
+
+    walk(root, root["start"] + root["durationMs"] / 1000)
+    # Segments were collected latest first
+    path: Dict[str, dict] = {}
+    for span, seconds in reversed(segments):
+        entry = path.setdefault(span["spanId"], {"name": span["name"], "ms": 0.0})
+        entry["ms"] += seconds * 1000
+    return [{"name": entry["name"], "ms": round(entry["ms"], 3)} for entry in path.values()]
+
+
+class SpanExporter:
+    """Receives each finished trace (see _record for its shape)"""
+
+    def export(self, trace: dict):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class ConsoleExporter(SpanExporter):
+    """Logs each trace as its critical path and an indented span tree"""
+
+    def export(self, trace: dict):
+        children = defaultdict(list)
+        for span in trace["spans"]:
+            children[span["parentId"]].append(span)
+        lines = [
+            f"Trace {trace['traceId']}: {trace['name']} {trace['durationMs']:.1f} ms",
+            "  critical path: "
+            + " > ".join(f"{step['name']} {step['ms']:.1f} ms" for step in trace["criticalPath"]),
+        ]
+
+        def add(span: dict, depth: int):
+            error = f" [{span['error']}]" if span["error"] else ""
+            lines.append(f"{'  ' * depth}{span['name']} {span['durationMs']:.1f} ms{error}")
+            for child in sorted(children[span["spanId"]], key=lambda child: child["start"]):
+                add(child, depth + 1)
+
+        ids = {span["spanId"] for span in trace["spans"]}
+        for span in trace["spans"]:
+            if span["parentId"] not in ids:
+                add(span, 1)
+        logger.info("\n".join(lines))
+
+
+class FileExporter(SpanExporter):
+    """Appends each trace to a file as one JSON line"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or settings.tracing_file_path
+        self._file = None
+
+    def export(self, trace: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(trace, default=str) + "\n")
+        self._file.flush()
+
+    def shutdown(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+EXPORTERS = {"console": ConsoleExporter, "file": FileExporter}
+
+
+def create_exporter() -> SpanExporter:
+    name = settings.tracing_exporter
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+    module_name, _, class_name = name.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown tracing exporter: '{name}'")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def _record(root: Span) -> dict:
+    with root.trace.lock:
+        root.trace.finished = True
+        spans = [span.to_dict() for span in root.trace.spans]
+    spans.sort(key=lambda span: span["start"])
+    return {
+        "traceId": root.trace_id,
+        "name": root.name,
+        "startedAt": datetime.fromtimestamp(root.start, timezone.utc).isoformat(),
+        "durationMs": round(root.duration * 1000, 3),
+        "criticalPath": critical_path(spans),
+        "spans": spans,
+    }
+
+
+class Tracer:
+    """Starts root spans and exports finished traces on a background thread"""
+
+    def __init__(self):
+        self._exporter: Optional[SpanExporter] = None
+        self._queue: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start_trace(self, name: str, traceparent: str = "") -> Optional[Span]:
+        """
+        Root span for a request, continuing the trace of a valid traceparent;
+        None when the request is not sampled
+        """
+        match = TRACEPARENT.match(traceparent.strip().lower())
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                return None
+        else:
+            if random.random() >= settings.tracing_sample_rate:
+                return None
+            trace_id, parent_id = secrets.token_hex(16), None
+        return Span(name, _Trace(trace_id), parent_id)
+
+    def finish_trace(self, root: Span):
+        root.end()
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(root)
+        except queue.Full:
+            TRACES_DROPPED.inc()
+
+    def reset_after_fork(self):
+        self._exporter = None
+        self._queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="trace-exporter", daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            root = self._queue.get()
+            try:
+                if self._exporter is None:
+                    self._exporter = create_exporter()
+                self._exporter.export(_record(root))
+            except Exception as e:
+                logger.warning(f"Failed to export trace {root.trace_id}: {e}")
+
+
+tracer = Tracer()
+
+
+class TracingMiddleware:
+    """ASGI middleware tracing sampled requests, named after their route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.tracing_enabled:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        root = tracer.start_trace(
+            f"{scope['method']} {scope['path']}", headers.get("traceparent", "")
+        )
+        if root is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.set("http.status_code", message["status"])
+                MutableHeaders(scope=message).append(TRACE_ID_HEADER, root.trace_id)
+            await send(message)
+
+        token = _current.set(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            root.name = f"{scope['method']} {route_template(scope)}"
+            root.set("http.path", scope["path"])
+            tracer.finish_trace(root)
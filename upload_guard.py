@@ -0,0 +1,209 @@
+"""
+Admission checks for multipart uploads
+Runs before python-multipart sees the body, so a request that cannot succeed
+is refused without being ingested: a Content-Length over the limit is
+rejected before any of the body is read, the limit is enforced again while
+the body streams (chunked uploads carry no length), and the first bytes of the
+file part are sniffed against the allowed image and video types instead of
+trusting the client's Content-Type, which must name the sniffed type. A body
+without a file part is refused too. A failed check raises an HTTPException out
+of receive(), which ends body parsing at once with a 413 or 415. The sender's
+upload rate limit (see rate_limit) is applied here too, before the body is read.
+"""
+
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from multipart.multipart import parse_options_header
+from starlette.datastructures import Headers
+from typing import Optional
+from auth import bearer_user_id
+from config import settings
+from metrics import UPLOADS_REJECTED
+from rate_limit import RateLimitedError, admit
+
+# Room for the form fields and part headers around the file
+FORM_OVERHEAD_BYTES = 64 * 1024
+# Longest part header block read before the body is refused
+MAX_PART_HEADER_BYTES = 64 * 1024
+# Leading file bytes every signature below fits in
+SNIFF_BYTES = 16
+
+SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"\x1a\x45\xdf\xa3", "video/webm"),
+    (b"\x00\x00\x01\xba", "video/mpeg"),
+    (b"\x00\x00\x01\xb3", "video/mpeg"),
+)
+# Top-level atoms a QuickTime file without an ftyp box may start with
+QUICKTIME_ATOMS = (b"moov", b"mdat", b"wide", b"free", b"skip")
+
+
+def sniff_content_type(head: bytes) -> Optional[str]:
+    """Media type identified by a file's leading bytes, or None if unknown"""
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        return "video/quicktime" if head[8:12] == b"qt  " else "video/mp4"
+    if head[4:8] in QUICKTIME_ATOMS:
+        return "video/quicktime"
+    return None
+
+
+def upload_limit_bytes() -> int:
+    return settings.max_file_size_bytes + FORM_OVERHEAD_BYTES
+
+
+def _too_large() -> HTTPException:
+    UPLOADS_REJECTED.inc(reason="too_large")
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Upload exceeds maximum allowed size ({settings.max_file_size_mb} MB)",
+    )
+
+
+def _unsupported(reason: str, detail: str) -> HTTPException:
+    UPLOADS_REJECTED.inc(reason=reason)
+    return HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=detail)
+
+
+class FileSniffer:
+    """
+    Finds the first file part of a multipart body and checks its leading bytes
+    The body is scanned as it streams: only the part headers being read and
+    the file's first bytes are kept, so form fields of any size ahead of the
+    file cannot push it out of reach.
+    """
+
+    def __init__(self, boundary: bytes):
+        self._delimiter = b"--" + boundary
+        self._buffer = bytearray()
+        # "delimiter", "headers" (of a part) or "content" (of the file part)
+        self._state = "delimiter"
+        self._declared = None
+        self.done = False
+
+    def feed(self, chunk: bytes, final: bool):
+        """
+        Raises:
+            HTTPException: 415 once the file part's content is seen not to
+                match an allowed type, or the body ends without a file part
+        """
+        self._buffer += chunk
+        head = self._file_head(final)
+        if head is not None:
+            self.done = True
+            self._buffer = bytearray()
+            self._check(self._declared, head)
+        elif final:
+            self.done = True
+            raise _unsupported("no_file", "Upload has no file part")
+
+    def _file_head(self, final: bool) -> Optional[bytes]:
+        """Leading bytes of the first file part, once they have arrived"""
+        buffer = self._buffer
+        while True:
+            if self._state == "delimiter":
+                start = buffer.find(self._delimiter)
+                if start < 0:
+                    # Keep what could be the start of a delimiter split across chunks
+                    del buffer[:max(0, len(buffer) - len(self._delimiter) + 1)]
+                    return None
+                del buffer[:start + len(self._delimiter)]
+                self._state = "headers"
+            elif self._state == "headers":
+                headers_end = buffer.find(b"\r\n\r\n")
+                if headers_end < 0:
+                    if len(buffer) > MAX_PART_HEADER_BYTES:
+                        raise _unsupported("no_file", "Upload has no file part")
+                    return None
+                headers = bytes(buffer[:headers_end])
+                del buffer[:headers_end + 4]
+                if b"filename=" not in headers.lower():
+                    self._state = "delimiter"
+                    continue
+                for line in headers.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-type":
+                        self._declared = value.split(b";")[0].strip().decode("latin-1").lower()
+                self._state = "content"
+            else:
+                content_end = buffer.find(b"\r\n" + self._delimiter)
+                if content_end < 0:
+                    content_end = len(buffer)
+                    if content_end < SNIFF_BYTES and not final:
+                        return None
+                return bytes(buffer[:min(content_end, SNIFF_BYTES)])
+
+    @staticmethod
+    def _check(declared: Optional[str], head: bytes):
+        detected = sniff_content_type(head)
+        allowed = settings.allowed_image_types_list + settings.allowed_video_types_list
+        if detected is None or detected not in allowed:
+            raise _unsupported(
+                "unsupported_content", "File content is not an allowed image or video type"
+            )
+        # The declared type is stored as the media's mimeType
+        if declared and declared != detected:
+            raise _unsupported("content_mismatch", f"File content is {detected}, not {declared}")
+
+
+class UploadGuardMiddleware:
+    """ASGI middleware applying the upload checks to multipart requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        content_type, options = parse_options_header(headers.get("content-type", ""))
+        if content_type != b"multipart/form-data":
+            await self.app(scope, receive, send)
+            return
+
+        limit = upload_limit_bytes()
+        content_length = headers.get("content-length", "")
+        error = None
+        if content_length.isdigit() and int(content_length) > limit:
+            error = _too_large()
+        else:
+            # Without a valid token the route itself rejects the request
+            user_id = bearer_user_id(headers.get("authorization", ""))
+            if user_id is not None:
+                try:
+                    await admit(user_id, "upload")
+                except RateLimitedError as e:
+                    error = e
+        if error is not None:
+            # Nothing has been read, so the response can be sent right away
+            response = JSONResponse(
+                {"detail": error.detail}, status_code=error.status_code, headers=error.headers
+            )
+            await response(scope, receive, send)
+            return
+
+        boundary = options.get(b"boundary")
+        sniffer = FileSniffer(boundary) if boundary else None
+        received = 0
+
+        async def guarded_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                if received > limit:
+                    raise _too_large()
+                if sniffer is not None and not sniffer.done:
+                    sniffer.feed(body, final=not message.get("more_body", False))
+            return message
+
+        await self.app(scope, guarded_receive, send)
@@ -0,0 +1,58 @@
+"""
+Per-user maintenance runs
+Shared by the scripts that walk every user (reconcile_blobs.py,
+backfill_video_metadata.py): users are taken from --user or read in id order,
+database calls run at bulk priority, and an interrupted run logs the
+--after value that resumes it.
+"""
+
+from collections import Counter
+from typing import Callable, Iterator, List, Optional
+from database import cosmos_db
+from ru_limiter import bulk
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def add_user_arguments(parser: argparse.ArgumentParser, verb: str):
+    parser.add_argument("--user", action="append", help=f"{verb} only this user (repeatable)")
+    parser.add_argument("--after", help="resume with the users whose id sorts after this one")
+
+
+def user_ids(after: Optional[str]) -> Iterator[str]:
+    for page in cosmos_db.iter_users(after_id=after, fields=["id"]):
+        for user in page:
+            yield user["id"]
+
+
+def run_per_user(
+    job: str,
+    handle: Callable[[str], None],
+    users: Optional[List[str]],
+    after: Optional[str],
+    counts: Counter,
+    dry_run: bool = False,
+) -> int:
+    """
+    Call handle(user_id) for each user and log counts at the end
+    Returns 0, or the exit code of an interrupted (130) or failed (1) run.
+    """
+    done = after
+    try:
+        with bulk():
+            for user_id in users or user_ids(after):
+                handle(user_id)
+                done = user_id
+    except KeyboardInterrupt:
+        logger.warning(f"Interrupted; resume with --after {done}" if done else "Interrupted")
+        return 130
+    except Exception as e:
+        logger.error(f"{job} failed after user {done}: {e}", exc_info=True)
+        return 1
+
+    logger.info(f"{job} complete" + (" (dry run)" if dry_run else ""))
+    for name, count in sorted(counts.items()):
+        logger.info(f"  {name}: {count}")
+    return 0
@@ -0,0 +1,76 @@
+"""
+Per-user in-memory indexes
+An index is built for a user on first use from one database query, kept in a
+least-recently-used map, and adjusted in place by the routes that change the
+underlying documents. Worker processes do not share memory, so a copy is
+rebuilt once it is older than settings.user_index_ttl_seconds; writes handled
+by another worker show up by then.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+from config import settings
+import threading
+import time
+
+T = TypeVar("T")
+
+
+class UserCache(Generic[T]):
+    """
+    Least recently used per-user values built by load(user_id)
+
+    Values are read and changed only under self.lock.
+    """
+
+    def __init__(self, load: Callable[[str], T]):
+        self._load_value = load
+        self._values: "OrderedDict[str, tuple[float, T]]" = OrderedDict()
+        # [loads in progress, writes seen since the first began] per user
+        self._loading: Dict[str, List[int]] = {}
+        self.lock = threading.Lock()
+
+    def peek(self, user_id: str) -> Optional[T]:
+        """The user's value if it is in memory and fresh; call with self.lock held"""
+        entry = self._values.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > settings.user_index_ttl_seconds:
+            del self._values[user_id]
+            return None
+        self._values.move_to_end(user_id)
+        return entry[1]
+
+    def get(self, user_id: str) -> T:
+        """The user's value, loading it (outside the lock) if needed"""
+        with self.lock:
+            value = self.peek(user_id)
+            if value is not None:
+                return value
+            loading = self._loading.setdefault(user_id, [0, 0])
+            loading[0] += 1
+            writes_before = loading[1]
+        value = None
+        try:
+            value = self._load_value(user_id)
+            return value
+        finally:
+            with self.lock:
+                loading[0] -= 1
+                if loading[0] == 0:
+                    del self._loading[user_id]
+                # A write that raced the query may or may not be in its
+                # result, so such a load is served once but not kept
+                if value is not None and loading[1] == writes_before:
+                    self._values[user_id] = (time.monotonic(), value)
+                    while len(self._values) > settings.user_index_max_users:
+                        self._values.popitem(last=False)
+
+    def update(self, user_id: str, change: Callable[[T], None]):
+        """Apply change to the user's value if it is in memory"""
+        with self.lock:
+            if user_id in self._loading:
+                self._loading[user_id][1] += 1
+            entry = self._values.get(user_id)
+            if entry is not None:
+                change(entry[1])
@@ -1,8 +1,11 @@
 from fastapi import UploadFile, HTTPException, status
-from PIL import Image
+from PIL import Image, ExifTags
+from datetime import datetime, timezone
 import io
 from typing import Optional
 from config import settings
+from metrics import THUMBNAIL_DURATION
+from tracing import traced
 import logging
 
 logger = logging.getLogger(__name__)
@@ -46,36 +49,153 @@ def validate_file_size(file: UploadFile, max_size: int = None) -> int:
     return file_size
 
 
+def perceptual_hash(image: Image.Image) -> str:
+    """
+    64-bit difference hash (dHash) of an image, as 16 hex digits
+    Each bit says whether a pixel of a 9x8 grayscale reduction is brighter than
+    its right neighbour, so re-encoded, resized or slightly edited copies of an
+    image hash within a few bits of each other.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.BOX).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            bits = (bits << 1) | (left > pixels[row * 9 + column + 1])
+    return f"{bits:016x}"
+
+
 def generate_thumbnail(image_data: bytes, max_size: tuple = (300, 300)) -> Optional[bytes]:
     """
     Generate thumbnail from image data
     Returns thumbnail as bytes or None if failed
     """
+    return generate_thumbnail_and_hash(image_data, max_size)[0]
+
+
+@traced("image.thumbnail")
+def generate_thumbnail_and_hash(
+    image_data: bytes, max_size: tuple = (300, 300)
+) -> tuple[Optional[bytes], Optional[str]]:
+    """
+    Generate thumbnail and perceptual hash from image data, decoding it once
+    The hash is taken from the thumbnail, which is far cheaper than the full
+    image and gives the same result at 9x8.
+    Returns (thumbnail bytes, hash), or (None, None) if failed
+    """
     try:
-        # Open image
-        image = Image.open(io.BytesIO(image_data))
+        with THUMBNAIL_DURATION.time():
+            # Open image
+            image = Image.open(io.BytesIO(image_data))
+
+            # Convert RGBA to RGB if necessary
+            if image.mode in ("RGBA", "LA", "P"):
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                if image.mode == "P":
+                    image = image.convert("RGBA")
+                background.paste(image, mask=image.split()[-1] if image.mode == "RGBA" else None)
+                image = background
 
-        # Convert RGBA to RGB if necessary
-        if image.mode in ("RGBA", "LA", "P"):
-            background = Image.new("RGB", image.size, (255, 255, 255))
-            if image.mode == "P":
-                image = image.convert("RGBA")
-            background.paste(image, mask=image.split()[-1] if image.mode == "RGBA" else None)
-            image = background
+            # Generate thumbnail
+            image.thumbnail(max_size, Image.Resampling.LANCZOS)
 
-        # Generate thumbnail
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+            image_hash = perceptual_hash(image)
 
-        # Save to bytes
-        output = io.BytesIO()
-        image.save(output, format="JPEG", quality=85, optimize=True)
-        output.seek(0)
+            # Save to bytes
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=85, optimize=True)
+            output.seek(0)
 
-        return output.read()
+            return output.read(), image_hash
 
     except Exception as e:
         logger.error(f"Failed to generate thumbnail: {e}")
+        return None, None
+
+
+@traced("image.metadata")
+def extract_image_metadata(image_data: bytes) -> dict:
+    """
+    Extract dimensions and EXIF metadata from image data
+    Only the image headers are parsed; pixel data is never decoded.
+    Returns a dict of media document fields (empty if the image is unreadable)
+    """
+    try:
+        # Image.open is lazy: it reads the header and EXIF segment only
+        with Image.open(io.BytesIO(image_data)) as image:
+            width, height = image.size
+            exif = image.getexif()
+
+        exif_orientation = exif.get(ExifTags.Base.Orientation)
+        # EXIF orientations 5-8 are rotated by 90 degrees, so the displayed
+        # dimensions are swapped
+        if exif_orientation in (5, 6, 7, 8):
+            width, height = height, width
+
+        metadata = {
+            "width": width,
+            "height": height,
+            "orientation": orientation_of(width, height),
+        }
+
+        exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+        captured_at = _parse_exif_datetime(
+            exif_ifd.get(ExifTags.Base.DateTimeOriginal)
+            or exif.get(ExifTags.Base.DateTime)
+        )
+        if captured_at:
+            metadata["capturedAt"] = captured_at
+
+        camera_model = exif.get(ExifTags.Base.Model)
+        if isinstance(camera_model, str) and camera_model.strip("\x00 "):
+            metadata["cameraModel"] = camera_model.strip("\x00 ")
+
+        return metadata
+
+    except Exception as e:
+        logger.warning(f"Failed to extract image metadata: {e}")
+        return {}
+
+
+def process_image(image_data: bytes) -> tuple[Optional[bytes], Optional[str], dict]:
+    """
+    Thumbnail, perceptual hash and header metadata of an uploaded image, in
+    one call so that all of its Pillow work can run off the event loop
+    Returns (thumbnail bytes or None, hash or None, metadata fields)
+    """
+    thumbnail_data, image_hash = generate_thumbnail_and_hash(image_data)
+    return thumbnail_data, image_hash, extract_image_metadata(image_data)
+
+
+def orientation_of(width: int, height: int) -> str:
+    """Orientation of displayed dimensions, as stored in media documents"""
+    if width > height:
+        return "landscape"
+    if width < height:
+        return "portrait"
+    return "square"
+
+
+def _parse_exif_datetime(value) -> Optional[str]:
+    """Convert an EXIF 'YYYY:MM:DD HH:MM:SS' timestamp to ISO format"""
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S").isoformat()
+    except ValueError:
+        return None
+
+
+def captured_at_filter(value: Optional[datetime]) -> Optional[str]:
+    """
+    A capturedAt query bound in the form stored values have (naive ISO), so
+    they compare correctly as strings; aware values are converted to UTC first
+    """
+    if value is None:
         return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
 
 
 def format_file_size(size_bytes: int) -> str:
@@ -0,0 +1,427 @@
+"""
+Video metadata from container headers
+Duration, display size, codecs and creation time are read from the header
+structures of MP4/QuickTime files (the moov box: mvhd, and tkhd, hdlr, mdhd
+and stsd of each track) and WebM/Matroska files (the EBML Info and Tracks
+elements). Media data is never read: the file is accessed through
+read(offset, length), which is served from one window at the start and one
+at the end of the file (where a moov box written after the media data
+sits), with ranged reads only for box headers outside them. Blob storage
+supports such reads, so a stored video can be inspected for a few KB.
+"""
+
+from datetime import datetime, timedelta
+from typing import BinaryIO, Callable, Dict, Iterator, Optional
+from utils import orientation_of
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+Reader = Callable[[int, int], bytes]
+
+# Bytes read at each end of the file up front
+WINDOW_BYTES = 64 * 1024
+# Ranged reads allowed per file beyond the two windows
+MAX_READS = 32
+# Largest moov box or Matroska Info/Tracks element read whole
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+
+MP4_TOP_LEVEL_BOXES = {
+    b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pdin", b"uuid", b"moof", b"mfra",
+    b"meta", b"sidx", b"styp",
+}
+MP4_EPOCH = datetime(1904, 1, 1)
+
+EBML_HEADER = 0x1A45DFA3
+EBML_DOC_TYPE = 0x4282
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+DATE_UTC = 0x4461
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+CLUSTER = 0x1F43B675
+MATROSKA_EPOCH = datetime(2001, 1, 1)
+
+
+class HeaderError(ValueError):
+    """The file is not a container this module can read, or is truncated"""
+
+
+class RangeReader:
+    """read(offset, length) over a file, caching a window at each end"""
+
+    def __init__(self, read: Reader, size: int, window: int = WINDOW_BYTES):
+        self._read = read
+        self.size = size
+        self._window = min(window, size)
+        self._head: Optional[bytes] = None
+        self._tail: Optional[bytes] = None
+        self.reads = 0
+
+    def _fetch(self, offset: int, length: int) -> bytes:
+        self.reads += 1
+        if self.reads > MAX_READS + 2:
+            raise HeaderError("Too many reads for a header")
+        return self._read(offset, length)
+
+    def read(self, offset: int, length: int) -> bytes:
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        if end <= self._window:
+            if self._head is None:
+                self._head = self._fetch(0, self._window)
+            return self._head[offset:end]
+        tail_start = self.size - self._window
+        if offset >= tail_start:
+            if self._tail is None:
+                self._tail = self._fetch(tail_start, self._window)
+            return self._tail[offset - tail_start:end - tail_start]
+        return self._fetch(offset, end - offset)
+
+
+def file_reader(file: BinaryIO) -> Reader:
+    """read(offset, length) over a seekable file object"""
+
+    def read(offset: int, length: int) -> bytes:
+        file.seek(offset)
+        return file.read(length)
+
+    return read
+
+
+def _captured_at(value: datetime) -> Optional[str]:
+    # Many muxers leave creation times at zero or at the encode time of a
+    # broken clock; only plausible ones are kept
+    if datetime(1971, 1, 1) <= value <= datetime.utcnow() + timedelta(days=1):
+        return value.replace(microsecond=0).isoformat()
+    return None
+
+
+# MP4 / QuickTime
+def _boxes(data: bytes, start: int = 0, end: Optional[int] = None) -> Iterator[tuple]:
+    """(type, payload start, box end) of the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, position)
+        header = 8
+        if size == 1:
+            if position + 16 > end:
+                return
+            (size,) = struct.unpack_from(">Q", data, position + 8)
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header or position + size > end:
+            return
+        yield box_type, position + header, position + size
+        position += size
+
+
+def _child(data: bytes, start: int, end: int, *path: bytes) -> Optional[tuple[int, int]]:
+    """(payload start, end) of the first box at path below data[start:end]"""
+    for box_type, payload, box_end in _boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return payload, box_end
+            return _child(data, payload, box_end, *path[1:])
+    return None
+
+
+def _find_moov(reader: RangeReader) -> bytes:
+    """Payload of the moov box, found by walking the top-level box headers"""
+    position = 0
+    while position + 8 <= reader.size:
+        header = reader.read(position, 16)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                break
+            (size,) = struct.unpack_from(">Q", header, 8)
+            header_size = 16
+        elif size == 0:
+            size = reader.size - position
+        if box_type not in MP4_TOP_LEVEL_BOXES or size < header_size:
+            raise HeaderError(f"Unexpected box {box_type!r} at {position}")
+        if box_type == b"moov":
+            if size > MAX_HEADER_BYTES:
+                raise HeaderError(f"moov box of {size} bytes")
+            if position + size > reader.size:
+                raise HeaderError("Truncated moov box")
+            return reader.read(position + header_size, size - header_size)
+        position += size
+    raise HeaderError("No moov box")
+
+
+def _header_times(data: bytes, start: int) -> tuple[int, int, int]:
+    """(creation time, timescale, duration) of an mvhd or mdhd box"""
+    if data[start] == 1:
+        created, _, timescale, duration = struct.unpack_from(">QQIQ", data, start + 4)
+    else:
+        created, _, timescale, duration = struct.unpack_from(">IIII", data, start + 4)
+    return created, timescale, duration
+
+
+def _rotation(matrix: tuple) -> int:
+    a, b = matrix[0], matrix[1]
+    if a == 0 and b == 0x10000:
+        return 90
+    if a == 0 and b == -0x10000:
+        return 270
+    if a == -0x10000:
+        return 180
+    return 0
+
+
+def _mp4_track(moov: bytes, start: int, end: int) -> Optional[dict]:
+    handler = _child(moov, start, end, b"mdia", b"hdlr")
+    if handler is None:
+        return None
+    track = {"handler": moov[handler[0] + 8:handler[0] + 12]}
+    sample_descriptions = _child(moov, start, end, b"mdia", b"minf", b"stbl", b"stsd")
+    if sample_descriptions and sample_descriptions[1] - sample_descriptions[0] >= 16:
+        track["codec"] = moov[sample_descriptions[0] + 12:sample_descriptions[0] + 16]
+    header = _child(moov, start, end, b"tkhd")
+    if header is not None:
+        version = moov[header[0]]
+        # Past the times, track id and duration: reserved, layer, group,
+        # volume, reserved, then the matrix and the 16.16 display size
+        matrix_start = header[0] + (4 + 32 if version == 1 else 4 + 20) + 16
+        if matrix_start + 44 <= header[1]:
+            matrix = struct.unpack_from(">9i", moov, matrix_start)
+            width, height = struct.unpack_from(">II", moov, matrix_start + 36)
+            track["width"] = round(width / 65536)
+            track["height"] = round(height / 65536)
+            track["rotation"] = _rotation(matrix)
+    media_header = _child(moov, start, end, b"mdia", b"mdhd")
+    if media_header is not None:
+        _, timescale, duration = _header_times(moov, media_header[0])
+        if timescale:
+            track["duration"] = duration / timescale
+    return track
+
+
+def _mp4_metadata(reader: RangeReader) -> dict:
+    moov = _find_moov(reader)
+    metadata = {}
+    movie_header = _child(moov, 0, len(moov), b"mvhd")
+    tracks = [
+        _mp4_track(moov, payload, box_end)
+        for box_type, payload, box_end in _boxes(moov)
+        if box_type == b"trak"
+    ]
+    tracks = [track for track in tracks if track]
+    video = next((t for t in tracks if t["handler"] == b"vide"), None)
+    audio = next((t for t in tracks if t["handler"] == b"soun"), None)
+
+    duration = None
+    if movie_header is not None:
+        created, timescale, movie_duration = _header_times(moov, movie_header[0])
+        # All ones means unknown (fragmented files)
+        if timescale and movie_duration not in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+            duration = movie_duration / timescale
+        if created:
+            metadata["capturedAt"] = _captured_at(MP4_EPOCH + timedelta(seconds=created))
+    if not duration and video and video.get("duration"):
+        duration = video["duration"]
+    if duration:
+        metadata["durationSeconds"] = round(duration, 3)
+
+    if video:
+        if video.get("codec"):
+            metadata["videoCodec"] = video["codec"].decode("latin-1").strip()
+        if video.get("width") and video.get("height"):
+            width, height = video["width"], video["height"]
+            if video["rotation"] in (90, 270):
+                width, height = height, width
+            metadata["width"], metadata["height"] = width, height
+    if audio and audio.get("codec"):
+        metadata["audioCodec"] = audio["codec"].decode("latin-1").strip()
+    return metadata
+
+
+# WebM / Matroska
+def _vint(data: bytes, position: int, marker: bool) -> tuple[Optional[int], int]:
+    """(value, length) of an EBML variable-size integer; None for unknown sizes"""
+    if position >= len(data):
+        raise HeaderError("Truncated EBML element")
+    first = data[position]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or position + length > len(data):
+        raise HeaderError("Invalid EBML integer")
+    value = first if marker else first & (0xFF >> length)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    if not marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def _elements(data: bytes, start: int = 0, end: Optional[int] = None) -> Iterator[tuple]:
+    """(id, payload start, payload end) of the EBML elements in data[start:end]"""
+    end = len(data) if end is None else end
+    position = start
+    while position < end:
+        element_id, id_length = _vint(data, position, marker=True)
+        size, size_length = _vint(data, position + id_length, marker=False)
+        payload = position + id_length + size_length
+        payload_end = end if size is None else payload + size
+        if payload_end > end:
+            return
+        yield element_id, payload, payload_end
+        position = payload_end
+
+
+def _uint(data: bytes) -> int:
+    return int.from_bytes(data, "big")
+
+
+def _matroska_info(data: bytes, metadata: dict):
+    scale = 1_000_000
+    duration = None
+    for element_id, start, end in _elements(data):
+        if element_id == TIMECODE_SCALE:
+            scale = _uint(data[start:end])
+        elif element_id == DURATION and end - start in (4, 8):
+            (duration,) = struct.unpack(">f" if end - start == 4 else ">d", data[start:end])
+        elif element_id == DATE_UTC and end - start == 8:
+            (nanoseconds,) = struct.unpack(">q", data[start:end])
+            captured_at = _captured_at(
+                MATROSKA_EPOCH + timedelta(microseconds=nanoseconds // 1000)
+            )
+            if captured_at:
+                metadata["capturedAt"] = captured_at
+    if duration:
+        metadata["durationSeconds"] = round(duration * scale / 1e9, 3)
+
+
+def _matroska_tracks(data: bytes, metadata: dict):
+    for element_id, start, end in _elements(data):
+        if element_id != TRACK_ENTRY:
+            continue
+        track = {}
+        for child_id, child_start, child_end in _elements(data, start, end):
+            if child_id == TRACK_TYPE:
+                track["type"] = _uint(data[child_start:child_end])
+            elif child_id == CODEC_ID:
+                codec = data[child_start:child_end].decode("ascii", "replace").strip("\x00")
+                # V_VP9 -> vp9, A_OPUS -> opus
+                track["codec"] = codec.split("_", 1)[-1].lower()
+            elif child_id == VIDEO:
+                for video_id, video_start, video_end in _elements(data, child_start, child_end):
+                    if video_id == PIXEL_WIDTH:
+                        track["width"] = _uint(data[video_start:video_end])
+                    elif video_id == PIXEL_HEIGHT:
+                        track["height"] = _uint(data[video_start:video_end])
+        if track.get("type") == 1 and "videoCodec" not in metadata:
+            if track.get("codec"):
+                metadata["videoCodec"] = track["codec"]
+            if track.get("width") and track.get("height"):
+                metadata["width"], metadata["height"] = track["width"], track["height"]
+        elif track.get("type") == 2 and "audioCodec" not in metadata and track.get("codec"):
+            metadata["audioCodec"] = track["codec"]
+
+
+def _read_element(reader: RangeReader, position: int) -> tuple[int, Optional[int], int]:
+    """(id, payload size or None if unknown, header length) of the element at position"""
+    header = reader.read(position, 12)
+    element_id, id_length = _vint(header, 0, marker=True)
+    size, size_length = _vint(header, id_length, marker=False)
+    return element_id, size, id_length + size_length
+
+
+def _matroska_metadata(reader: RangeReader) -> dict:
+    element_id, size, header_length = _read_element(reader, 0)
+    if element_id != EBML_HEADER or size is None:
+        raise HeaderError("No EBML header")
+    header = reader.read(header_length, size)
+    doc_types = [
+        header[start:end] for child, start, end in _elements(header) if child == EBML_DOC_TYPE
+    ]
+    if doc_types and doc_types[0].rstrip(b"\x00") not in (b"webm", b"matroska"):
+        raise HeaderError(f"Unknown EBML document type {doc_types[0]!r}")
+    metadata = {}
+
+    position = header_length + size
+    element_id, segment_size, header_length = _read_element(reader, position)
+    if element_id != SEGMENT:
+        raise HeaderError("No Segment element")
+    segment_start = position + header_length
+    segment_end = reader.size if segment_size is None else segment_start + segment_size
+
+    # Info and Tracks normally come before the first Cluster; otherwise the
+    # SeekHead says where they are
+    found: Dict[int, int] = {}
+    seek: Dict[int, int] = {}
+    position = segment_start
+    while position < segment_end and not (INFO in found and TRACKS in found):
+        element_id, size, header_length = _read_element(reader, position)
+        if element_id == CLUSTER or size is None:
+            break
+        if element_id in (INFO, TRACKS):
+            found[element_id] = position
+        elif element_id == SEEK_HEAD and size <= MAX_HEADER_BYTES:
+            data = reader.read(position + header_length, size)
+            for entry_id, start, end in _elements(data):
+                if entry_id != SEEK:
+                    continue
+                target = offset = None
+                for child_id, child_start, child_end in _elements(data, start, end):
+                    if child_id == SEEK_ID:
+                        target = _uint(data[child_start:child_end])
+                    elif child_id == SEEK_POSITION:
+                        offset = _uint(data[child_start:child_end])
+                if target is not None and offset is not None:
+                    seek[target] = segment_start + offset
+        position += header_length + size
+
+    for element_id, parse in ((INFO, _matroska_info), (TRACKS, _matroska_tracks)):
+        position = found.get(element_id, seek.get(element_id))
+        if position is None:
+            continue
+        found_id, size, header_length = _read_element(reader, position)
+        if found_id != element_id or size is None or size > MAX_HEADER_BYTES:
+            continue
+        parse(reader.read(position + header_length, size), metadata)
+    return metadata
+
+
+def extract_video_metadata(read: Reader, size: int) -> dict:
+    """
+    Read duration, size, codecs and creation time from a video's headers
+    Returns a dict of media document fields (empty if the container is not
+    MP4/QuickTime or WebM/Matroska, or its headers cannot be read)
+    """
+    reader = RangeReader(read, size)
+    try:
+        head = reader.read(0, 8)
+        if head[:4] == b"\x1a\x45\xdf\xa3":
+            metadata = _matroska_metadata(reader)
+        else:
+            metadata = _mp4_metadata(reader)
+    except Exception as e:
+        logger.warning(f"Failed to extract video metadata: {e}")
+        return {}
+
+    metadata = {key: value for key, value in metadata.items() if value is not None}
+    if metadata.get("width") and metadata.get("height"):
+        metadata["orientation"] = orientation_of(metadata["width"], metadata["height"])
+    return metadata
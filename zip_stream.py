@@ -0,0 +1,190 @@
+"""
+Streaming ZIP writer
+Produces a ZIP archive as a sequence of byte strings without seeking, so it
+can be sent while it is being built. Entries are stored (media files are
+already compressed) and always written in ZIP64 form: sizes and CRCs follow
+each entry's data in a data descriptor, so neither needs to be known up
+front, and no entry or archive size limit applies.
+"""
+
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+import posixpath
+import re
+import struct
+import zlib
+
+# Stored entries need 4.5 for ZIP64
+ZIP_VERSION = 45
+# Bit 3: sizes in a data descriptor, bit 11: UTF-8 names
+FLAGS = 0x0808
+# Unix host, so external attributes carry file permissions
+VERSION_MADE_BY = (3 << 8) | ZIP_VERSION
+EXTERNAL_ATTRIBUTES = 0o100644 << 16
+ZIP64_EXTRA_ID = 0x0001
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+MAX_NAME_BYTES = 255
+
+_UNSAFE_NAME_CHARACTERS = re.compile(r'[\x00-\x1f\x7f/\\:*?"<>|]')
+
+
+def dos_datetime(moment: Optional[datetime]) -> tuple[int, int]:
+    """MS-DOS (time, date) fields; the format starts in 1980"""
+    if moment is None or moment.year < 1980:
+        moment = datetime(1980, 1, 1)
+    if moment.year > 2107:
+        moment = datetime(2107, 12, 31, 23, 59, 58)
+    time_field = (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2)
+    date_field = ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day
+    return time_field, date_field
+
+
+class _Entry:
+    __slots__ = ("name", "time", "date", "offset", "crc", "size")
+
+    def __init__(self, name: bytes, time_field: int, date_field: int, offset: int):
+        self.name = name
+        self.time = time_field
+        self.date = date_field
+        self.offset = offset
+        self.crc = 0
+        self.size = 0
+
+
+class ZipStream:
+    """
+    Incremental ZIP64 writer
+
+    Each method returns the bytes to send next; entry data is passed through
+    unchanged, so file chunks are never copied into a larger buffer.
+    """
+
+    def __init__(self):
+        self._offset = 0
+        self._entries: List[_Entry] = []
+        self._current: Optional[_Entry] = None
+        self._names = set()
+
+    def unique_name(self, name: str, fallback: str = "file") -> str:
+        """Make name safe as a flat archive path and distinct from earlier ones"""
+        name = _UNSAFE_NAME_CHARACTERS.sub("_", name or "").strip(" .") or fallback
+        stem, extension = posixpath.splitext(name)
+        while len(f"{stem}{extension}".encode("utf-8")) > MAX_NAME_BYTES - 8:
+            stem = stem[:-1]
+        candidate, counter = f"{stem}{extension}", 1
+        while candidate.lower() in self._names:
+            candidate = f"{stem} ({counter}){extension}"
+            counter += 1
+        self._names.add(candidate.lower())
+        return candidate
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def start_entry(self, name: str, modified: Optional[datetime] = None) -> bytes:
+        """Local file header of a new entry"""
+        if self._current is not None:
+            raise RuntimeError("Previous entry is still open")
+        time_field, date_field = dos_datetime(modified)
+        entry = _Entry(name.encode("utf-8"), time_field, date_field, self._offset)
+        self._current = entry
+        # Sizes are unknown here; the ZIP64 extra marks them as such
+        extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, 0, 0)
+        header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            ZIP_VERSION,
+            FLAGS,
+            0,  # stored
+            entry.time,
+            entry.date,
+            0,
+            MAX_32,
+            MAX_32,
+            len(entry.name),
+            len(extra),
+        )
+        return self._emit(header + entry.name + extra)
+
+    def data(self, chunk: bytes) -> bytes:
+        """Account for a chunk of the open entry and return it unchanged"""
+        entry = self._current
+        entry.crc = zlib.crc32(chunk, entry.crc)
+        entry.size += len(chunk)
+        return self._emit(chunk)
+
+    def end_entry(self) -> bytes:
+        """ZIP64 data descriptor closing the open entry"""
+        entry = self._current
+        self._current = None
+        self._entries.append(entry)
+        return self._emit(struct.pack("<IIQQ", 0x08074B50, entry.crc, entry.size, entry.size))
+
+    def finish(self) -> bytes:
+        """Central directory and the ZIP64 and classic end records"""
+        if self._current is not None:
+            raise RuntimeError("An entry is still open")
+        directory = bytearray()
+        for entry in self._entries:
+            extra = struct.pack(
+                "<HHQQQ", ZIP64_EXTRA_ID, 24, entry.size, entry.size, entry.offset
+            )
+            directory += struct.pack(
+                "<IHHHHHHIIIHHHHHII",
+                0x02014B50,
+                VERSION_MADE_BY,
+                ZIP_VERSION,
+                FLAGS,
+                0,
+                entry.time,
+                entry.date,
+                entry.crc,
+                MAX_32,
+                MAX_32,
+                len(entry.name),
+                len(extra),
+                0,  # comment
+                0,  # disk
+                0,  # internal attributes
+                EXTERNAL_ATTRIBUTES,
+                MAX_32,
+            )
+            directory += entry.name + extra
+
+        directory_offset = self._offset
+        zip64_end_offset = directory_offset + len(directory)
+        count = len(self._entries)
+        directory += struct.pack(
+            "<IQHHIIQQQQ",
+            0x06064B50,
+            44,
+            VERSION_MADE_BY,
+            ZIP_VERSION,
+            0,
+            0,
+            count,
+            count,
+            len(directory),
+            directory_offset,
+        )
+        directory += struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+        directory += struct.pack(
+            "<IHHHHIIH", 0x06054B50, 0, 0, MAX_16, MAX_16, MAX_32, MAX_32, 0
+        )
+        return self._emit(bytes(directory))
+
+
+def stream_zip(
+    files: Iterable[tuple[str, Optional[datetime], Iterable[bytes]]]
+) -> Iterator[bytes]:
+    """Archive (name, modified, chunks) triples as a stream of byte strings"""
+    archive = ZipStream()
+    for name, modified, chunks in files:
+        yield archive.start_entry(archive.unique_name(name), modified)
+        for chunk in chunks:
+            if chunk:
+                yield archive.data(chunk)
+        yield archive.end_entry()
+    yield archive.finish()